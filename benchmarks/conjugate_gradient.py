@@ -0,0 +1,97 @@
+"""
+Comparison of the L-BFGS-B and conjugate gradient solvers
+---------------------------------------------------------
+
+Minimizes the cost function of a synthetic case with the radial velocity,
+mass continuity, smoothness and background constraints with L-BFGS-B and
+with pydda.retrieval.linear_solver.solve_cg. Prints the final cost of
+each solver, the number of cost function evaluations or Hessian products
+it took, and how many the conjugate gradient solver needed to get below
+the final cost of L-BFGS-B. Also checks that the Hessian products are
+symmetric.
+
+Usage: python conjugate_gradient.py [nz ny nx]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+from scipy.optimize import minimize, Bounds
+from scipy.sparse.linalg import cg
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.cost_functions import gradient_check, make_constraints
+from pydda.retrieval import linear_solver
+
+SYMMETRY_TOLERANCE = 1e-10
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        grid_shape = tuple(int(x) for x in sys.argv[1:])
+    else:
+        grid_shape = (10, 40, 40)
+
+    case = gradient_check.make_synthetic_case(grid_shape)
+    registry = make_constraints(
+        case['observations'], case['rmsVr'], case['u_back'],
+        case['v_back'], case['bg_weights'], case['Co'], case['Cm'],
+        case['Cx'], case['Cy'], case['Cz'], case['Cb'], 0.0, None, None)
+    registry.setup(grid_shape, case['dx'], case['dy'], case['dz'],
+                   case['z'])
+    winds = np.zeros(3*np.prod(grid_shape))
+
+    operator = linear_solver.HessianOperator(registry, grid_shape)
+    x = np.random.randn(len(winds))
+    y = np.random.randn(len(winds))
+    xHy = x.dot(operator.matvec(y))
+    yHx = y.dot(operator.matvec(x))
+    asymmetry = abs(xHy - yHx)/abs(xHy)
+    print('Relative asymmetry of the Hessian: ' + "{:.3e}".format(asymmetry))
+
+    n_evaluations = [0]
+
+    def cost_function(winds):
+        n_evaluations[0] += 1
+        J, grad, _ = registry.evaluate(winds)
+        return J, grad.copy()
+
+    bt = time.time()
+    result = minimize(cost_function, winds, method='L-BFGS-B', jac=True,
+                      bounds=Bounds(-100.0, 100.0),
+                      options={'maxiter': 10000, 'maxfun': 100000,
+                               'gtol': 1e-3})
+    print('L-BFGS-B: J = ' + "{:.6f}".format(result.fun) + ', ' +
+          str(n_evaluations[0]) + ' evaluations, ' +
+          "{:.2f}".format(time.time() - bt) + ' s')
+
+    diagnostics = {}
+    bt = time.time()
+    linear_solver.solve_cg(registry, winds, grid_shape, 10000, np.float64,
+                           diagnostics=diagnostics)
+    print('CG: J = ' + "{:.6f}".format(diagnostics['cost']) + ', ' +
+          str(diagnostics['evaluations']) + ' evaluations, ' +
+          "{:.2f}".format(time.time() - bt) + ' s')
+
+    # Number of iterations until the cost is below that of L-BFGS-B
+    operator = linear_solver.HessianOperator(registry, grid_shape)
+    rhs = -operator.free*registry.evaluate(winds)[1]
+    n_iterations = [0, None]
+
+    def callback(increment):
+        n_iterations[0] += 1
+        if(n_iterations[1] is None and
+           registry.evaluate(increment)[0] <= result.fun):
+            n_iterations[1] = n_iterations[0]
+
+    cg(operator, rhs, rtol=1e-3, atol=0.0, maxiter=10000,
+       M=linear_solver.jacobi_preconditioner(operator), callback=callback)
+    print('CG iterations to reach the cost of L-BFGS-B: ' +
+          str(n_iterations[1]))
+
+    if asymmetry > SYMMETRY_TOLERANCE:
+        raise RuntimeError('The Hessian products are not symmetric!')
@@ -0,0 +1,69 @@
+"""
+Gradient checks and timings of each cost function term
+------------------------------------------------------
+
+Runs pydda.cost_functions.gradient_check on a synthetic grid: every term of
+the cost function is evaluated with each backend, its gradient is checked
+against finite differences and compared to the reference NumPy functions,
+and the run time and peak memory of an evaluation are recorded. Exits with
+status 1 if any row fails its tolerances. The terms whose baseline
+gradients are known to be inexact are listed on stderr.
+
+Usage: python cost_terms.py [--shape nz ny nx] [--backends ...]
+                            [--precision float64] [--format csv|json]
+                            [--output file] [--fd-tolerance 1e-5]
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.cost_functions import gradient_check
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shape', type=int, nargs=3, default=[20, 50, 50],
+                        metavar=('NZ', 'NY', 'NX'))
+    parser.add_argument('--terms', nargs='+', default=gradient_check.TERMS,
+                        choices=gradient_check.TERMS)
+    parser.add_argument('--backends', nargs='+',
+                        default=gradient_check.BACKENDS,
+                        choices=gradient_check.BACKENDS)
+    parser.add_argument('--precision', default='float64',
+                        choices=['float32', 'float64'])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--format', default='csv', choices=['csv', 'json'])
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--fd-tolerance', type=float,
+                        default=gradient_check.FD_TOLERANCE)
+    args = parser.parse_args()
+
+    rows = gradient_check.run_harness(
+        tuple(args.shape), terms=args.terms, backends=args.backends,
+        dtype=args.precision, repeat=args.repeat,
+        fd_tolerance=args.fd_tolerance)
+    table = gradient_check.format_rows(rows, fmt=args.format)
+    if args.output is None:
+        sys.stdout.write(table)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(table)
+
+    for row in rows:
+        if row['known_inexact'] and row['fd_error'] > args.fd_tolerance:
+            sys.stderr.write('Known inexact gradient: ' + row['term'] +
+                             ' (' + row['backend'] + '), fd_error ' +
+                             "{:.3g}".format(row['fd_error']) + '\n')
+    failed = [row for row in rows if not row['passed']]
+    for row in failed:
+        sys.stderr.write('FAILED: ' + row['term'] + ' (' + row['backend'] +
+                         ')\n')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
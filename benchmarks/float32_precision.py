@@ -0,0 +1,94 @@
+"""
+Validation of the float32 retrieval mode
+----------------------------------------
+
+Evaluates J_and_grad on a random wind field and random observations in
+float64 and in float32 with every constraint enabled, for both backends,
+and checks that the float32 cost function and gradient stay within a
+fixed relative tolerance of the float64 ones. The float32 and float64
+winds of full retrievals are compared in pydda/retrieval/test_precision.py.
+
+The numba kernels do their arithmetic in float64 and are not limited by
+memory traffic, so their float32 evaluations are not faster, and can be
+slightly slower, than float64 ones.
+
+Usage: python float32_precision.py [nz ny nx]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.cost_functions import J_and_grad, make_radar_observations
+from pydda.cost_functions import merge_radar_observations
+
+# Maximum allowed relative differences from float64
+J_TOLERANCE = 1e-5
+GRAD_TOLERANCE = 1e-4
+
+
+def make_case(grid_shape, n_radars=3, dtype=np.float64):
+    np.random.seed(0)
+    masked = lambda x, p: np.ma.masked_where(
+        np.random.rand(*grid_shape) < p, x)
+    vrs = [masked(10*np.random.randn(*grid_shape), 0.3)
+           for i in range(n_radars)]
+    azs = [masked(2*np.pi*np.random.rand(*grid_shape), 0.0)
+           for i in range(n_radars)]
+    els = [masked(0.5*np.random.rand(*grid_shape), 0.0)
+           for i in range(n_radars)]
+    wts = [masked(-3*np.random.rand(*grid_shape), 0.0)
+           for i in range(n_radars)]
+    weights = (np.random.rand(n_radars, *grid_shape) > 0.3).astype(dtype)
+    bg_weights = (np.random.rand(*grid_shape) > 0.5).astype(dtype)
+    z = np.tile(500.0*np.arange(grid_shape[0])[:, np.newaxis, np.newaxis],
+                (1, grid_shape[1], grid_shape[2])).astype(dtype)
+    winds = np.random.randn(3*np.prod(grid_shape))
+    observations = make_radar_observations(vrs, azs, els, wts, weights,
+                                           dtype=dtype)
+    return winds, observations, bg_weights, z
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        grid_shape = tuple(int(x) for x in sys.argv[1:])
+    else:
+        grid_shape = (20, 100, 100)
+
+    u_back = np.random.randn(grid_shape[0])
+    v_back = np.random.randn(grid_shape[0])
+    failed = False
+    for backend in ['numpy', 'numba']:
+        results = {}
+        for precision in ['float64', 'float32']:
+            winds, observations, bg_weights, z = make_case(
+                grid_shape, dtype=np.dtype(precision))
+            if backend == 'numba':
+                observations = merge_radar_observations(observations)
+            args = (observations, u_back, v_back, 1.0, 1500.0, 1e-2, 1e-2,
+                    1e-2, 1e-2, 1e-5, 5.0, 3.0, grid_shape, 1000.0, 1000.0,
+                    500.0, z, 10.0, bg_weights, True, backend, precision)
+            J_and_grad(winds, *args)
+            bt = time.time()
+            results[precision] = J_and_grad(winds, *args)
+            print(backend + ' ' + precision + ' time per evaluation: ' +
+                  "{:.4f}".format(time.time() - bt) + ' s')
+
+        J64, grad64 = results['float64']
+        J32, grad32 = results['float32']
+        J_error = abs(J32 - J64)/abs(J64)
+        grad_error = (np.abs(grad32 - grad64).max() /
+                      np.abs(grad64).max())
+        print(backend + ' relative difference in cost:     ' +
+              "{:.3e}".format(J_error))
+        print(backend + ' relative difference in gradient: ' +
+              "{:.3e}".format(grad_error))
+        if J_error > J_TOLERANCE or grad_error > GRAD_TOLERANCE:
+            failed = True
+
+    if failed:
+        raise RuntimeError('float32 results differ too much from float64!')
@@ -0,0 +1,59 @@
+"""
+Wall time of the multigrid retrieval
+------------------------------------
+
+Retrieves the winds of a synthetic two radar case from
+pydda.retrieval.synthetic, with the radial velocity, mass continuity and
+smoothness constraints, with and without multigrid=True, and prints the
+wall time, the number of iterations and evaluations of the cost function
+on the full grid and in total, and the RMS error of each run against the
+true winds.
+
+Usage: python multigrid.py [nz ny nx]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.initialization import make_constant_wind_field
+from pydda.retrieval import get_dd_wind_field
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        grid_shape = tuple(int(x) for x in sys.argv[1:])
+    else:
+        grid_shape = (10, 128, 128)
+
+    Grids, truth = make_synthetic_grids(grid_shape)
+    u_init, v_init, w_init = make_constant_wind_field(Grids[0])
+    lines = []
+    for multigrid in [False, True]:
+        bt = time.time()
+        result = get_dd_wind_field(
+            Grids, u_init, v_init, w_init, Co=1.0, Cm=1500.0, Cx=1e-2,
+            Cy=1e-2, Cz=1e-2, frz=5000.0, filt_iterations=0,
+            mask_w_outside_opt=False, max_iterations=1000,
+            multigrid=multigrid)
+        elapsed = time.time() - bt
+        diagnostics = result.diagnostics
+        coarse = diagnostics.get('multigrid', [])
+        fine_evaluations = (diagnostics['evaluations'] -
+                            sum(level['evaluations'] for level in coarse))
+        errors = [np.sqrt(np.mean(np.square(np.ma.getdata(x) - t)))
+                  for x, t in zip([result.u, result.v, result.w], truth)]
+        lines.append(
+            'multigrid=' + str(multigrid) + ': ' +
+            "{:.2f}".format(elapsed) + ' s, ' +
+            str(diagnostics['iterations']) + ' iterations, ' +
+            str(diagnostics['evaluations']) + ' evaluations (' +
+            str(fine_evaluations) + ' on the full grid), RMS error ' +
+            ', '.join("{:.3f}".format(e) for e in errors) + ' m/s')
+    for line in lines:
+        print(line)
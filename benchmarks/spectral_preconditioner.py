@@ -0,0 +1,86 @@
+"""
+Iteration counts with the spectral preconditioner
+-------------------------------------------------
+
+Minimizes the cost function of a synthetic case with the radial velocity,
+mass continuity, smoothness and background constraints, with L-BFGS-B and
+with conjugate gradients, each with and without
+pydda.retrieval.preconditioner.SpectralPreconditioner, and prints the
+number of iterations, the number of cost function evaluations and the
+final cost of each run.
+
+Usage: python spectral_preconditioner.py [nz ny nx]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+from scipy.optimize import minimize, Bounds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.cost_functions import gradient_check, make_constraints
+from pydda.retrieval import linear_solver, preconditioner
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        grid_shape = tuple(int(x) for x in sys.argv[1:])
+    else:
+        grid_shape = (10, 40, 40)
+
+    case = gradient_check.make_synthetic_case(grid_shape)
+    registry = make_constraints(
+        case['observations'], case['rmsVr'], case['u_back'],
+        case['v_back'], case['bg_weights'], case['Co'], case['Cm'],
+        case['Cx'], case['Cy'], case['Cz'], case['Cb'], 0.0, None, None)
+    registry.setup(grid_shape, case['dx'], case['dy'], case['dz'],
+                   case['z'])
+    winds = np.zeros(3*np.prod(grid_shape))
+
+    bt = time.time()
+    spectral = preconditioner.SpectralPreconditioner(registry)
+    print('Setup of the preconditioner: ' +
+          "{:.2f}".format(time.time() - bt) + ' s')
+
+    n_evaluations = [0]
+
+    def cost_function(winds):
+        n_evaluations[0] += 1
+        J, grad, _ = registry.evaluate(winds)
+        return J, grad.copy()
+
+    for name in ['none', 'spectral']:
+        n_evaluations[0] = 0
+        bt = time.time()
+        if name == 'none':
+            result = minimize(cost_function, winds, method='L-BFGS-B',
+                              jac=True, bounds=Bounds(-100.0, 100.0),
+                              options={'maxiter': 10000, 'maxfun': 100000,
+                                       'gtol': 1e-3})
+        else:
+            result = minimize(preconditioner.ChangeOfVariables(
+                                  cost_function, spectral, winds),
+                              np.zeros(len(winds)), method='L-BFGS-B',
+                              jac=True, options={'maxiter': 10000,
+                                                 'maxfun': 100000,
+                                                 'gtol': 1e-3})
+        print('L-BFGS-B, preconditioner ' + name + ': ' +
+              str(result.nit) + ' iterations, ' + str(n_evaluations[0]) +
+              ' evaluations, J = ' + "{:.6f}".format(result.fun) + ', ' +
+              "{:.2f}".format(time.time() - bt) + ' s')
+
+    for name, M in [('jacobi', 'jacobi'), ('spectral', spectral)]:
+        diagnostics = {}
+        bt = time.time()
+        linear_solver.solve_cg(registry, winds, grid_shape, 10000,
+                               np.float64, diagnostics=diagnostics,
+                               preconditioner=M)
+        print('CG, preconditioner ' + name + ': ' +
+              str(diagnostics['iterations']) + ' iterations, ' +
+              str(diagnostics['evaluations']) + ' evaluations, J = ' +
+              "{:.6f}".format(diagnostics['cost']) + ', ' +
+              "{:.2f}".format(time.time() - bt) + ' s')
@@ -0,0 +1,63 @@
+"""
+Benchmark of the compiled vertical vorticity kernel
+---------------------------------------------------
+
+Compares the numba vertical vorticity cost function and gradient against
+the NumPy reference on a random wind field, checks that both give the same
+result and prints the time per evaluation of each.
+
+Usage: python vertical_vorticity_kernel.py [nz ny nx]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.cost_functions import calculate_vertical_vorticity_cost_and_gradient
+from pydda.cost_functions.kernels import \
+    calculate_vertical_vorticity_cost_and_gradient_numba
+
+
+def time_function(function, args, repeats=5):
+    times = []
+    for i in range(repeats):
+        bt = time.time()
+        result = function(*args)
+        times.append(time.time() - bt)
+    return np.min(times), result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        grid_shape = tuple(int(x) for x in sys.argv[1:])
+    else:
+        grid_shape = (40, 200, 200)
+
+    np.random.seed(0)
+    u = 10*np.random.randn(*grid_shape)
+    v = 10*np.random.randn(*grid_shape)
+    w = np.random.randn(*grid_shape)
+    args = (u, v, w, 1000.0, 1000.0, 500.0, 5.0, 3.0, 1e-5)
+
+    # Compile the kernel before timing it
+    calculate_vertical_vorticity_cost_and_gradient_numba(*args)
+    numpy_time, (J_numpy, grad_numpy) = time_function(
+        calculate_vertical_vorticity_cost_and_gradient, args)
+    numba_time, (J_numba, grad_numba) = time_function(
+        calculate_vertical_vorticity_cost_and_gradient_numba, args)
+
+    J_error = abs(J_numba - J_numpy)/abs(J_numpy)
+    grad_error = (np.abs(grad_numba - grad_numpy).max() /
+                  np.abs(grad_numpy).max())
+    print('Grid shape: ' + str(grid_shape))
+    print('Relative difference in cost:     ' + "{:.3e}".format(J_error))
+    print('Relative difference in gradient: ' + "{:.3e}".format(grad_error))
+    print('NumPy time per evaluation: ' + "{:.4f}".format(numpy_time) + ' s')
+    print('Numba time per evaluation: ' + "{:.4f}".format(numba_time) + ' s')
+    print('Speedup: ' + "{:.1f}".format(numpy_time/numba_time) + 'x')
+    if J_error > 1e-10 or grad_error > 1e-10:
+        raise RuntimeError('Numba kernel does not match the NumPy reference!')
@@ -0,0 +1,66 @@
+"""
+Iterations with a warm start from the previous volume
+-----------------------------------------------------
+
+Retrieves a synthetic volume from pydda.retrieval.synthetic, then the
+next volume, in which the wind field has moved with the storm, once from
+a constant wind field and once from the first retrieval advected with
+pydda.initialization.make_initialization_from_previous. Prints the
+iterations, evaluations, final cost, wall time and RMS error against the
+true winds of both retrievals of the second volume.
+
+Usage: python warm_start.py [nz ny nx]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pydda.initialization import make_constant_wind_field
+from pydda.initialization import make_initialization_from_previous
+from pydda.retrieval import get_dd_wind_field
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+# Time between the volumes in s and storm motion in m/s
+DT = 300.0
+STORM_MOTION = (10.0, 5.0)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        grid_shape = tuple(int(x) for x in sys.argv[1:])
+    else:
+        grid_shape = (10, 64, 64)
+
+    kwargs = dict(Co=1.0, Cm=1500.0, Cx=1e-2, Cy=1e-2, Cz=1e-2, frz=5000.0,
+                  filt_iterations=0, mask_w_outside_opt=False,
+                  max_iterations=1000)
+    first, _ = make_synthetic_grids(grid_shape, seed=0)
+    u_init, v_init, w_init = make_constant_wind_field(first[0])
+    previous = get_dd_wind_field(first, u_init, v_init, w_init, **kwargs)
+
+    offset = (STORM_MOTION[0]*DT, STORM_MOTION[1]*DT)
+    second, truth = make_synthetic_grids(grid_shape, seed=1, offset=offset)
+    starts = [('cold', make_constant_wind_field(second[0])),
+              ('warm', make_initialization_from_previous(
+                  second[0], previous, dt=DT, storm_motion=STORM_MOTION))]
+    lines = []
+    for name, (u_init, v_init, w_init) in starts:
+        bt = time.time()
+        result = get_dd_wind_field(second, u_init, v_init, w_init, **kwargs)
+        elapsed = time.time() - bt
+        errors = [np.sqrt(np.mean(np.square(np.ma.getdata(x) - t)))
+                  for x, t in zip([result.u, result.v, result.w], truth)]
+        lines.append(
+            name + ' start: ' + str(result.diagnostics['iterations']) +
+            ' iterations, ' + str(result.diagnostics['evaluations']) +
+            ' evaluations, J = ' +
+            "{:.4f}".format(result.diagnostics['cost']) + ', ' +
+            "{:.2f}".format(elapsed) + ' s, RMS error ' +
+            ', '.join("{:.3f}".format(e) for e in errors) + ' m/s')
+    for line in lines:
+        print(line)
@@ -28,11 +28,14 @@ u_init, v_init, w_init = pydda.initialization.make_wind_field_from_profile(
 
 # Start the wind retrieval. This example only uses the mass continuity
 # and data weighting constraints.
-Grids = pydda.retrieval.get_dd_wind_field([berr_grid, cpol_grid], u_init,
-                                          v_init, w_init, Co=10.0, Cm=1500.0, 
-                                          Cz=0, vel_name='VT', refl_field='DT',
-                                          frz=5000.0, filt_iterations=2, 
-                                          mask_outside_opt=True, upper_bc=1)
+result = pydda.retrieval.get_dd_wind_field([berr_grid, cpol_grid], u_init,
+                                           v_init, w_init, Co=10.0, Cm=1500.0, 
+                                           Cz=0, vel_name='VT', refl_field='DT',
+                                           frz=5000.0, filt_iterations=2, 
+                                           mask_outside_opt=True, upper_bc=1)
+
+# Make Py-ART Grids with the wind fields for plotting
+Grids = result.to_grids()
 # Plot a horizontal cross section
 plt.figure(figsize=(9,9))
 pydda.vis.plot_horiz_xsection_barbs(Grids, background_field='DT', level=6,
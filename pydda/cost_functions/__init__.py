@@ -12,6 +12,7 @@ The procedures in this module calculate the individual cost functions and their
 
     J_function
     grad_J  
+    J_and_grad
     calculate_radial_vel_cost_function
     calculate_grad_radial_vel
     calculate_mass_continuity
@@ -23,6 +24,30 @@ The procedures in this module calculate the individual cost functions and their
     calculate_vertical_vorticity_cost
     calculate_vertical_vorticity_gradient
     calculate_fall_speed
+    calculate_radial_vel_cost_and_gradient
+    calculate_mass_continuity_and_gradient
+    calculate_smoothness_cost_and_gradient
+    calculate_background_cost_and_gradient
+    calculate_vertical_vorticity_cost_and_gradient
+    calculate_mass_continuity_hessian_product
+    make_radar_observations
+    merge_radar_observations
+    RadarObservation
+    MergedRadarObservations
+    Workspace
+    DerivativeCache
+    Constraint
+    ConstraintRegistry
+    RadialVelocityConstraint
+    MassContinuityConstraint
+    SmoothnessConstraint
+    BackgroundConstraint
+    VerticalVorticityConstraint
+    make_constraints
+    instrument
+    Profile
+    kernels
+    gradient_check
 """
 
 
@@ -37,4 +62,19 @@ from .cost_functions import calculate_background_gradient
 from .cost_functions import calculate_background_cost
 from .cost_functions import calculate_vertical_vorticity_cost
 from .cost_functions import calculate_vertical_vorticity_gradient
-from .cost_functions import J_function, grad_J
+from .cost_functions import calculate_radial_vel_cost_and_gradient
+from .cost_functions import calculate_mass_continuity_and_gradient
+from .cost_functions import calculate_smoothness_cost_and_gradient
+from .cost_functions import calculate_background_cost_and_gradient
+from .cost_functions import calculate_vertical_vorticity_cost_and_gradient
+from .cost_functions import calculate_mass_continuity_hessian_product
+from .cost_functions import J_function, grad_J, J_and_grad
+from .observations import RadarObservation, MergedRadarObservations
+from .observations import make_radar_observations, merge_radar_observations
+from .workspace import Workspace, DerivativeCache
+from .constraints import Constraint, ConstraintRegistry
+from .constraints import RadialVelocityConstraint, MassContinuityConstraint
+from .constraints import SmoothnessConstraint, BackgroundConstraint
+from .constraints import VerticalVorticityConstraint, make_constraints
+from . import gradient_check
+from .instrumentation import instrument, Profile
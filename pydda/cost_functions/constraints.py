@@ -0,0 +1,645 @@
+"""
+Pluggable constraints for the cost function.
+
+Each term of the cost function is a :py:class:`Constraint` that knows how
+to evaluate its value and gradient from the wind field. A
+:py:class:`ConstraintRegistry` holds the active constraints of a retrieval,
+prepares them once before the solver starts and sums their values and
+gradients on every evaluation. New constraints can be added to a retrieval
+by subclassing :py:class:`Constraint` without editing the solver loop.
+"""
+
+import numpy as np
+
+from . import kernels
+from .cost_functions import calculate_radial_vel_cost_and_gradient
+from .cost_functions import calculate_mass_continuity_and_gradient
+from .cost_functions import calculate_mass_continuity_hessian_product
+from .cost_functions import calculate_smoothness_cost_and_gradient
+from .cost_functions import calculate_background_cost_and_gradient
+from .cost_functions import calculate_vertical_vorticity_cost_and_gradient
+from .observations import merge_radar_observations
+from .workspace import Workspace
+from .instrumentation import measure
+
+
+BACKENDS = ('numpy', 'numba')
+
+
+class Constraint(object):
+    """
+    Base class for a term of the cost function.
+
+    Subclasses implement :py:meth:`value` and :py:meth:`gradient`, or
+    override :py:meth:`value_and_gradient` when both can be computed
+    together more cheaply. Anything that only depends on the grid or the
+    data, and not on the wind field, should be computed once in
+    :py:meth:`setup`.
+
+    Parameters
+    ----------
+    coeff: float
+        Weight of this constraint in the cost function. A constraint with
+        a weight of zero is skipped.
+
+    Attributes
+    ----------
+    name: str
+        Short name of the constraint, used as its key in a
+        :py:class:`ConstraintRegistry` and in the printed cost table.
+    quadratic: bool
+        True if the constraint is a quadratic function of the wind field,
+        so that its gradient is affine. Only cost functions made of
+        quadratic constraints can be minimized by the conjugate gradient
+        solver.
+    """
+    name = 'J'
+    quadratic = False
+
+    def __init__(self, coeff=1.0):
+        self.coeff = coeff
+
+    @property
+    def active(self):
+        """
+        True if this constraint contributes to the cost function.
+        """
+        return self.coeff != 0
+
+    def setup(self, grid_shape, dx, dy, dz, z, workspace):
+        """
+        Prepares the constraint for a retrieval. This is called once
+        before the solver starts.
+
+        Parameters
+        ----------
+        grid_shape: tuple
+            Shape (nz, ny, nx) of the analysis grid
+        dx: float
+            Spacing of grid in x direction
+        dy: float
+            Spacing of grid in y direction
+        dz: float
+            Spacing of grid in z direction
+        z: 3D float array
+            Height of each grid point
+        workspace: Workspace
+            Buffers of the retrieval. Constraints may use
+            :py:meth:`Workspace.work` for their working arrays.
+        """
+        pass
+
+    def value(self, u, v, w):
+        """
+        Returns the value of the constraint for the wind field (u, v, w).
+        """
+        raise NotImplementedError
+
+    def gradient(self, u, v, w, grad_out=None):
+        """
+        Returns the gradient of the constraint with respect to (u, v, w)
+        flattened to 1D. If grad_out, a (3, nz, ny, nx) array, is given
+        the gradient is added to it in place.
+        """
+        raise NotImplementedError
+
+    def value_and_gradient(self, u, v, w, grad_out=None):
+        """
+        Returns the value of the constraint and its gradient. If grad_out
+        is given the gradient is added to it in place.
+        """
+        return self.value(u, v, w), self.gradient(u, v, w, grad_out=grad_out)
+
+    def hessian_product(self, u, v, w, grad_out=None):
+        """
+        Returns the product of the Hessian of a quadratic constraint with
+        (u, v, w), flattened to 1D. If grad_out is given the product is
+        added to it in place.
+
+        The default is the difference between the gradient at (u, v, w) and
+        the gradient at zero wind, which is exact when :py:meth:`gradient`
+        is the exact gradient of :py:meth:`value`. The gradient at zero wind
+        is only computed once for each grid shape and data type.
+        """
+        key = (u.shape, u.dtype)
+        if(getattr(self, '_zero_gradient_key', None) != key):
+            zero = np.zeros_like(u)
+            self._zero_gradient = np.reshape(
+                self.gradient(zero, zero, zero), (3,) + u.shape).copy()
+            self._zero_gradient_key = key
+        product = np.reshape(self.gradient(u, v, w), (3,) + u.shape)
+        product = product - self._zero_gradient
+        if grad_out is None:
+            return product.reshape(-1)
+        grad_out += product
+        return grad_out.reshape(-1)
+
+
+class _FusedConstraint(Constraint):
+    """
+    Constraint where value and gradient come from a single fused
+    evaluation.
+    """
+    def value(self, u, v, w):
+        return self.value_and_gradient(u, v, w)[0]
+
+    def gradient(self, u, v, w, grad_out=None):
+        return self.value_and_gradient(u, v, w, grad_out=grad_out)[1]
+
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError("backend must be one of " + str(BACKENDS))
+
+
+class RadialVelocityConstraint(_FusedConstraint):
+    """
+    Fit to the observed radial velocities of each radar.
+
+    Parameters
+    ----------
+    observations: list of RadarObservation or MergedRadarObservations
+        The observation operator for each radar
+    rmsVr: float
+        The sum of squares of velocity/num_points. Use for normalization
+        of data weighting coefficient
+    coeff: float
+        Weight of the constraint
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    backend: str
+        'numpy' or 'numba'
+    """
+    name = 'Jvel'
+    quadratic = True
+
+    def __init__(self, observations, rmsVr, coeff=1.0, upper_bc=True,
+                 backend='numpy'):
+        _check_backend(backend)
+        Constraint.__init__(self, coeff)
+        self.observations = observations
+        self.rmsVr = rmsVr
+        self.upper_bc = upper_bc
+        self.backend = backend
+
+    def setup(self, grid_shape, dx, dy, dz, z, workspace):
+        if(self.backend == 'numba'):
+            self.observations = merge_radar_observations(self.observations)
+
+    def value_and_gradient(self, u, v, w, grad_out=None):
+        if(self.backend == 'numba'):
+            return kernels.calculate_radial_vel_cost_and_gradient_numba(
+                self.observations, u, v, w, rmsVr=self.rmsVr,
+                coeff=self.coeff, upper_bc=self.upper_bc, grad_out=grad_out)
+        return calculate_radial_vel_cost_and_gradient(
+            self.observations, u, v, w, rmsVr=self.rmsVr, coeff=self.coeff,
+            upper_bc=self.upper_bc, grad_out=grad_out)
+
+
+class MassContinuityConstraint(_FusedConstraint):
+    """
+    Anelastic mass continuity equation.
+
+    Parameters
+    ----------
+    coeff: float
+        Weight of the constraint
+    anel: int
+        =1 use anelastic approximation, 0=don't
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    backend: str
+        'numpy' or 'numba'
+    """
+    name = 'Jmass'
+    quadratic = True
+
+    def __init__(self, coeff=1500.0, anel=1, upper_bc=True, backend='numpy'):
+        _check_backend(backend)
+        Constraint.__init__(self, coeff)
+        self.anel = anel
+        self.upper_bc = upper_bc
+        self.backend = backend
+
+    def setup(self, grid_shape, dx, dy, dz, z, workspace):
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.z = z
+        if(self.backend == 'numba'):
+            if(self.anel == 1):
+                self.anel_profile = kernels.make_anelastic_profile(z, dz)
+            else:
+                self.anel_profile = np.zeros(grid_shape[0])
+            self.div = workspace.work('div')
+        self.derivatives = workspace.derivatives
+
+    def value_and_gradient(self, u, v, w, grad_out=None):
+        if(self.backend == 'numba'):
+            return kernels.calculate_mass_continuity_and_gradient_numba(
+                u, v, w, self.anel_profile, self.dx, self.dy, self.dz,
+                coeff=self.coeff, upper_bc=self.upper_bc, grad_out=grad_out,
+                work=self.div)
+        return calculate_mass_continuity_and_gradient(
+            u, v, w, self.z, self.dx, self.dy, self.dz, coeff=self.coeff,
+            anel=self.anel, upper_bc=self.upper_bc, grad_out=grad_out,
+            derivatives=self.derivatives.bind((u, v, w)))
+
+    def hessian_product(self, u, v, w, grad_out=None):
+        return calculate_mass_continuity_hessian_product(
+            u, v, w, self.z, self.dx, self.dy, self.dz, coeff=self.coeff,
+            anel=self.anel, grad_out=grad_out)
+
+
+class SmoothnessConstraint(_FusedConstraint):
+    """
+    Penalty on the Laplacian of the wind field.
+
+    Parameters
+    ----------
+    Cx: float
+        Constant controlling smoothness in x-direction
+    Cy: float
+        Constant controlling smoothness in y-direction
+    Cz: float
+        Constant controlling smoothness in z-direction
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    backend: str
+        'numpy' or 'numba'
+    """
+    name = 'Jsmooth'
+    quadratic = True
+
+    def __init__(self, Cx=1e-5, Cy=1e-5, Cz=1e-5, upper_bc=True,
+                 backend='numpy'):
+        _check_backend(backend)
+        Constraint.__init__(self, max(Cx, Cy, Cz))
+        self.Cx = Cx
+        self.Cy = Cy
+        self.Cz = Cz
+        self.upper_bc = upper_bc
+        self.backend = backend
+
+    @property
+    def active(self):
+        return self.Cx > 0 or self.Cy > 0 or self.Cz > 0
+
+    def value_and_gradient(self, u, v, w, grad_out=None):
+        if(self.backend == 'numba'):
+            return kernels.calculate_smoothness_cost_and_gradient_numba(
+                u, v, w, Cx=self.Cx, Cy=self.Cy, Cz=self.Cz,
+                upper_bc=self.upper_bc, grad_out=grad_out)
+        return calculate_smoothness_cost_and_gradient(
+            u, v, w, Cx=self.Cx, Cy=self.Cy, Cz=self.Cz,
+            upper_bc=self.upper_bc, grad_out=grad_out)
+
+
+class BackgroundConstraint(_FusedConstraint):
+    """
+    Fit to a background wind profile, such as a sounding.
+
+    Parameters
+    ----------
+    weights: 3D float array
+        Weights of the background at each grid point
+    u_back: 1D float array
+        Background u wind on each vertical level
+    v_back: 1D float array
+        Background v wind on each vertical level
+    coeff: float
+        Weight of the constraint
+    """
+    name = 'Jbg'
+    quadratic = True
+
+    def __init__(self, weights, u_back, v_back, coeff=0.01):
+        Constraint.__init__(self, coeff)
+        self.weights = weights
+        self.u_back = u_back
+        self.v_back = v_back
+
+    def value_and_gradient(self, u, v, w, grad_out=None):
+        return calculate_background_cost_and_gradient(
+            u, v, w, self.weights, self.u_back, self.v_back, Cb=self.coeff,
+            grad_out=grad_out)
+
+
+class VerticalVorticityConstraint(_FusedConstraint):
+    """
+    Vertical vorticity equation.
+
+    Parameters
+    ----------
+    Ut: float
+        U component of storm motion
+    Vt: float
+        V component of storm motion
+    coeff: float
+        Weight of the constraint
+    backend: str
+        'numpy' or 'numba'
+    """
+    name = 'Jvort'
+
+    def __init__(self, Ut, Vt, coeff=1e-5, backend='numpy'):
+        _check_backend(backend)
+        Constraint.__init__(self, coeff)
+        self.Ut = Ut
+        self.Vt = Vt
+        self.backend = backend
+
+    def setup(self, grid_shape, dx, dy, dz, z, workspace):
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        if(self.backend == 'numba'):
+            self.work = (workspace.work('zeta'), workspace.work('dudx'))
+        self.derivatives = workspace.derivatives
+
+    def value_and_gradient(self, u, v, w, grad_out=None):
+        if(self.backend == 'numba'):
+            return \
+                kernels.calculate_vertical_vorticity_cost_and_gradient_numba(
+                    u, v, w, self.dx, self.dy, self.dz, self.Ut, self.Vt,
+                    coeff=self.coeff, grad_out=grad_out, work=self.work)
+        return calculate_vertical_vorticity_cost_and_gradient(
+            u, v, w, self.dx, self.dy, self.dz, self.Ut, self.Vt,
+            coeff=self.coeff, grad_out=grad_out,
+            derivatives=self.derivatives.bind((u, v, w)))
+
+
+class ConstraintRegistry(object):
+    """
+    The constraints that make up the cost function of a retrieval.
+
+    Calling the registry with the flattened wind field returns the total
+    cost and its gradient, so it can be passed directly as the cost
+    function to scipy's L-BFGS-B with fprime=None. Constraints that are not
+    active are skipped.
+
+    Parameters
+    ----------
+    constraints: list of Constraint
+        The initial constraints.
+
+    Examples
+    --------
+    >>> registry = ConstraintRegistry([MassContinuityConstraint(1500.0)])
+    >>> registry.add(MyConstraint(coeff=0.1))
+    >>> registry.setup(grid_shape, dx, dy, dz, z)
+    >>> J, grad = registry(winds)
+    """
+    def __init__(self, constraints=None):
+        self.constraints = []
+        self.workspace = None
+        if constraints is not None:
+            for constraint in constraints:
+                self.add(constraint)
+
+    def add(self, constraint):
+        """
+        Adds a constraint. Its name must be unique within the registry.
+        """
+        if not isinstance(constraint, Constraint):
+            raise TypeError('constraint must be a Constraint')
+        if constraint.name in self.names:
+            raise ValueError('A constraint named ' + constraint.name +
+                             ' is already registered')
+        self.constraints.append(constraint)
+        self.workspace = None
+
+    @property
+    def names(self):
+        """
+        Names of the registered constraints.
+        """
+        return [constraint.name for constraint in self.constraints]
+
+    @property
+    def active(self):
+        """
+        The constraints that contribute to the cost function.
+        """
+        return [constraint for constraint in self.constraints
+                if constraint.active]
+
+    @property
+    def quadratic(self):
+        """
+        True if every active constraint is quadratic.
+        """
+        return all(constraint.quadratic for constraint in self.active)
+
+    def __getitem__(self, name):
+        for constraint in self.constraints:
+            if constraint.name == name:
+                return constraint
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.constraints)
+
+    def __len__(self):
+        return len(self.constraints)
+
+    def setup(self, grid_shape, dx, dy, dz, z, dtype=np.float64):
+        """
+        Allocates the workspace of the retrieval and sets up every
+        registered constraint. This must be called before evaluating the
+        cost function.
+
+        Parameters
+        ----------
+        grid_shape: tuple
+            Shape (nz, ny, nx) of the analysis grid
+        dx: float
+            Spacing of grid in x direction
+        dy: float
+            Spacing of grid in y direction
+        dz: float
+            Spacing of grid in z direction
+        z: 3D float array
+            Height of each grid point
+        dtype: numpy dtype
+            Floating point type the wind field is evaluated in
+        """
+        self.grid_shape = tuple(grid_shape)
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.workspace = Workspace(self.grid_shape, dtype=dtype)
+        for constraint in self.constraints:
+            constraint.setup(self.grid_shape, dx, dy, dz, z, self.workspace)
+
+    def evaluate(self, winds, print_out=False):
+        """
+        Evaluates every active constraint.
+
+        Parameters
+        ----------
+        winds: 1-D float array
+            The wind field, flattened to 1-D for the optimizer
+        print_out: bool
+            Set to True to print out the value of each constraint and the
+            norm of the gradient.
+
+        Returns
+        -------
+        J: float
+            The total cost
+        grad: 1-D float array
+            The gradient of the total cost. It is a view into the
+            workspace and is overwritten by the next evaluation.
+        values: dict
+            The value of each active constraint, by name
+        """
+        if self.workspace is None:
+            raise RuntimeError('setup must be called before evaluate')
+        winds = np.reshape(np.asarray(winds, dtype=self.workspace.dtype),
+                           (3,) + self.grid_shape)
+        grad = self.workspace.reset()
+        self.workspace.derivatives.clear()
+        values = {}
+        # Pass the same component arrays to every constraint, so that they
+        # share the derivatives cached for them
+        u, v, w = winds
+        for constraint in self.active:
+            with measure('cost_and_gradient', constraint.name):
+                values[constraint.name], _ = constraint.value_and_gradient(
+                    u, v, w, grad_out=grad)
+        grad = grad.reshape(-1)
+
+        if(print_out == True):
+            self.print_values(values, np.abs(winds[2]).max(),
+                              np.linalg.norm(grad, np.inf))
+        return sum(values.values()), grad, values
+
+    def hessian_product(self, p):
+        """
+        Returns the product of the Hessian of the cost function with the
+        flattened wind field p. Every active constraint must be quadratic.
+
+        Parameters
+        ----------
+        p: 1-D float array
+            The wind field to multiply, flattened to 1-D
+
+        Returns
+        -------
+        product: 1-D float array
+            The product, in float64.
+        """
+        if self.workspace is None:
+            raise RuntimeError('setup must be called before hessian_product')
+        if not self.quadratic:
+            raise ValueError('Every active constraint must be quadratic')
+        p = np.reshape(np.asarray(p, dtype=self.workspace.dtype),
+                       (3,) + self.grid_shape)
+        product = np.zeros((3,) + self.grid_shape)
+        for constraint in self.active:
+            with measure('hessian_product', constraint.name):
+                constraint.hessian_product(p[0], p[1], p[2],
+                                           grad_out=product)
+        return product.reshape(-1)
+
+    @staticmethod
+    def print_values(values, max_w, grad_norm):
+        """
+        Prints the value of each constraint, the maximum absolute vertical
+        velocity and the norm of the gradient, as returned by evaluate.
+        """
+        names = list(values.keys())
+        print('|' + '|'.join(["{:^9s}".format(name) for name in names]) +
+              '| Max w  ')
+        print('|' + '|'.join(["{:9.4f}".format(values[name])
+                              for name in names]) +
+              '|' + "{:9.4f}".format(max_w))
+        print('Norm of gradient: ' + str(grad_norm))
+
+    def __call__(self, winds, print_out=False):
+        """
+        Returns the total cost and its gradient for the flattened wind
+        field.
+        """
+        J, grad, _ = self.evaluate(winds, print_out=print_out)
+        return J, grad
+
+
+def make_constraints(observations, rmsVr, u_back, v_back, bg_weights, Co,
+                     Cm, Cx, Cy, Cz, Cb, Cv, Ut, Vt, upper_bc=True,
+                     backend='numpy', constraints=None):
+    """
+    Builds the registry of constraints for a retrieval from the weight of
+    each term of the cost function. Terms with a weight of zero are not
+    registered.
+
+    Parameters
+    ----------
+    observations: list of RadarObservation
+        The observation operator for each radar
+    rmsVr: float
+        The sum of squares of velocity/num_points. Use for normalization
+        of data weighting coefficient
+    u_back: 1D float array
+        Background u wind
+    v_back: 1D float array
+        Background v wind
+    bg_weights: 3D float array
+        Weights of the background at each grid point
+    Co: float
+        Weight of the radial velocity constraint
+    Cm: float
+        Weight of the mass continuity constraint
+    Cx: float
+        Smoothing coefficient for x-direction
+    Cy: float
+        Smoothing coefficient for y-direction
+    Cz: float
+        Smoothing coefficient for z-direction
+    Cb: float
+        Coefficient for sounding constraint
+    Cv: float
+        Weight for cost function related to vertical vorticity equation.
+    Ut: float
+        Prescribed storm motion. This is only needed if Cv is not zero.
+    Vt: float
+        Prescribed storm motion. This is only needed if Cv is not zero.
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    backend: str
+        'numpy' or 'numba'
+    constraints: list of Constraint
+        Additional constraints to register.
+
+    Returns
+    -------
+    registry: ConstraintRegistry
+        The constraints of the retrieval. Call its setup method before
+        evaluating it.
+    """
+    _check_backend(backend)
+    registry = ConstraintRegistry()
+    if(Co > 0):
+        registry.add(RadialVelocityConstraint(
+            observations, rmsVr, coeff=Co, upper_bc=upper_bc,
+            backend=backend))
+    if(Cm > 0):
+        registry.add(MassContinuityConstraint(
+            coeff=Cm, upper_bc=upper_bc, backend=backend))
+    if(Cx > 0 or Cy > 0 or Cz > 0):
+        registry.add(SmoothnessConstraint(
+            Cx=Cx, Cy=Cy, Cz=Cz, upper_bc=upper_bc, backend=backend))
+    if(Cb > 0):
+        registry.add(BackgroundConstraint(bg_weights, u_back, v_back,
+                                          coeff=Cb))
+    if(Cv > 0):
+        registry.add(VerticalVorticityConstraint(Ut, Vt, coeff=Cv,
+                                                 backend=backend))
+    if constraints is not None:
+        for constraint in constraints:
+            registry.add(constraint)
+    return registry
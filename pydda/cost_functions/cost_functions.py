@@ -6,12 +6,36 @@ Created on Wed Jul 19 11:31:02 2017
 
 import numpy as np
 import pyart
+import weakref
+
+from concurrent.futures import ThreadPoolExecutor
 
 from numba import jit, cuda
 from numba import vectorize
 import scipy.ndimage.filters
 
- 
+from . import kernels
+from .workspace import Workspace, DerivativeCache
+from .instrumentation import measure
+
+
+def _add_gradient(grad_out, grad_u, grad_v, grad_w):
+    """
+    Adds the gradient with respect to u, v and w to grad_out in place, or
+    stacks them into a new array if grad_out is None. A component that is
+    None is treated as zero. Returns the gradient flattened to 1D.
+    """
+    if grad_out is None:
+        zeros = np.zeros(grad_u.shape, dtype=grad_u.dtype)
+        return np.stack([grad_u, grad_v if grad_v is not None else zeros,
+                         grad_w if grad_w is not None else zeros],
+                        axis=0).reshape(-1)
+    for i, component in enumerate([grad_u, grad_v, grad_w]):
+        if component is not None:
+            grad_out[i] += component
+    return grad_out.reshape(-1)
+
+
 def J_function(winds, vrs, azs, els, wts, u_back, v_back,
                Co, Cm, Cx, Cy, Cz, Cb, Cv, Ut, Vt, grid_shape,
                dx, dy, dz, z, rmsVr, weights, bg_weights, upper_bc,
@@ -84,33 +108,36 @@ def J_function(winds, vrs, azs, els, wts, u_back, v_back,
     winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
                                   grid_shape[2]))
       
-    Jvel = calculate_radial_vel_cost_function(vrs, azs, els, winds[0],
-                                              winds[1], winds[2], wts,
-                                              rmsVr=rmsVr, weights=weights,
-                                              coeff=Co)
+    with measure('cost', 'Jvel'):
+        Jvel = calculate_radial_vel_cost_function(
+            vrs, azs, els, winds[0], winds[1], winds[2], wts, rmsVr=rmsVr,
+            weights=weights, coeff=Co)
     if(Cm > 0):
-        Jmass = calculate_mass_continuity(
-            winds[0], winds[1], winds[2], z, dx, dy, dz, coeff=Cm)
+        with measure('cost', 'Jmass'):
+            Jmass = calculate_mass_continuity(
+                winds[0], winds[1], winds[2], z, dx, dy, dz, coeff=Cm)
     else:
         Jmass = 0
           
     if(Cx > 0 or Cy > 0 or Cz > 0):
-        Jsmooth = calculate_smoothness_cost(
-            winds[0], winds[1], winds[2], Cx=Cx, Cy=Cy, Cz=Cz)
+        with measure('cost', 'Jsmooth'):
+            Jsmooth = calculate_smoothness_cost(
+                winds[0], winds[1], winds[2], Cx=Cx, Cy=Cy, Cz=Cz)
     else:
         Jsmooth = 0
         
     if(Cb > 0):
-        Jbackground = calculate_background_cost(
-            winds[0], winds[1], winds[2], bg_weights, u_back, v_back, Cb)
+        with measure('cost', 'Jbg'):
+            Jbackground = calculate_background_cost(
+                winds[0], winds[1], winds[2], bg_weights, u_back, v_back,
+                Cb)
     else:
         Jbackground = 0
         
     if(Cv > 0):
-        Jvorticity =  calculate_vertical_vorticity_cost(winds[0], winds[1],
-                                                        winds[2], dx, dy, 
-                                                        dz, Ut, Vt, 
-                                                        coeff=Cv)
+        with measure('cost', 'Jvort'):
+            Jvorticity = calculate_vertical_vorticity_cost(
+                winds[0], winds[1], winds[2], dx, dy, dz, Ut, Vt, coeff=Cv)
     else:
         Jvorticity = 0
         
@@ -129,7 +156,7 @@ def J_function(winds, vrs, azs, els, wts, u_back, v_back,
     
 def grad_J(winds, vrs, azs, els, wts, u_back, v_back, Co, Cm, Cx, Cy, 
            Cz, Cb, Cv, Ut, Vt, grid_shape, dx, dy, dz, z, rmsVr, 
-           weights, bg_weights, upper_bc, print_out=False):
+           weights, bg_weights, upper_bc, print_out=False, workspace=None):
     """
     Calculates the gradient of the cost function.
     
@@ -187,6 +214,11 @@ def grad_J(winds, vrs, azs, els, wts, u_back, v_back, Co, Cm, Cx, Cy,
     upper_bc: bool
         True to enforce w=0 at top of domain (impermeability condition),
         False to not enforce impermeability at top of domain
+    workspace: Workspace
+        Preallocated buffers to evaluate the gradient in. None will
+        allocate a new gradient array. The gradient returned when a
+        workspace is given is a view into it and is overwritten by the next
+        evaluation.
         
     Returns
     -------
@@ -195,35 +227,218 @@ def grad_J(winds, vrs, azs, els, wts, u_back, v_back, Co, Cm, Cx, Cy,
     """ 
     winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
                                       grid_shape[2]))
-    grad = calculate_grad_radial_vel(
-        vrs, els, azs, winds[0], winds[1], winds[2], wts, weights,
-        rmsVr, coeff=Co, upper_bc=upper_bc)
+    if workspace is None:
+        workspace = Workspace(grid_shape, dtype=winds.dtype)
+    grad = workspace.reset()
+    with measure('gradient', 'Jvel'):
+        calculate_grad_radial_vel(
+            vrs, els, azs, winds[0], winds[1], winds[2], wts, weights,
+            rmsVr, coeff=Co, upper_bc=upper_bc, grad_out=grad)
     
     if(Cm > 0):
-        grad += calculate_mass_continuity_gradient(
-            winds[0], winds[1], winds[2], z, dx, dy, dz, coeff=Cm, 
-            upper_bc=upper_bc)
+        with measure('gradient', 'Jmass'):
+            calculate_mass_continuity_gradient(
+                winds[0], winds[1], winds[2], z, dx, dy, dz, coeff=Cm, 
+                upper_bc=upper_bc, grad_out=grad)
                                                                     
     if(Cx > 0 or Cy > 0 or Cz > 0):
-        grad += calculate_smoothness_gradient(
-            winds[0], winds[1], winds[2], Cx=Cx, Cy=Cy, Cz=Cz, 
-            upper_bc=upper_bc)
+        with measure('gradient', 'Jsmooth'):
+            calculate_smoothness_gradient(
+                winds[0], winds[1], winds[2], Cx=Cx, Cy=Cy, Cz=Cz, 
+                upper_bc=upper_bc, grad_out=grad)
         
     if(Cb > 0):
-        grad += calculate_background_gradient(
-            winds[0], winds[1], winds[2], bg_weights, u_back, v_back, Cb,
-            upper_bc=upper_bc)
+        with measure('gradient', 'Jbg'):
+            calculate_background_gradient(
+                winds[0], winds[1], winds[2], bg_weights, u_back, v_back,
+                Cb, grad_out=grad)
     if(Cv > 0):
-        grad += calculate_vertical_vorticity_gradient(winds[0], winds[1], 
-                                                      winds[2], dx, dy, 
-                                                      dz, Ut, Vt, 
-                                                      coeff=Cv)    
+        with measure('gradient', 'Jvort'):
+            calculate_vertical_vorticity_gradient(winds[0], winds[1], 
+                                                  winds[2], dx, dy, 
+                                                  dz, Ut, Vt, 
+                                                  coeff=Cv, grad_out=grad)
         
+    grad = grad.reshape(-1)
     if(print_out==True):    
         print('Norm of gradient: ' + str(np.linalg.norm(grad, np.inf)))
     return grad
 
 
+def J_and_grad(winds, observations, u_back, v_back, Co, Cm, Cx, Cy, Cz, Cb,
+               Cv, Ut, Vt, grid_shape, dx, dy, dz, z, rmsVr, bg_weights,
+               upper_bc, backend='numpy', precision='float64',
+               print_out=False, workspace=None):
+    """
+    Calculates the cost function and its gradient in a single pass.
+
+    Each constraint computes its value and gradient from the same
+    intermediate fields, so the radial velocity projections, divergence
+    and Laplacians are only evaluated once per iteration. This function
+    can be passed to the optimizer with fprime=None.
+
+    Parameters
+    ----------
+    winds: 1-D float array
+        The wind field, flattened to 1-D for f_min
+    observations: list of RadarObservation or MergedRadarObservations
+        The precomputed radial velocity observation operator for each radar,
+        with the data weights of each radar folded in. Merge them once with
+        merge_radar_observations when using backend='numba'.
+    u_back: 1D float array (number of vertical levels):
+        Background u wind
+    v_back: 1D float array (number of vertical levels):
+        Background u wind
+    Co: float
+        Weighting coefficient for data constraint.
+    Cm: float
+        Weighting coefficient for mass continuity constraint.
+    Cx: float
+        Smoothing coefficient for x-direction
+    Cy: float
+        Smoothing coefficient for y-direction
+    Cz: float
+        Smoothing coefficient for z-direction
+    Cb: float
+        Coefficient for sounding constraint
+    Cv: float
+        Weight for cost function related to vertical vorticity equation.
+    Ut: float
+        Prescribed storm motion. This is only needed if Cv is not zero.
+    Vt: float
+        Prescribed storm motion. This is only needed if Cv is not zero.
+    grid_shape:
+        Shape of wind grid
+    dx:
+        Spacing of grid in x direction
+    dy:
+        Spacing of grid in y direction
+    dz:
+        Spacing of grid in z direction
+    z:
+        Grid vertical levels in m
+    rmsVr: float
+        The sum of squares of velocity/num_points. Use for normalization
+        of data weighting coefficient
+    bg_weights: z_bins x x_bins x y_bins float array
+        Data weights for sounding constraint
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition),
+        False to not enforce impermeability at top of domain
+    backend: str
+        'numpy' to use the NumPy cost functions, 'numba' to use the compiled
+        stencil kernels in :py:mod:`pydda.cost_functions.kernels` where they
+        are available.
+    precision: str
+        'float64' or 'float32'. The floating point type the wind field and
+        the gradient are evaluated in. The observations, bg_weights and z
+        should be stored in the same type. The value of the cost function
+        is always accumulated in float64.
+    print_out: bool
+        Set to True to print out the value of the cost function and the
+        norm of its gradient.
+    workspace: Workspace
+        Preallocated buffers to evaluate the gradient in. None will
+        allocate new buffers. The gradient returned when a workspace is
+        given is a view into it and is overwritten by the next evaluation.
+        The workspace also keeps the anelastic profile of the numba mass
+        continuity kernel, so it is only computed on the first evaluation.
+
+    Returns
+    -------
+    J: float
+        The value of the cost function
+    grad: 1D float array
+        Gradient vector of cost function
+    """
+    if backend not in ('numpy', 'numba'):
+        raise ValueError("backend must be 'numpy' or 'numba'")
+    winds = np.reshape(np.asarray(winds, dtype=precision),
+                       (3, grid_shape[0], grid_shape[1], grid_shape[2]))
+    if workspace is None:
+        workspace = Workspace(grid_shape, dtype=precision)
+    grad = workspace.reset()
+    workspace.derivatives.clear()
+    derivatives = workspace.derivatives.bind(winds)
+
+    if(backend == 'numba'):
+        with measure('cost_and_gradient', 'Jvel'):
+            Jvel, _ = kernels.calculate_radial_vel_cost_and_gradient_numba(
+                observations, winds[0], winds[1], winds[2], rmsVr=rmsVr,
+                coeff=Co, upper_bc=upper_bc, grad_out=grad)
+    else:
+        with measure('cost_and_gradient', 'Jvel'):
+            Jvel, _ = calculate_radial_vel_cost_and_gradient(
+                observations, winds[0], winds[1], winds[2], rmsVr=rmsVr,
+                coeff=Co, upper_bc=upper_bc, grad_out=grad)
+
+    if(Cm > 0 and backend == 'numba'):
+        anel = workspace.anelastic_profile(z, dz)
+        with measure('cost_and_gradient', 'Jmass'):
+            Jmass, _ = \
+                kernels.calculate_mass_continuity_and_gradient_numba(
+                    winds[0], winds[1], winds[2], anel, dx, dy, dz,
+                    coeff=Cm, upper_bc=upper_bc, grad_out=grad,
+                    work=workspace.work('div'))
+    elif(Cm > 0):
+        with measure('cost_and_gradient', 'Jmass'):
+            Jmass, _ = calculate_mass_continuity_and_gradient(
+                winds[0], winds[1], winds[2], z, dx, dy, dz, coeff=Cm,
+                upper_bc=upper_bc, grad_out=grad, derivatives=derivatives)
+    else:
+        Jmass = 0
+
+    if((Cx > 0 or Cy > 0 or Cz > 0) and backend == 'numba'):
+        with measure('cost_and_gradient', 'Jsmooth'):
+            Jsmooth, _ = \
+                kernels.calculate_smoothness_cost_and_gradient_numba(
+                    winds[0], winds[1], winds[2], Cx=Cx, Cy=Cy, Cz=Cz,
+                    upper_bc=upper_bc, grad_out=grad)
+    elif(Cx > 0 or Cy > 0 or Cz > 0):
+        with measure('cost_and_gradient', 'Jsmooth'):
+            Jsmooth, _ = calculate_smoothness_cost_and_gradient(
+                winds[0], winds[1], winds[2], Cx=Cx, Cy=Cy, Cz=Cz,
+                upper_bc=upper_bc, grad_out=grad)
+    else:
+        Jsmooth = 0
+
+    if(Cb > 0):
+        with measure('cost_and_gradient', 'Jbg'):
+            Jbackground, _ = calculate_background_cost_and_gradient(
+                winds[0], winds[1], winds[2], bg_weights, u_back, v_back,
+                Cb, grad_out=grad)
+    else:
+        Jbackground = 0
+
+    if(Cv > 0 and backend == 'numba'):
+        with measure('cost_and_gradient', 'Jvort'):
+            Jvorticity, _ = \
+                kernels.calculate_vertical_vorticity_cost_and_gradient_numba(
+                    winds[0], winds[1], winds[2], dx, dy, dz, Ut, Vt,
+                    coeff=Cv, grad_out=grad,
+                    work=(workspace.work('zeta'), workspace.work('dudx')))
+    elif(Cv > 0):
+        with measure('cost_and_gradient', 'Jvort'):
+            Jvorticity, _ = calculate_vertical_vorticity_cost_and_gradient(
+                winds[0], winds[1], winds[2], dx, dy, dz, Ut, Vt, coeff=Cv,
+                grad_out=grad, derivatives=derivatives)
+    else:
+        Jvorticity = 0
+
+    grad = grad.reshape(-1)
+    if(print_out==True):
+        print('| Jvel    | Jmass   | Jsmooth |   Jbg   | Jvort   | Max w  ')
+        print(('|' + "{:9.4f}".format(Jvel) + '|' +
+               "{:9.4f}".format(Jmass) + '|' +
+               "{:9.4f}".format(Jsmooth) + '|' +
+               "{:9.4f}".format(Jbackground) + '|' +
+               "{:9.4f}".format(Jvorticity) + '|' +
+               "{:9.4f}".format(np.abs(winds[2]).max())))
+        print('Norm of gradient: ' + str(np.linalg.norm(grad, np.inf)))
+
+    return Jvel + Jmass + Jsmooth + Jbackground + Jvorticity, grad
+
+
 def calculate_radial_vel_cost_function(vrs, azs, els, u, v,
                                        w, wts, rmsVr, weights, coeff=1.0,
                                        ):
@@ -280,7 +495,8 @@ def calculate_radial_vel_cost_function(vrs, azs, els, u, v,
 
 
 def calculate_grad_radial_vel(vrs, els, azs, u, v, w,
-                              wts, weights, rmsVr, coeff=1.0, upper_bc=True):
+                              wts, weights, rmsVr, coeff=1.0, upper_bc=True,
+                              grad_out=None):
     """
     Calculates the gradient of the cost function due to difference of wind field from
     radar radial velocities. 
@@ -311,6 +527,9 @@ def calculate_grad_radial_vel(vrs, els, azs, u, v, w,
         Background velocity field name
     weights: n_radars x_bins x y_bins float array
         Data weights for each pair of radars
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
     
     Returns
     -------
@@ -362,8 +581,71 @@ def calculate_grad_radial_vel(vrs, els, azs, u, v, w,
     p_z1[0, :, :] = 0
     if(upper_bc == True):
         p_z1[-1, :, :] = 0
-    y = np.stack((p_x1, p_y1, p_z1), axis=0)
-    return y.flatten()
+    return _add_gradient(grad_out, p_x1, p_y1, p_z1)
+
+
+def calculate_radial_vel_cost_and_gradient(observations, u, v, w, rmsVr,
+                                           coeff=1.0, upper_bc=True,
+                                           grad_out=None):
+    """
+    Calculates the cost function due to difference of the wind field from
+    radar radial velocities and its gradient in one pass.
+
+    All grids must have the same grid specification.
+
+    Parameters
+    ----------
+    observations: list of RadarObservation
+        The precomputed observation operator for each radar. These are
+        made by :py:func:`pydda.cost_functions.make_radar_observations`.
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    rmsVr: float
+        The sum of squares of velocity/num_points. Use for normalization
+        of data weighting coefficient
+    coeff: float
+        Constant for cost function
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+
+    Returns
+    -------
+    J_o: float
+         Observational cost function
+    y: 1-D float array
+         Gradient vector of observational cost function
+    """
+    J_o = 0
+    if grad_out is None:
+        grad_out = np.zeros((3,) + u.shape, dtype=u.dtype)
+    lambda_o = coeff / (rmsVr * rmsVr)
+
+    # The impermeability condition applies to this term's contribution
+    # only, so keep whatever is already at the boundaries of grad_out.
+    w_bottom = grad_out[2, 0].copy()
+    w_top = grad_out[2, -1].copy()
+
+    for obs in observations:
+        residual = obs.project(u, v, w)
+        weighted = obs.weight*residual
+        J_o += lambda_o*np.sum(weighted*residual, dtype=np.float64)
+        weighted *= 2*lambda_o
+        obs.scatter(obs.x_coeff*weighted, grad_out[0])
+        obs.scatter(obs.y_coeff*weighted, grad_out[1])
+        obs.scatter(obs.z_coeff*weighted, grad_out[2])
+
+    # Impermeability condition
+    grad_out[2, 0] = w_bottom
+    if(upper_bc == True):
+        grad_out[2, -1] = w_top
+    return J_o, grad_out.reshape(-1)
 
 
 def calculate_smoothness_cost(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5):
@@ -404,7 +686,7 @@ def calculate_smoothness_cost(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5):
 
 
 def calculate_smoothness_gradient(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5,
-                                  upper_bc=True):
+                                  upper_bc=True, grad_out=None):
     """
     Calculates the gradient of the smoothness cost function 
     by taking the Laplacian of the Laplacian of the wind field.
@@ -425,6 +707,9 @@ def calculate_smoothness_gradient(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5,
         Constant controlling smoothness in y-direction
     Cz: float
         Constant controlling smoothness in z-direction
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
     
     Returns
     -------
@@ -448,10 +733,67 @@ def calculate_smoothness_gradient(u, v, w, Cx=1e-5, Cy=1e-5, Cz=1e-5,
     grad_w[0, :, :] = 0
     if(upper_bc == True):
         grad_w[-1, :, :] = 0
-    y = np.stack([grad_u*Cx*2, grad_v*Cy*2, grad_w*Cz*2], axis=0)
-    return y.flatten()
+    return _add_gradient(grad_out, grad_u*Cx*2, grad_v*Cy*2, grad_w*Cz*2)
+
 
 
+def calculate_smoothness_cost_and_gradient(u, v, w, Cx=1e-5, Cy=1e-5,
+                                           Cz=1e-5, upper_bc=True,
+                                           grad_out=None):
+    """
+    Calculates the smoothness cost function and its gradient in one pass,
+    reusing the Laplacian of the wind field for both.
+
+    All grids must have the same grid specification.
+
+    Parameters
+    ----------
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    Cx: float
+        Constant controlling smoothness in x-direction
+    Cy: float
+        Constant controlling smoothness in y-direction
+    Cz: float
+        Constant controlling smoothness in z-direction
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+
+    Returns
+    -------
+    Js: float
+        value of smoothness cost function
+    y: float array
+        value of gradient of smoothness cost function
+    """
+    du = np.zeros(w.shape, dtype=w.dtype)
+    dv = np.zeros(w.shape, dtype=w.dtype)
+    dw = np.zeros(w.shape, dtype=w.dtype)
+    grad_u = np.zeros(w.shape, dtype=w.dtype)
+    grad_v = np.zeros(w.shape, dtype=w.dtype)
+    grad_w = np.zeros(w.shape, dtype=w.dtype)
+    scipy.ndimage.filters.laplace(u, du, mode='wrap')
+    scipy.ndimage.filters.laplace(v, dv, mode='wrap')
+    scipy.ndimage.filters.laplace(w, dw, mode='wrap')
+    Js = np.sum(Cx*du**2 + Cy*dv**2 + Cz*dw**2, dtype=np.float64)
+    scipy.ndimage.filters.laplace(du, grad_u, mode='wrap')
+    scipy.ndimage.filters.laplace(dv, grad_v, mode='wrap')
+    scipy.ndimage.filters.laplace(dw, grad_w, mode='wrap')
+
+    # Impermeability condition
+    grad_w[0, :, :] = 0
+    if(upper_bc == True):
+        grad_w[-1, :, :] = 0
+    grad_u *= Cx*2
+    grad_v *= Cy*2
+    grad_w *= Cz*2
+    return Js, _add_gradient(grad_out, grad_u, grad_v, grad_w)
+
 
 def calculate_mass_continuity(u, v, w, z, dx, dy, dz, coeff=1500.0, anel=1):
     """
@@ -495,7 +837,7 @@ def calculate_mass_continuity(u, v, w, z, dx, dy, dz, coeff=1500.0, anel=1):
 
 def calculate_mass_continuity_gradient(u, v, w, z, dx,
                                        dy, dz, coeff=1500.0, anel=1,
-                                       upper_bc=True):
+                                       upper_bc=True, grad_out=None):
     """
     Calculates the gradient of mass continuity cost function. 
     
@@ -515,6 +857,9 @@ def calculate_mass_continuity_gradient(u, v, w, z, dx,
         Constant controlling contribution of mass continuity to cost function
     anel: int
         =1 use anelastic approximation, 0=don't
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
         
     Returns
     -------
@@ -542,15 +887,191 @@ def calculate_mass_continuity_gradient(u, v, w, z, dx,
     grad_w[0,:,:] = 0
     if(upper_bc == True):
         grad_w[-1,:,:] = 0
-    y = np.stack([grad_u, grad_v, grad_w], axis=0)
-    return y.flatten()
+    return _add_gradient(grad_out, grad_u, grad_v, grad_w)
+
+
+def calculate_mass_continuity_and_gradient(u, v, w, z, dx, dy, dz,
+                                           coeff=1500.0, anel=1,
+                                           upper_bc=True, grad_out=None,
+                                           derivatives=None):
+    """
+    Calculates the mass continuity cost function and its gradient in one
+    pass, reusing the divergence field for both.
+
+    All grids must have the same grid specification.
+
+    Parameters
+    ----------
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    z: Float array (1D)
+        1D Float array with heights of grid
+    coeff: float
+        Constant controlling contribution of mass continuity to cost function
+    anel: int
+        =1 use anelastic approximation, 0=don't
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+    derivatives: DerivativeCache
+        Cache bound to the wind field (u, v, w) to take the first
+        derivatives from, so they are shared with the other constraints.
+        None will compute them here.
+
+    Returns
+    -------
+    J: float
+        value of mass continuity cost function
+    y: float array
+        value of gradient of mass continuity cost function
+    """
+    if derivatives is None:
+        derivatives = DerivativeCache().bind((u, v, w))
+    dudx = derivatives.gradient('u', 2, dx)
+    dvdy = derivatives.gradient('v', 1, dy)
+    dwdz = derivatives.gradient('w', 0, dz)
+    if(anel == 1):
+        rho = np.exp(-z/10000.0)
+        drho_dz = np.gradient(rho, dz, axis=0)
+        anel_term = w/rho*drho_dz
+    else:
+        anel_term = 0
+
+    div2 = dudx + dvdy + dwdz + anel_term
+    J = coeff*np.sum(np.square(div2), dtype=np.float64)/2.0
+
+    grad_u = -np.gradient(div2, dx, axis=2)*coeff
+    grad_v = -np.gradient(div2, dy, axis=1)*coeff
+    grad_w = -np.gradient(div2, dz, axis=0)*coeff
+
+    # Impermeability condition
+    grad_w[0,:,:] = 0
+    if(upper_bc == True):
+        grad_w[-1,:,:] = 0
+    return J, _add_gradient(grad_out, grad_u, grad_v, grad_w)
+
+
+def _gradient_adjoint(field, spacing, axis):
+    """
+    Applies the transpose of np.gradient(., spacing, axis=axis) to field.
+    """
+    field = np.moveaxis(field, axis, 0)
+    out = np.zeros(field.shape)
+    out[0] -= field[0]/spacing
+    out[1] += field[0]/spacing
+    out[2:] += field[1:-1]/(2*spacing)
+    out[:-2] -= field[1:-1]/(2*spacing)
+    out[-1] += field[-1]/spacing
+    out[-2] -= field[-1]/spacing
+    return np.moveaxis(out, 0, axis)
 
 
-def calculate_fall_speed(grid, refl_field=None, frz=4500.0):
+def calculate_mass_continuity_hessian_product(u, v, w, z, dx, dy, dz,
+                                              coeff=1500.0, anel=1,
+                                              grad_out=None):
+    """
+    Calculates the product of the Hessian of the mass continuity cost
+    function with a wind field.
+
+    The cost function is (coeff/2)*|D(u, v, w)|^2, where D is the linear
+    divergence operator, so the product is coeff*D^T D (u, v, w). Unlike
+    calculate_mass_continuity_gradient, which approximates D^T with the
+    continuous adjoint of the divergence, this uses the exact transpose of
+    the finite differences, so the product is symmetric.
+
+    Parameters
+    ----------
+    u: Float array
+        u component of the wind field to multiply
+    v: Float array
+        v component of the wind field to multiply
+    w: Float array
+        w component of the wind field to multiply
+    z: Float array (1D)
+        1D Float array with heights of grid
+    dx: float
+        Grid spacing in x direction
+    dy: float
+        Grid spacing in y direction
+    dz: float
+        Grid spacing in z direction
+    coeff: float
+        Constant controlling contribution of mass continuity to cost function
+    anel: int
+        = 1 use anelastic approximation, 0=don't
+    grad_out: (3, nz, ny, nx) float array
+        If given, the product is added to this array in place instead of
+        being returned in a new array.
+
+    Returns
+    -------
+    y: 1-D float array
+        The product of the Hessian with (u, v, w)
+    """
+    div = (np.gradient(u, dx, axis=2) + np.gradient(v, dy, axis=1) +
+           np.gradient(w, dz, axis=0)).astype(np.float64)
+    if(anel == 1):
+        rho = np.exp(-z/10000.0)
+        anel_coeff = np.gradient(rho, dz, axis=0)/rho
+        div += anel_coeff*w
+    div *= coeff
+
+    product_w = _gradient_adjoint(div, dz, 0)
+    if(anel == 1):
+        product_w += anel_coeff*div
+    return _add_gradient(grad_out, _gradient_adjoint(div, dx, 2),
+                         _gradient_adjoint(div, dy, 1), product_w)
+
+
+# Coefficients of the fall speed relation A*10**(B*Z) for each regime. Rows
+# 0-2 are below the freezing level and rows 4-6 above it, for the
+# reflectivity classes given by _FALL_SPEED_BINS. Rows 3 and 7 give no fall
+# speed at the class boundaries that the original relation leaves out.
+_FALL_SPEED_A = np.array([-2.6, -2.5, -3.95, 0.0, -0.817, -2.5, -3.95, 0.0])
+_FALL_SPEED_B = np.array([0.0107, 0.013, 0.0148, 0.0,
+                          0.0063, 0.013, 0.0148, 0.0])
+_FALL_SPEED_BINS = (np.array([55.0, 60.0]), np.array([33.0, 49.0]))
+
+# Fall speeds already calculated, by grid and then by (refl_field, frz)
+_fall_speed_cache = weakref.WeakKeyDictionary()
+
+
+def _fall_speed_levels(refl, grid_z, frz, out):
+    """
+    Calculates the fall speed from reflectivity refl at heights grid_z into
+    out, all 3D arrays of the same shape, with one lookup of the
+    coefficients per point.
+    """
+    cold = grid_z >= frz
+    regime = np.empty(refl.shape, dtype=np.intp)
+    for first_row, in_regime in ((0, ~cold), (4, cold)):
+        bins = _FALL_SPEED_BINS[first_row // 4]
+        refl_regime = refl[in_regime]
+        row = np.digitize(refl_regime, bins) + first_row
+        row[refl_regime == bins[-1]] = first_row + 3
+        regime[in_regime] = row
+    rho = np.exp(-grid_z/10000.0)
+    np.multiply(_FALL_SPEED_A[regime],
+                np.power(10, refl*_FALL_SPEED_B[regime]), out=out)
+    out *= np.power(1.2/rho, 0.4)
+    return out
+
+
+def calculate_fall_speed(grid, refl_field=None, frz=4500.0, n_threads=1,
+                         use_cache=True):
     """
     Estimates fall speed based on reflectivity.
 
     Uses methodology of Mike Biggerstaff and Dan Betten
+
+    Each grid point is classified into one of the reflectivity and height
+    regimes of the relation with np.digitize, and the coefficients of its
+    regime are looked up from a table, so the fall speed is evaluated in a
+    single pass over the grid.
     
     Parameters
     ----------
@@ -561,6 +1082,14 @@ def calculate_fall_speed(grid, refl_field=None, frz=4500.0):
         determine the name.
     frz: float
         Height of freezing level in m
+    n_threads: int
+        Number of threads to split the vertical levels of the grid over.
+    use_cache: bool
+        If True, the fall speed is stored with the grid and returned again
+        by later calls with the same grid, reflectivity field and freezing
+        level, as long as the reflectivity field has not been replaced.
+        The returned array is then shared between calls and must not be
+        modified.
         
     Returns
     -------
@@ -573,30 +1102,30 @@ def calculate_fall_speed(grid, refl_field=None, frz=4500.0):
         refl_field = pyart.config.get_field_name('reflectivity')
         
     refl = grid.fields[refl_field]['data']
-    grid_z = grid.point_z['data']
-    term_vel = np.zeros(refl.shape)    
-    A = np.zeros(refl.shape)
-    B = np.zeros(refl.shape)
-    rho = np.exp(-grid_z/10000.0)
-    A[np.logical_and(grid_z < frz, refl < 55)] = -2.6
-    B[np.logical_and(grid_z < frz, refl < 55)] = 0.0107
-    A[np.logical_and(grid_z < frz, 
-                     np.logical_and(refl >= 55, refl < 60))] = -2.5
-    B[np.logical_and(grid_z < frz, 
-                     np.logical_and(refl >= 55, refl < 60))] = 0.013
-    A[np.logical_and(grid_z < frz, refl > 60)] = -3.95
-    B[np.logical_and(grid_z < frz, refl > 60)] = 0.0148
-    A[np.logical_and(grid_z >= frz, refl < 33)] = -0.817
-    B[np.logical_and(grid_z >= frz, refl < 33)] = 0.0063
-    A[np.logical_and(grid_z >= frz,
-                     np.logical_and(refl >= 33, refl < 49))] = -2.5
-    B[np.logical_and(grid_z >= frz,
-                     np.logical_and(refl >= 33, refl < 49))] = 0.013
-    A[np.logical_and(grid_z >= frz, refl > 49)] = -3.95
-    B[np.logical_and(grid_z >= frz, refl > 49)] = 0.0148
-
-    fallspeed = A*np.power(10, refl*B)*np.power(1.2/rho, 0.4)
-    del A, B, rho
+    if(use_cache == True):
+        cached = _fall_speed_cache.get(grid, {}).get((refl_field, frz))
+        if cached is not None and cached[0] is refl:
+            return cached[1]
+
+    grid_z = np.broadcast_to(grid.point_z['data'], refl.shape)
+    refl_data = np.ma.getdata(refl)
+    fallspeed = np.empty(refl.shape)
+    if(n_threads > 1):
+        levels = [slice(k[0], k[-1] + 1) for k in
+                  np.array_split(np.arange(refl.shape[0]), n_threads)
+                  if len(k) > 0]
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(
+                lambda k: _fall_speed_levels(refl_data[k], grid_z[k], frz,
+                                             fallspeed[k]),
+                levels))
+    else:
+        _fall_speed_levels(refl_data, grid_z, frz, fallspeed)
+    fallspeed = np.ma.masked_array(fallspeed, mask=np.ma.getmask(refl))
+
+    if(use_cache == True):
+        _fall_speed_cache.setdefault(grid, {})[(refl_field, frz)] = (
+            refl, fallspeed)
     return fallspeed
 
 
@@ -636,7 +1165,8 @@ def calculate_background_cost(u, v, w, weights, u_back, v_back, Cb=0.01):
 
 
 
-def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01):
+def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01,
+                                  grad_out=None):
     """
     Calculates the gradient of the background cost function.
     
@@ -656,6 +1186,9 @@ def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01):
         Meridional winds vs height from sounding    
     Cb: float
         Weight of background constraint to total cost function
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
         
     Returns
     -------
@@ -665,14 +1198,60 @@ def calculate_background_gradient(u, v, w, weights, u_back, v_back, Cb=0.01):
     the_shape = u.shape
     u_grad = np.zeros(the_shape)
     v_grad = np.zeros(the_shape)
-    w_grad = np.zeros(the_shape)
 
     for i in range(the_shape[0]):
         u_grad[i] = Cb*2*(u[i]-u_back[i])*(weights[i])
         v_grad[i] = Cb*2*(v[i]-v_back[i])*(weights[i])
 
-    y = np.stack([u_grad, v_grad, w_grad], axis=0)
-    return y.flatten()
+    return _add_gradient(grad_out, u_grad, v_grad, None)
+
+
+def calculate_background_cost_and_gradient(u, v, w, weights, u_back, v_back,
+                                           Cb=0.01, grad_out=None):
+    """
+    Calculates the background cost function and its gradient in one pass.
+
+    Parameters
+    ----------
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    weights: Float array
+        Weights for each point to consider into cost function
+    u_back: 1D float array
+        Zonal winds vs height from sounding
+    w_back: 1D float array
+        Meridional winds vs height from sounding
+    Cb: float
+        Weight of background constraint to total cost function
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+
+    Returns
+    -------
+    cost: float
+        value of background cost function
+    y: float array
+        value of gradient of background cost function
+    """
+    the_shape = u.shape
+    cost = 0
+    u_grad = np.zeros(the_shape, dtype=u.dtype)
+    v_grad = np.zeros(the_shape, dtype=u.dtype)
+
+    for i in range(the_shape[0]):
+        u_diff = (u[i]-u_back[i])*weights[i]
+        v_diff = (v[i]-v_back[i])*weights[i]
+        cost += Cb*np.sum((u[i]-u_back[i])*u_diff + (v[i]-v_back[i])*v_diff,
+                          dtype=np.float64)
+        u_grad[i] = Cb*2*u_diff
+        v_grad[i] = Cb*2*v_diff
+
+    return cost, _add_gradient(grad_out, u_grad, v_grad, None)
 
 
 def calculate_vertical_vorticity_cost(u, v, w, dx, dy, dz, Ut, Vt, 
@@ -726,7 +1305,7 @@ def calculate_vertical_vorticity_cost(u, v, w, dx, dy, dz, Ut, Vt,
     
 
 def calculate_vertical_vorticity_gradient(u, v, w, dx, dy, dz, Ut, Vt, 
-                                          coeff=1e-5):
+                                          coeff=1e-5, grad_out=None):
     """
     Calculates the gradient of the cost function due to deviance from vertical 
     vorticity equation.
@@ -751,6 +1330,10 @@ def calculate_vertical_vorticity_gradient(u, v, w, dx, dy, dz, Ut, Vt,
         V component of storm motion
     coeff: float
         Weighting coefficient        
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+
     Returns
     -------
     Jv: 1D float array
@@ -815,5 +1398,102 @@ def calculate_vertical_vorticity_gradient(u, v, w, dx, dy, dz, Ut, Vt,
     v_grad = v_grad*2*dzeta_dt*coeff
     w_grad = w_grad*2*dzeta_dt*coeff
     
-    y = np.stack([u_grad, v_grad, w_grad], axis=0)
-    return y.flatten()
+    return _add_gradient(grad_out, u_grad, v_grad, w_grad)
+
+
+def calculate_vertical_vorticity_cost_and_gradient(u, v, w, dx, dy, dz, Ut,
+                                                   Vt, coeff=1e-5,
+                                                   grad_out=None,
+                                                   derivatives=None):
+    """
+    Calculates the cost function due to deviance from vertical vorticity
+    equation and its gradient in one pass, sharing the first derivatives
+    and the residual of the vorticity equation between the two.
+
+    Parameters
+    ----------
+    u: 3D array
+        Float array with u component of wind field
+    v: 3D array
+        Float array with v component of wind field
+    w: 3D array
+        Float array with w component of wind field
+    dx: float array
+        Spacing in x grid
+    dy: float array
+        Spacing in y grid
+    dz: float array
+        Spacing in z grid
+    Ut: float
+        U component of storm motion
+    Vt: float
+        V component of storm motion
+    coeff: float
+        Weighting coefficient
+    grad_out: (3, nz, ny, nx) float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+    derivatives: DerivativeCache
+        Cache bound to the wind field (u, v, w) to take the first and
+        second derivatives from, so they are shared with the other constraints.
+        None will compute them here.
+
+    Returns
+    -------
+    Jv: float
+        Value of vertical vorticity cost function.
+    y: 1D float array
+        Value of the gradient of the vertical vorticity cost function.
+    """
+    if derivatives is None:
+        derivatives = DerivativeCache().bind((u, v, w))
+
+    # First derivatives
+    dvdz = derivatives.gradient('v', 0, dz)
+    dudz = derivatives.gradient('u', 0, dz)
+    dwdy = derivatives.gradient('w', 1, dy)
+    dudx = derivatives.gradient('u', 2, dx)
+    dvdy = derivatives.gradient('v', 2, dy)
+    dwdx = derivatives.gradient('w', 2, dx)
+    dvdx = derivatives.gradient('v', 2, dx)
+    dudy = derivatives.gradient('u', 1, dy)
+
+    zeta = dvdx - dudy
+    dzeta_dx = np.gradient(zeta, dx, axis=2)
+    dzeta_dy = np.gradient(zeta, dy, axis=1)
+    dzeta_dz = np.gradient(zeta, dz, axis=0)
+
+    dzeta_dt = ((u - Ut)*dzeta_dx + (v - Vt)*dzeta_dy + w*dzeta_dz +
+                (dvdz*dwdx - dudz*dwdy) + zeta*(dudx + dvdy))
+    Jv = np.sum(coeff*dzeta_dt**2, dtype=np.float64)
+
+    # Second deriviatives
+    dwdydz = derivatives.gradient(('w', 1, dy), 0, dz)
+    dwdxdz = derivatives.gradient(('w', 2, dx), 0, dz)
+    dudzdy = derivatives.gradient(('u', 0, dz), 1, dy)
+    dvdxdy = derivatives.gradient(('v', 2, dx), 1, dy)
+    dudx2 = derivatives.gradient(('u', 2, dx), 2, dx)
+    dudxdy = derivatives.gradient(('u', 2, dx), 1, dy)
+    dudxdz = derivatives.gradient(('u', 2, dx), 0, dz)
+    dudy2 = dudxdy
+
+    # Vorticity Advection
+    u_grad = dzeta_dx + (Ut - u)*dudxdy + (Vt - v)*dudxdy
+    v_grad = dzeta_dy + (Vt - v)*dvdxdy + (Ut - u)*dvdxdy
+    w_grad = dzeta_dz
+
+    # Tilting term
+    u_grad += dwdydz
+    v_grad += dwdxdz
+    w_grad += dudzdy - dudxdz
+
+    # Stretching term
+    u_grad += -dudxdy + dudy2 - dzeta_dx
+    u_grad += -dudx2 + dudxdy - dzeta_dy
+
+    # Multiply by 2*dzeta_dt according to chain rule
+    u_grad = u_grad*2*dzeta_dt*coeff
+    v_grad = v_grad*2*dzeta_dt*coeff
+    w_grad = w_grad*2*dzeta_dt*coeff
+
+    return Jv, _add_gradient(grad_out, u_grad, v_grad, w_grad)
@@ -0,0 +1,404 @@
+"""
+Gradient checks and micro-benchmarks for the terms of the cost function.
+
+Every term of the cost function is available from up to three backends:
+'reference' (the separate calculate_*_cost and calculate_*_gradient
+functions), 'numpy' (the fused calculate_*_cost_and_gradient functions) and
+'numba' (the compiled kernels). The harness builds a synthetic case of any
+size, checks each term's gradient against directional finite differences
+of its cost function, compares it to the reference backend and records the
+run time and peak memory of an evaluation. The results are returned as a
+list of dicts that can be written as CSV or JSON, so new backends can be
+validated and compared against the reference NumPy path. Each row is
+marked as passed or failed against FD_TOLERANCE and REFERENCE_TOLERANCE.
+
+The gradients of the mass continuity and vertical vorticity terms inherited
+from the original NumPy functions are not the exact gradients of their cost
+functions, so they fail the finite difference check with every backend.
+They are listed in KNOWN_INEXACT_GRADIENTS, and their rows only have to
+match the reference backend to pass.
+"""
+
+import csv
+import io
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import cost_functions as cf
+from . import kernels
+from .observations import make_radar_observations, merge_radar_observations
+
+
+TERMS = ('radial_vel', 'mass_continuity', 'smoothness', 'background',
+         'vertical_vorticity')
+BACKENDS = ('reference', 'numpy', 'numba')
+
+# The background constraint has no compiled kernel
+_NUMBA_TERMS = ('radial_vel', 'mass_continuity', 'smoothness',
+                'vertical_vorticity')
+
+# The mass continuity gradient leaves out the anelastic term and applies
+# np.gradient where its adjoint is needed, which differs at the edges of the
+# grid. The vertical vorticity gradient is only an approximation of the
+# derivative of its cost function.
+KNOWN_INEXACT_GRADIENTS = ('mass_continuity', 'vertical_vorticity')
+
+# Maximum relative error of the gradient from finite differences
+FD_TOLERANCE = 1e-5
+# Maximum relative differences of the cost and gradient from the reference
+# backend for each precision
+REFERENCE_TOLERANCE = {'float64': 1e-10, 'float32': 1e-5}
+
+COLUMNS = ('term', 'backend', 'nz', 'ny', 'nx', 'dtype', 'J', 'fd_error',
+           'J_diff', 'grad_diff', 'time_min', 'time_median',
+           'peak_memory_mb', 'known_inexact', 'passed')
+
+
+def make_synthetic_case(grid_shape=(20, 50, 50), n_radars=2, seed=0,
+                        dtype=np.float64):
+    """
+    Builds a synthetic retrieval problem with random radial velocities,
+    radar geometry, data weights and wind field.
+
+    Parameters
+    ----------
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the grid
+    n_radars: int
+        Number of radars
+    seed: int
+        Seed of the random number generator
+    dtype: numpy dtype
+        Floating point type of the wind field and observations
+
+    Returns
+    -------
+    case: dict
+        Everything needed to evaluate every term of the cost function.
+        case['winds'] is the (3, nz, ny, nx) wind field.
+    """
+    rng = np.random.RandomState(seed)
+    masked = lambda x, p: np.ma.masked_where(rng.rand(*grid_shape) < p, x)
+    vrs = [masked(10*rng.randn(*grid_shape), 0.3) for i in range(n_radars)]
+    azs = [masked(2*np.pi*rng.rand(*grid_shape), 0.0)
+           for i in range(n_radars)]
+    els = [masked(0.5*rng.rand(*grid_shape), 0.0) for i in range(n_radars)]
+    wts = [masked(-3*rng.rand(*grid_shape), 0.0) for i in range(n_radars)]
+    weights = (rng.rand(n_radars, *grid_shape) > 0.3).astype(dtype)
+    z = np.tile(500.0*np.arange(grid_shape[0])[:, np.newaxis, np.newaxis],
+                (1, grid_shape[1], grid_shape[2])).astype(dtype)
+    observations = make_radar_observations(vrs, azs, els, wts, weights,
+                                           dtype=dtype)
+    return {'grid_shape': tuple(grid_shape),
+            'dtype': np.dtype(dtype),
+            'vrs': vrs, 'azs': azs, 'els': els, 'wts': wts,
+            'weights': weights,
+            'observations': observations,
+            'merged': merge_radar_observations(
+                make_radar_observations(vrs, azs, els, wts, weights,
+                                        dtype=dtype)),
+            'bg_weights': (rng.rand(*grid_shape) > 0.5).astype(dtype),
+            'u_back': rng.randn(grid_shape[0]),
+            'v_back': rng.randn(grid_shape[0]),
+            'z': z, 'dx': 1000.0, 'dy': 1000.0, 'dz': 500.0,
+            'rmsVr': 10.0, 'Ut': 5.0, 'Vt': 3.0,
+            'Co': 1.0, 'Cm': 1500.0, 'Cx': 1e-2, 'Cy': 1e-2, 'Cz': 1e-2,
+            'Cb': 0.1, 'Cv': 1e-3, 'upper_bc': True,
+            'winds': (5*rng.randn(3, *grid_shape)).astype(dtype)}
+
+
+def term_function(term, backend, case):
+    """
+    Returns a function of the (3, nz, ny, nx) wind field that evaluates
+    one term of the cost function with the given backend.
+
+    Parameters
+    ----------
+    term: str
+        One of TERMS
+    backend: str
+        One of BACKENDS
+    case: dict
+        Case from :py:func:`make_synthetic_case`
+
+    Returns
+    -------
+    f: function
+        f(winds) returns the value of the term and its gradient, flattened
+        to 1D.
+    """
+    c = case
+    if backend not in BACKENDS:
+        raise ValueError('backend must be one of ' + str(BACKENDS))
+    if term not in TERMS:
+        raise ValueError('term must be one of ' + str(TERMS))
+    if backend == 'numba' and term not in _NUMBA_TERMS:
+        raise ValueError('No numba kernel for ' + term)
+
+    if term == 'radial_vel':
+        if backend == 'reference':
+            return lambda W: (
+                cf.calculate_radial_vel_cost_function(
+                    c['vrs'], c['azs'], c['els'], W[0], W[1], W[2], c['wts'],
+                    c['rmsVr'], c['weights'], coeff=c['Co']),
+                cf.calculate_grad_radial_vel(
+                    c['vrs'], c['els'], c['azs'], W[0], W[1], W[2],
+                    c['wts'], c['weights'], c['rmsVr'], coeff=c['Co'],
+                    upper_bc=c['upper_bc']))
+        if backend == 'numpy':
+            return lambda W: cf.calculate_radial_vel_cost_and_gradient(
+                c['observations'], W[0], W[1], W[2], c['rmsVr'],
+                coeff=c['Co'], upper_bc=c['upper_bc'])
+        return lambda W: kernels.calculate_radial_vel_cost_and_gradient_numba(
+            c['merged'], W[0], W[1], W[2], c['rmsVr'], coeff=c['Co'],
+            upper_bc=c['upper_bc'])
+
+    if term == 'mass_continuity':
+        args = (c['z'], c['dx'], c['dy'], c['dz'])
+        if backend == 'reference':
+            return lambda W: (
+                cf.calculate_mass_continuity(W[0], W[1], W[2], *args,
+                                             coeff=c['Cm']),
+                cf.calculate_mass_continuity_gradient(
+                    W[0], W[1], W[2], *args, coeff=c['Cm'],
+                    upper_bc=c['upper_bc']))
+        if backend == 'numpy':
+            return lambda W: cf.calculate_mass_continuity_and_gradient(
+                W[0], W[1], W[2], *args, coeff=c['Cm'],
+                upper_bc=c['upper_bc'])
+        anel = kernels.make_anelastic_profile(c['z'], c['dz'])
+        return lambda W: \
+            kernels.calculate_mass_continuity_and_gradient_numba(
+                W[0], W[1], W[2], anel, c['dx'], c['dy'], c['dz'],
+                coeff=c['Cm'], upper_bc=c['upper_bc'])
+
+    if term == 'smoothness':
+        kwargs = {'Cx': c['Cx'], 'Cy': c['Cy'], 'Cz': c['Cz']}
+        if backend == 'reference':
+            return lambda W: (
+                cf.calculate_smoothness_cost(W[0], W[1], W[2], **kwargs),
+                cf.calculate_smoothness_gradient(
+                    W[0], W[1], W[2], upper_bc=c['upper_bc'], **kwargs))
+        if backend == 'numpy':
+            return lambda W: cf.calculate_smoothness_cost_and_gradient(
+                W[0], W[1], W[2], upper_bc=c['upper_bc'], **kwargs)
+        return lambda W: kernels.calculate_smoothness_cost_and_gradient_numba(
+            W[0], W[1], W[2], upper_bc=c['upper_bc'], **kwargs)
+
+    if term == 'background':
+        args = (c['bg_weights'], c['u_back'], c['v_back'])
+        if backend == 'reference':
+            return lambda W: (
+                cf.calculate_background_cost(W[0], W[1], W[2], *args,
+                                             Cb=c['Cb']),
+                cf.calculate_background_gradient(W[0], W[1], W[2], *args,
+                                                 Cb=c['Cb']))
+        return lambda W: cf.calculate_background_cost_and_gradient(
+            W[0], W[1], W[2], *args, Cb=c['Cb'])
+
+    args = (c['dx'], c['dy'], c['dz'], c['Ut'], c['Vt'])
+    if backend == 'reference':
+        return lambda W: (
+            cf.calculate_vertical_vorticity_cost(W[0], W[1], W[2], *args,
+                                                 coeff=c['Cv']),
+            cf.calculate_vertical_vorticity_gradient(W[0], W[1], W[2], *args,
+                                                     coeff=c['Cv']))
+    if backend == 'numpy':
+        return lambda W: cf.calculate_vertical_vorticity_cost_and_gradient(
+            W[0], W[1], W[2], *args, coeff=c['Cv'])
+    return lambda W: \
+        kernels.calculate_vertical_vorticity_cost_and_gradient_numba(
+            W[0], W[1], W[2], *args, coeff=c['Cv'])
+
+
+def check_gradient(f, winds, n_directions=3, step=1e-3, upper_bc=True,
+                   seed=0):
+    """
+    Compares the gradient of f with central finite differences of its value
+    along random directions.
+
+    The directions leave w at the bottom level, and at the top level when
+    upper_bc is True, unchanged, since the gradient is set to zero there by
+    the impermeability condition.
+
+    Parameters
+    ----------
+    f: function
+        Function from :py:func:`term_function`
+    winds: (3, nz, ny, nx) float array
+        Wind field to check the gradient at
+    n_directions: int
+        Number of random directions
+    step: float
+        Finite difference step, relative to the norm of winds
+    upper_bc: bool
+        True if f enforces w=0 at the top of the domain
+    seed: int
+        Seed of the random directions
+
+    Returns
+    -------
+    error: float
+        Largest relative difference between the directional derivative from
+        the gradient and from finite differences.
+    """
+    rng = np.random.RandomState(seed)
+    winds = np.asarray(winds, dtype=np.float64)
+    grad = np.asarray(f(winds)[1], dtype=np.float64)
+    h = step*np.sqrt(np.mean(winds**2))
+    error = 0.0
+    for i in range(n_directions):
+        direction = rng.randn(*winds.shape)
+        direction[2, 0] = 0
+        if upper_bc:
+            direction[2, -1] = 0
+        direction /= np.linalg.norm(direction)
+        J_plus = f(winds + h*direction)[0]
+        J_minus = f(winds - h*direction)[0]
+        fd = (J_plus - J_minus)/(2*h)
+        analytic = np.dot(grad, direction.reshape(-1))
+        scale = max(abs(fd), abs(analytic), np.finfo(np.float64).tiny)
+        error = max(error, abs(fd - analytic)/scale)
+    return error
+
+
+def time_and_memory(f, winds, repeat=5):
+    """
+    Times f(winds) and measures the peak memory it allocates.
+
+    Parameters
+    ----------
+    f: function
+        Function from :py:func:`term_function`
+    winds: (3, nz, ny, nx) float array
+        Wind field to evaluate f at
+    repeat: int
+        Number of timed evaluations
+
+    Returns
+    -------
+    time_min: float
+        Fastest evaluation in seconds
+    time_median: float
+        Median evaluation time in seconds
+    peak_memory: int
+        Peak memory allocated by one evaluation in bytes
+    """
+    # Warm up, which also compiles the numba kernels
+    f(winds)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        f(winds)
+        times.append(time.perf_counter() - start)
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    f(winds)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    if not was_tracing:
+        tracemalloc.stop()
+    return min(times), float(np.median(times)), peak
+
+
+def run_harness(grid_shape=(20, 50, 50), terms=TERMS, backends=BACKENDS,
+                dtype=np.float64, repeat=5, n_directions=3, seed=0,
+                fd_tolerance=FD_TOLERANCE, reference_tolerance=None):
+    """
+    Checks and times every term of the cost function with every backend.
+
+    Parameters
+    ----------
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the synthetic grid
+    terms: sequence of str
+        Terms to run, from TERMS
+    backends: sequence of str
+        Backends to run, from BACKENDS. Terms a backend does not implement
+        are skipped.
+    dtype: numpy dtype
+        Floating point type of the wind field and observations
+    repeat: int
+        Number of timed evaluations of each term
+    n_directions: int
+        Number of random directions for the finite difference check
+    seed: int
+        Seed of the synthetic case
+    fd_tolerance: float
+        Maximum fd_error of a row that passes
+    reference_tolerance: float or None
+        Maximum J_diff and grad_diff of a row that passes. None uses the
+        value in REFERENCE_TOLERANCE for dtype.
+
+    Returns
+    -------
+    rows: list of dict
+        One row for each term and backend with the keys in COLUMNS.
+        fd_error is the relative error of the gradient from
+        :py:func:`check_gradient`. J_diff and grad_diff are the relative
+        differences of the cost and the gradient from the reference
+        backend. known_inexact is True for the terms in
+        KNOWN_INEXACT_GRADIENTS. passed is True if J_diff and grad_diff
+        are within reference_tolerance and, unless known_inexact is True,
+        fd_error is within fd_tolerance.
+    """
+    if reference_tolerance is None:
+        reference_tolerance = REFERENCE_TOLERANCE[np.dtype(dtype).name]
+    case = make_synthetic_case(grid_shape, seed=seed, dtype=dtype)
+    winds = case['winds']
+    rows = []
+    for term in terms:
+        J_ref, grad_ref = term_function(term, 'reference', case)(
+            winds.astype(np.float64))
+        grad_ref = np.asarray(grad_ref, dtype=np.float64)
+        for backend in backends:
+            if backend == 'numba' and term not in _NUMBA_TERMS:
+                continue
+            f = term_function(term, backend, case)
+            J, grad = f(winds)
+            grad = np.asarray(grad, dtype=np.float64)
+            time_min, time_median, peak = time_and_memory(f, winds,
+                                                          repeat=repeat)
+            fd_error = check_gradient(f, winds, n_directions=n_directions,
+                                      upper_bc=case['upper_bc'], seed=seed)
+            J_diff = abs(J - J_ref)/max(abs(J_ref),
+                                        np.finfo(np.float64).tiny)
+            grad_diff = (np.abs(grad - grad_ref).max() /
+                         max(np.abs(grad_ref).max(),
+                             np.finfo(np.float64).tiny))
+            known_inexact = term in KNOWN_INEXACT_GRADIENTS
+            rows.append({
+                'term': term, 'backend': backend,
+                'nz': grid_shape[0], 'ny': grid_shape[1],
+                'nx': grid_shape[2], 'dtype': np.dtype(dtype).name,
+                'J': float(J), 'fd_error': fd_error,
+                'J_diff': J_diff, 'grad_diff': grad_diff,
+                'time_min': time_min, 'time_median': time_median,
+                'peak_memory_mb': peak/2.0**20,
+                'known_inexact': known_inexact,
+                'passed': bool(J_diff <= reference_tolerance and
+                               grad_diff <= reference_tolerance and
+                               (known_inexact or
+                                fd_error <= fd_tolerance))})
+    return rows
+
+
+def format_rows(rows, fmt='csv'):
+    """
+    Formats the rows from :py:func:`run_harness` as 'csv' or 'json'.
+    """
+    if fmt == 'json':
+        return json.dumps(rows, indent=1)
+    if fmt != 'csv':
+        raise ValueError("fmt must be 'csv' or 'json'")
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=COLUMNS, lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+    return out.getvalue()
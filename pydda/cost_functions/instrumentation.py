@@ -0,0 +1,207 @@
+"""
+Optional instrumentation of retrievals.
+
+Instrumentation is off by default and then only costs a check for an
+active profile at each measured block. Inside an :py:func:`instrument`
+block, the wall time and number of calls of each constraint of the cost
+function and of each stage of the retrieval are accumulated into a
+:py:class:`Profile`, along with the peak memory allocated by each if
+requested.
+
+Examples
+--------
+>>> with pydda.cost_functions.instrument() as profile:
+...     result = pydda.retrieval.get_dd_wind_field(...)
+>>> print(profile)
+>>> report = profile.report()
+"""
+
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+_state = threading.local()
+
+
+class Profile(object):
+    """
+    Cumulative wall time, call counts and peak memory of measured blocks.
+
+    Blocks are identified by a category and a name. The categories used by
+    PyDDA are:
+
+    'stage'
+        Stages of get_dd_wind_field: setup, weights, solve, filter and
+        output.
+    'cost', 'gradient', 'cost_and_gradient'
+        Each constraint, by the name used in the printed cost table, in
+        J_function, grad_J and the fused J_and_grad or constraint registry.
+
+    Parameters
+    ----------
+    track_memory: bool
+        If True, also record the peak memory allocated by each block with
+        tracemalloc. This slows down the retrieval noticeably.
+    """
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.records = {}
+        self._stack = []
+        self._stage = None
+
+    def _push(self):
+        frame = [time.perf_counter(), 0, 0]
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][2] = max(self._stack[-1][2], peak)
+            tracemalloc.reset_peak()
+            frame[1] = current
+        self._stack.append(frame)
+
+    def _pop(self, category, name):
+        start, memory_start, child_peak = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        peak_bytes = 0
+        if self.track_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], child_peak)
+            peak_bytes = peak - memory_start
+            if self._stack:
+                self._stack[-1][2] = max(self._stack[-1][2], peak)
+        record = self.records.setdefault(
+            (category, name), {'calls': 0, 'time': 0.0, 'peak_bytes': 0})
+        record['calls'] += 1
+        record['time'] += elapsed
+        record['peak_bytes'] = max(record['peak_bytes'], peak_bytes)
+
+    def stage(self, name):
+        """
+        Ends the current stage, if any, and starts the stage name. None only
+        ends the current stage.
+        """
+        if self._stage is not None:
+            self._pop('stage', self._stage)
+            self._stage = None
+        if name is not None:
+            self._push()
+            self._stage = name
+
+    def report(self):
+        """
+        Returns the records as a nested dict of category, then name, then
+        'calls', 'time' in seconds and 'peak_bytes'.
+        """
+        report = {}
+        for (category, name), record in self.records.items():
+            report.setdefault(category, {})[name] = dict(record)
+        return report
+
+    def __str__(self):
+        lines = ['{:<18s}{:<12s}{:>8s}{:>12s}{:>14s}'.format(
+            'category', 'name', 'calls', 'time (s)', 'peak (MB)')]
+        for (category, name), record in self.records.items():
+            lines.append('{:<18s}{:<12s}{:>8d}{:>12.4f}{:>14.2f}'.format(
+                category, name, record['calls'], record['time'],
+                record['peak_bytes']/2.0**20))
+        return '\n'.join(lines)
+
+
+class _Measure(object):
+    """
+    Context manager that records one block into a profile.
+    """
+    __slots__ = ('profile', 'category', 'name')
+
+    def __init__(self, profile, category, name):
+        self.profile = profile
+        self.category = category
+        self.name = name
+
+    def __enter__(self):
+        self.profile._push()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile._pop(self.category, self.name)
+        return False
+
+
+class _NullMeasure(object):
+    """
+    Context manager that does nothing, used when no profile is active.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_MEASURE = _NullMeasure()
+
+
+def active_profile():
+    """
+    Returns the profile of the innermost :py:func:`instrument` block of
+    this thread, or None.
+    """
+    return getattr(_state, 'profile', None)
+
+
+def measure(category, name):
+    """
+    Returns a context manager that records the block it wraps into the
+    active profile under (category, name). It does nothing when no profile
+    is active.
+    """
+    profile = getattr(_state, 'profile', None)
+    if profile is None:
+        return _NULL_MEASURE
+    return _Measure(profile, category, name)
+
+
+def stage(name):
+    """
+    Starts the retrieval stage name in the active profile, ending the
+    previous stage. None only ends the current stage. Does nothing when no
+    profile is active.
+    """
+    profile = getattr(_state, 'profile', None)
+    if profile is not None:
+        profile.stage(name)
+
+
+@contextmanager
+def instrument(track_memory=False):
+    """
+    Context manager that collects a :py:class:`Profile` of everything run
+    inside it on this thread.
+
+    Parameters
+    ----------
+    track_memory: bool
+        If True, also record the peak memory allocated by each block.
+
+    Yields
+    ------
+    profile: Profile
+        The profile, which can be read after the block ends.
+    """
+    profile = Profile(track_memory=track_memory)
+    previous = getattr(_state, 'profile', None)
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _state.profile = profile
+    try:
+        yield profile
+    finally:
+        profile.stage(None)
+        _state.profile = previous
+        if started_tracing:
+            tracemalloc.stop()
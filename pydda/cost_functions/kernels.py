@@ -0,0 +1,499 @@
+"""
+Numba compiled stencil kernels for the cost functions.
+
+These kernels compute the same finite differences as the NumPy cost
+functions (second order centered differences in the interior and first
+order one sided differences at the edges, like np.gradient), but fuse the
+derivatives, the residual and the gradient into a few parallel sweeps over
+the grid instead of building a full size temporary for every derivative.
+
+The kernels work on float32 or float64 fields. The arithmetic at each
+point and the sums for the cost function are always done in float64.
+"""
+
+import numpy as np
+
+from numba import njit, prange
+
+from .observations import merge_radar_observations
+
+
+@njit(cache=True)
+def _stencil(i, n, h):
+    """
+    Returns the neighbour indices and the spacing that np.gradient uses
+    at index i of an axis with n points and spacing h.
+    """
+    if i == 0:
+        return 0, 1, h
+    elif i == n - 1:
+        return n - 2, n - 1, h
+    else:
+        return i - 1, i + 1, 2*h
+
+
+def make_anelastic_profile(z, dz):
+    """
+    Calculates the vertical profile of the anelastic term of the mass
+    continuity equation.
+
+    Parameters
+    ----------
+    z: 1D or 3D float array
+        Heights of the grid levels in m. Only the first column is used if
+        a 3D array of grid point heights is given.
+    dz: float
+        Spacing of grid in z direction
+
+    Returns
+    -------
+    anel: 1D float array
+        (1/rho)*(drho/dz) at each vertical level, with rho = exp(-z/10000).
+    """
+    z = np.asarray(z, dtype=np.float64)
+    if z.ndim == 3:
+        z = z[:, 0, 0]
+    rho = np.exp(-z/10000.0)
+    return np.gradient(rho, dz)/rho
+
+
+def _gradient_buffer(grad_out, u):
+    """
+    Returns the array the kernels add the gradient to: grad_out if given,
+    otherwise a new array of zeros.
+    """
+    if grad_out is None:
+        return np.zeros((3,) + u.shape, dtype=u.dtype)
+    return grad_out
+
+
+@njit(parallel=True, cache=True)
+def _mass_continuity_kernel(u, v, w, anel, dx, dy, dz, coeff, upper_bc,
+                            div, grad):
+    nz, ny, nx = u.shape
+    partial = np.zeros(nz)
+
+    # Divergence and anelastic term
+    for k in prange(nz):
+        klo, khi, hz = _stencil(k, nz, dz)
+        total = 0.0
+        for j in range(ny):
+            jlo, jhi, hy = _stencil(j, ny, dy)
+            for i in range(nx):
+                ilo, ihi, hx = _stencil(i, nx, dx)
+                d = ((u[k, j, ihi] - u[k, j, ilo])/hx +
+                     (v[k, jhi, i] - v[k, jlo, i])/hy +
+                     (w[khi, j, i] - w[klo, j, i])/hz +
+                     w[k, j, i]*anel[k])
+                div[k, j, i] = d
+                total += d*d
+        partial[k] = total
+
+    # Adjoint of the divergence
+    for k in prange(nz):
+        klo, khi, hz = _stencil(k, nz, dz)
+        zero_w = k == 0 or (upper_bc and k == nz - 1)
+        for j in range(ny):
+            jlo, jhi, hy = _stencil(j, ny, dy)
+            for i in range(nx):
+                ilo, ihi, hx = _stencil(i, nx, dx)
+                grad[0, k, j, i] += -coeff*(div[k, j, ihi] -
+                                            div[k, j, ilo])/hx
+                grad[1, k, j, i] += -coeff*(div[k, jhi, i] -
+                                            div[k, jlo, i])/hy
+                if not zero_w:
+                    grad[2, k, j, i] += -coeff*(div[khi, j, i] -
+                                                div[klo, j, i])/hz
+    return coeff*np.sum(partial)/2.0
+
+
+def calculate_mass_continuity_and_gradient_numba(u, v, w, anel, dx, dy, dz,
+                                                 coeff=1500.0, upper_bc=True,
+                                                 grad_out=None, work=None):
+    """
+    Calculates the mass continuity cost function and its gradient using
+    compiled stencil kernels. The results match
+    :py:func:`pydda.cost_functions.calculate_mass_continuity_and_gradient`.
+
+    Parameters
+    ----------
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    anel: 1D float array
+        Anelastic term for each vertical level from
+        :py:func:`make_anelastic_profile`. Use zeros to disable the
+        anelastic approximation.
+    dx: float
+        Spacing of grid in x direction
+    dy: float
+        Spacing of grid in y direction
+    dz: float
+        Spacing of grid in z direction
+    coeff: float
+        Constant controlling contribution of mass continuity to cost function
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    grad_out: (3, nz, ny, nx) C-contiguous float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+    work: float array
+        Working array with the shape of the grid to store the divergence
+        in. None will allocate one.
+
+    Returns
+    -------
+    J: float
+        value of mass continuity cost function
+    y: 1D float array
+        value of gradient of mass continuity cost function
+    """
+    div = work if work is not None else np.empty(u.shape, dtype=u.dtype)
+    grad = _gradient_buffer(grad_out, u)
+    J = _mass_continuity_kernel(
+        np.ascontiguousarray(u),
+        np.ascontiguousarray(v, dtype=u.dtype),
+        np.ascontiguousarray(w, dtype=u.dtype),
+        np.ascontiguousarray(anel, dtype=np.float64),
+        float(dx), float(dy), float(dz), float(coeff), bool(upper_bc),
+        div, grad)
+    return J, grad.reshape(-1)
+
+
+@njit(cache=True)
+def _ddx(f, k, j, i, h):
+    lo, hi, hx = _stencil(i, f.shape[2], h)
+    return (f[k, j, hi] - f[k, j, lo])/hx
+
+
+@njit(cache=True)
+def _ddy(f, k, j, i, h):
+    lo, hi, hy = _stencil(j, f.shape[1], h)
+    return (f[k, hi, i] - f[k, lo, i])/hy
+
+
+@njit(cache=True)
+def _ddz(f, k, j, i, h):
+    lo, hi, hz = _stencil(k, f.shape[0], h)
+    return (f[hi, j, i] - f[lo, j, i])/hz
+
+
+@njit(parallel=True, cache=True)
+def _vertical_vorticity_kernel(u, v, w, dx, dy, dz, Ut, Vt, coeff,
+                               zeta, dudx, grad):
+    nz, ny, nx = u.shape
+    partial = np.zeros(nz)
+
+    # The vorticity and du/dx are differenced again, so keep them
+    for k in prange(nz):
+        for j in range(ny):
+            for i in range(nx):
+                dudx[k, j, i] = _ddx(u, k, j, i, dx)
+                zeta[k, j, i] = _ddx(v, k, j, i, dx) - _ddy(u, k, j, i, dy)
+
+    for k in prange(nz):
+        klo, khi, hz = _stencil(k, nz, dz)
+        total = 0.0
+        for j in range(ny):
+            jlo, jhi, hy = _stencil(j, ny, dy)
+            for i in range(nx):
+                ilo, ihi, hx = _stencil(i, nx, dx)
+
+                # First derivatives. dvdy is differenced along x with the
+                # y spacing to match the NumPy reference.
+                dvdz = _ddz(v, k, j, i, dz)
+                dudz = _ddz(u, k, j, i, dz)
+                dwdy = _ddy(w, k, j, i, dy)
+                dvdy = _ddx(v, k, j, i, dy)
+                dwdx = _ddx(w, k, j, i, dx)
+                dzeta_dx = (zeta[k, j, ihi] - zeta[k, j, ilo])/hx
+                dzeta_dy = (zeta[k, jhi, i] - zeta[k, jlo, i])/hy
+                dzeta_dz = (zeta[khi, j, i] - zeta[klo, j, i])/hz
+
+                dzeta_dt = ((u[k, j, i] - Ut)*dzeta_dx +
+                            (v[k, j, i] - Vt)*dzeta_dy +
+                            w[k, j, i]*dzeta_dz +
+                            (dvdz*dwdx - dudz*dwdy) +
+                            zeta[k, j, i]*(dudx[k, j, i] + dvdy))
+                total += dzeta_dt*dzeta_dt
+
+                # Second derivatives
+                dwdydz = (_ddy(w, khi, j, i, dy) - _ddy(w, klo, j, i, dy))/hz
+                dwdxdz = (_ddx(w, khi, j, i, dx) - _ddx(w, klo, j, i, dx))/hz
+                dudzdy = (_ddz(u, k, jhi, i, dz) - _ddz(u, k, jlo, i, dz))/hy
+                dvdxdy = (_ddx(v, k, jhi, i, dx) - _ddx(v, k, jlo, i, dx))/hy
+                dudx2 = (dudx[k, j, ihi] - dudx[k, j, ilo])/hx
+                dudxdy = (dudx[k, jhi, i] - dudx[k, jlo, i])/hy
+                dudxdz = (dudx[khi, j, i] - dudx[klo, j, i])/hz
+
+                # Vorticity advection, tilting and stretching terms
+                u_grad = (dzeta_dx + (Ut - u[k, j, i])*dudxdy +
+                          (Vt - v[k, j, i])*dudxdy)
+                v_grad = (dzeta_dy + (Vt - v[k, j, i])*dvdxdy +
+                          (Ut - u[k, j, i])*dvdxdy)
+                w_grad = dzeta_dz
+                u_grad += dwdydz
+                v_grad += dwdxdz
+                w_grad += dudzdy - dudxdz
+                u_grad += -dudxdy + dudxdy - dzeta_dx
+                u_grad += -dudx2 + dudxdy - dzeta_dy
+
+                scale = 2*dzeta_dt*coeff
+                grad[0, k, j, i] += u_grad*scale
+                grad[1, k, j, i] += v_grad*scale
+                grad[2, k, j, i] += w_grad*scale
+        partial[k] = total
+    return coeff*np.sum(partial)
+
+
+def calculate_vertical_vorticity_cost_and_gradient_numba(u, v, w, dx, dy, dz,
+                                                         Ut, Vt, coeff=1e-5,
+                                                         grad_out=None,
+                                                         work=None):
+    """
+    Calculates the vertical vorticity cost function and its gradient with a
+    compiled kernel. The vorticity and du/dx are stored in two working
+    arrays, and everything else (the remaining derivatives, the residual of
+    the vorticity equation and the gradient) is evaluated point by point in
+    a single sweep over the grid. The results match the NumPy reference in
+    calculate_vertical_vorticity_cost_and_gradient.
+
+    Parameters
+    ----------
+    u: 3D array
+        Float array with u component of wind field
+    v: 3D array
+        Float array with v component of wind field
+    w: 3D array
+        Float array with w component of wind field
+    dx: float
+        Spacing in x grid
+    dy: float
+        Spacing in y grid
+    dz: float
+        Spacing in z grid
+    Ut: float
+        U component of storm motion
+    Vt: float
+        V component of storm motion
+    coeff: float
+        Weighting coefficient
+    grad_out: (3, nz, ny, nx) C-contiguous float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+    work: tuple of two float arrays
+        Working arrays with the shape of the grid to store the vorticity
+        and du/dx in. None will allocate them.
+
+    Returns
+    -------
+    Jv: float
+        Value of vertical vorticity cost function.
+    y: 1D float array
+        Value of the gradient of the vertical vorticity cost function.
+    """
+    if work is None:
+        work = (np.empty(u.shape, dtype=u.dtype),
+                np.empty(u.shape, dtype=u.dtype))
+    zeta, dudx = work
+    grad = _gradient_buffer(grad_out, u)
+    J = _vertical_vorticity_kernel(
+        np.ascontiguousarray(u),
+        np.ascontiguousarray(v, dtype=u.dtype),
+        np.ascontiguousarray(w, dtype=u.dtype),
+        float(dx), float(dy), float(dz), float(Ut), float(Vt), float(coeff),
+        zeta, dudx, grad)
+    return J, grad.reshape(-1)
+
+
+@njit(parallel=True, cache=True)
+def _radial_vel_kernel(u, v, w, index, x_coeff, y_coeff, z_coeff, vr,
+                       weight, offsets, lambda_o, grad_u, grad_v, grad_w):
+    n_radars = offsets.shape[0]
+    nz = offsets.shape[1] - 1
+    partial = np.zeros(nz)
+    for k in prange(nz):
+        total = 0.0
+        for r in range(n_radars):
+            for n in range(offsets[r, k], offsets[r, k + 1]):
+                p = index[n]
+                residual = (x_coeff[n]*u[p] + y_coeff[n]*v[p] +
+                            z_coeff[n]*w[p] - vr[n])
+                weighted = weight[n]*residual
+                total += weighted*residual
+                weighted *= 2*lambda_o
+                grad_u[p] += x_coeff[n]*weighted
+                grad_v[p] += y_coeff[n]*weighted
+                grad_w[p] += z_coeff[n]*weighted
+        partial[k] = total
+    return lambda_o*np.sum(partial)
+
+
+def calculate_radial_vel_cost_and_gradient_numba(observations, u, v, w,
+                                                 rmsVr, coeff=1.0,
+                                                 upper_bc=True,
+                                                 grad_out=None):
+    """
+    Calculates the radial velocity cost function and its gradient for every
+    radar in a single compiled pass. The work is split over the vertical
+    levels of the grid, and the residuals and gradient contributions of all
+    radars on each level are accumulated together, so the run time scales
+    with the number of cores rather than the number of radars. The results
+    match the NumPy version in calculate_radial_vel_cost_and_gradient.
+
+    Parameters
+    ----------
+    observations: MergedRadarObservations or list of RadarObservation
+        The observation operators of each radar. A list is merged on every
+        call, so merge it once with
+        :py:func:`pydda.cost_functions.merge_radar_observations` instead.
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    rmsVr: float
+        The sum of squares of velocity/num_points. Use for normalization
+        of data weighting coefficient
+    coeff: float
+        Constant for cost function
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    grad_out: (3, nz, ny, nx) C-contiguous float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+
+    Returns
+    -------
+    J_o: float
+         Observational cost function
+    y: 1-D float array
+         Gradient vector of observational cost function
+    """
+    obs = merge_radar_observations(observations)
+    grad = _gradient_buffer(grad_out, u)
+    lambda_o = coeff / (rmsVr * rmsVr)
+    w_bottom = grad[2, 0].copy()
+    w_top = grad[2, -1].copy()
+    J_o = _radial_vel_kernel(
+        np.ascontiguousarray(u).reshape(-1),
+        np.ascontiguousarray(v, dtype=u.dtype).reshape(-1),
+        np.ascontiguousarray(w, dtype=u.dtype).reshape(-1),
+        obs.index, obs.x_coeff, obs.y_coeff, obs.z_coeff, obs.vr, obs.weight,
+        obs.offsets, float(lambda_o), grad[0].reshape(-1),
+        grad[1].reshape(-1), grad[2].reshape(-1))
+
+    # Impermeability condition
+    grad[2, 0] = w_bottom
+    if(upper_bc == True):
+        grad[2, -1] = w_top
+    return J_o, grad.reshape(-1)
+
+
+@njit(cache=True)
+def _laplacian_and_biharmonic(f, k, j, i, kk, jj, ii):
+    """
+    Returns the 7 point Laplacian and 25 point biharmonic of f at (k, j, i)
+    with periodic boundaries. kk, jj and ii hold the indices at offsets
+    -2, -1, +1 and +2 along each axis.
+    """
+    km2, km1, kp1, kp2 = kk[0], kk[1], kk[2], kk[3]
+    jm2, jm1, jp1, jp2 = jj[0], jj[1], jj[2], jj[3]
+    im2, im1, ip1, ip2 = ii[0], ii[1], ii[2], ii[3]
+    center = f[k, j, i]
+    faces = (f[km1, j, i] + f[kp1, j, i] + f[k, jm1, i] + f[k, jp1, i] +
+             f[k, j, im1] + f[k, j, ip1])
+    laplacian = faces - 6*center
+    far = (f[km2, j, i] + f[kp2, j, i] + f[k, jm2, i] + f[k, jp2, i] +
+           f[k, j, im2] + f[k, j, ip2])
+    edges = (f[km1, jm1, i] + f[km1, jp1, i] + f[kp1, jm1, i] +
+             f[kp1, jp1, i] + f[km1, j, im1] + f[km1, j, ip1] +
+             f[kp1, j, im1] + f[kp1, j, ip1] + f[k, jm1, im1] +
+             f[k, jm1, ip1] + f[k, jp1, im1] + f[k, jp1, ip1])
+    biharmonic = 42*center - 12*faces + far + 2*edges
+    return laplacian, biharmonic
+
+
+@njit(parallel=True, cache=True)
+def _smoothness_kernel(u, v, w, Cx, Cy, Cz, upper_bc, grad):
+    nz, ny, nx = u.shape
+    partial = np.zeros(nz)
+    for k in prange(nz):
+        kk = np.array([(k - 2) % nz, (k - 1) % nz, (k + 1) % nz,
+                       (k + 2) % nz])
+        zero_w = k == 0 or (upper_bc and k == nz - 1)
+        jj = np.empty(4, dtype=np.int64)
+        ii = np.empty(4, dtype=np.int64)
+        total = 0.0
+        for j in range(ny):
+            jj[0] = (j - 2) % ny
+            jj[1] = (j - 1) % ny
+            jj[2] = (j + 1) % ny
+            jj[3] = (j + 2) % ny
+            for i in range(nx):
+                ii[0] = (i - 2) % nx
+                ii[1] = (i - 1) % nx
+                ii[2] = (i + 1) % nx
+                ii[3] = (i + 2) % nx
+                lap, bih = _laplacian_and_biharmonic(u, k, j, i, kk, jj, ii)
+                total += Cx*lap*lap
+                grad[0, k, j, i] += 2*Cx*bih
+                lap, bih = _laplacian_and_biharmonic(v, k, j, i, kk, jj, ii)
+                total += Cy*lap*lap
+                grad[1, k, j, i] += 2*Cy*bih
+                lap, bih = _laplacian_and_biharmonic(w, k, j, i, kk, jj, ii)
+                total += Cz*lap*lap
+                if not zero_w:
+                    grad[2, k, j, i] += 2*Cz*bih
+        partial[k] = total
+    return np.sum(partial)
+
+
+def calculate_smoothness_cost_and_gradient_numba(u, v, w, Cx=1e-5, Cy=1e-5,
+                                                 Cz=1e-5, upper_bc=True,
+                                                 grad_out=None):
+    """
+    Calculates the smoothness cost function and its gradient in a single
+    compiled sweep. The Laplacian of the Laplacian is applied directly as
+    a 25 point biharmonic stencil, so no intermediate arrays are allocated.
+    The boundaries are periodic, which matches the mode='wrap' Laplacian
+    used by calculate_smoothness_cost_and_gradient.
+
+    Parameters
+    ----------
+    u: Float array
+        Float array with u component of wind field
+    v: Float array
+        Float array with v component of wind field
+    w: Float array
+        Float array with w component of wind field
+    Cx: float
+        Constant controlling smoothness in x-direction
+    Cy: float
+        Constant controlling smoothness in y-direction
+    Cz: float
+        Constant controlling smoothness in z-direction
+    upper_bc: bool
+        True to enforce w=0 at top of domain (impermeability condition)
+    grad_out: (3, nz, ny, nx) C-contiguous float array
+        If given, the gradient is added to this array in place instead of
+        being returned in a new array.
+
+    Returns
+    -------
+    Js: float
+        value of smoothness cost function
+    y: float array
+        value of gradient of smoothness cost function
+    """
+    grad = _gradient_buffer(grad_out, u)
+    Js = _smoothness_kernel(
+        np.ascontiguousarray(u),
+        np.ascontiguousarray(v, dtype=u.dtype),
+        np.ascontiguousarray(w, dtype=u.dtype),
+        float(Cx), float(Cy), float(Cz), bool(upper_bc), grad)
+    return Js, grad.reshape(-1)
@@ -0,0 +1,212 @@
+"""
+Observation operators for the radial velocity data constraint.
+
+The projection of the wind field onto each radar beam only depends on the
+radar geometry, so these are computed once before the solver starts instead
+of on every evaluation of the cost function.
+"""
+
+import numpy as np
+
+
+class RadarObservation(object):
+    """
+    Precomputed radial velocity observation operator for a single radar.
+
+    Only the grid points where the radar contributes to the cost function
+    are stored. Every input mask and the beam crossing angle weights are
+    applied when the operator is built, and the remaining points are kept
+    as flat indices into the analysis grid together with 1D arrays of the
+    observed values at those points. Memory use and the cost of evaluating
+    the data term therefore scale with the number of observations rather
+    than with the size of the grid.
+
+    The modeled radial velocity at each observation is
+    x_coeff*u + y_coeff*v + z_coeff*w - z_coeff*|fall speed|. The fall speed
+    part does not depend on the wind field, so it is folded into the
+    observed radial velocity here.
+
+    Parameters
+    ----------
+    vr: 3D masked float array
+        Radial velocity from the radar
+    az: 3D masked float array
+        Azimuth of each grid point from the radar in radians
+    el: 3D masked float array
+        Elevation of each grid point from the radar in radians
+    wt: 3D masked float array
+        Fall speed estimated from the radar's reflectivity
+    weights: 3D float array
+        Data weights for this radar from the beam crossing angle criteria
+    dtype: numpy dtype
+        Floating point type to store the observations in.
+
+    Attributes
+    ----------
+    shape: tuple
+        Shape of the analysis grid
+    index: 1D int array
+        Flat indices of the observations in the analysis grid
+    x_coeff: 1D float array
+        Projection of u onto the radar beam
+    y_coeff: 1D float array
+        Projection of v onto the radar beam
+    z_coeff: 1D float array
+        Projection of w onto the radar beam
+    vr: 1D float array
+        Observed radial velocity plus the projected fall speed
+    weight: 1D float array
+        Data weight of each observation
+    """
+    def __init__(self, vr, az, el, wt, weights, dtype=np.float64):
+        mask = np.logical_or.reduce([np.ma.getmaskarray(vr),
+                                     np.ma.getmaskarray(az),
+                                     np.ma.getmaskarray(el),
+                                     np.ma.getmaskarray(wt)])
+        self.shape = mask.shape
+        self.index = np.flatnonzero(np.logical_and(~mask, weights != 0))
+        az = np.take(np.ma.getdata(az), self.index)
+        el = np.take(np.ma.getdata(el), self.index)
+        cos_el = np.cos(el)
+        self.x_coeff = cos_el*np.sin(az)
+        self.y_coeff = cos_el*np.cos(az)
+        self.z_coeff = np.sin(el)
+        fall_speed = np.abs(np.take(np.ma.getdata(wt), self.index))
+        self.vr = np.take(np.ma.getdata(vr), self.index).astype(np.float64)
+        self.vr += self.z_coeff*fall_speed
+        self.weight = np.take(weights, self.index)
+        for field in ['x_coeff', 'y_coeff', 'z_coeff', 'vr', 'weight']:
+            setattr(self, field, getattr(self, field).astype(dtype))
+
+    def gather(self, field):
+        """
+        Returns the values of a 3D field at the observation points.
+        """
+        return np.take(field, self.index)
+
+    def scatter(self, values, out):
+        """
+        Adds values at the observation points to a C-contiguous 3D array.
+        """
+        out.reshape(-1)[self.index] += values
+        return out
+
+    def project(self, u, v, w):
+        """
+        Returns the residual between the radial velocity projected from the
+        wind field and the observed radial velocity at each observation.
+        """
+        return (self.x_coeff*self.gather(u) + self.y_coeff*self.gather(v) +
+                self.z_coeff*self.gather(w) - self.vr)
+
+
+class MergedRadarObservations(object):
+    """
+    The observation operators of several radars stored in one set of
+    contiguous arrays, so that the data term of every radar can be
+    evaluated in a single compiled pass.
+
+    The observations are stored radar by radar. Since the observations of
+    each radar are sorted by their position in the grid, the ones on each
+    vertical level form a contiguous slice, given by offsets. A compiled
+    kernel can therefore work on each level independently, and no two
+    levels write to the same point of the gradient.
+
+    Iterating over this object gives the per-radar
+    :py:class:`RadarObservation` objects, whose arrays are views into the
+    merged arrays, so it can be used wherever a list of observation
+    operators is expected.
+
+    Parameters
+    ----------
+    observations: list of RadarObservation
+        The observation operator for each radar. Their arrays are replaced
+        by views into the merged arrays.
+
+    Attributes
+    ----------
+    shape: tuple
+        Shape of the analysis grid
+    index, x_coeff, y_coeff, z_coeff, vr, weight: 1D arrays
+        Concatenated arrays of every radar's observation operator
+    offsets: 2D int array
+        offsets[i, k] is the position in the merged arrays of the first
+        observation of radar i on vertical level k. offsets[i, -1] is the
+        end of radar i's observations.
+    """
+    _fields = ['index', 'x_coeff', 'y_coeff', 'z_coeff', 'vr', 'weight']
+
+    def __init__(self, observations):
+        self.observations = list(observations)
+        self.shape = self.observations[0].shape
+        nz = self.shape[0]
+        level_size = self.shape[1]*self.shape[2]
+        for field in self._fields:
+            setattr(self, field, np.concatenate(
+                [getattr(obs, field) for obs in self.observations]))
+
+        self.offsets = np.zeros((len(self.observations), nz + 1),
+                                dtype=np.int64)
+        start = 0
+        for i, obs in enumerate(self.observations):
+            self.offsets[i] = start + np.searchsorted(
+                obs.index, np.arange(nz + 1)*level_size)
+            end = start + len(obs.index)
+            for field in self._fields:
+                setattr(obs, field, getattr(self, field)[start:end])
+            start = end
+
+    def __iter__(self):
+        return iter(self.observations)
+
+    def __len__(self):
+        return len(self.observations)
+
+
+def make_radar_observations(vrs, azs, els, wts, weights, dtype=np.float64):
+    """
+    Builds the observation operator for each radar.
+
+    Parameters
+    ----------
+    vrs: List of float arrays
+        List of radial velocities from each radar
+    azs: List of float arrays
+        List of azimuths from each radar in radians
+    els: List of float arrays
+        List of elevations from each radar in radians
+    wts: List of float arrays
+        List of fall speeds from each radar
+    weights: n_radars x z_bins x y_bins x x_bins float array
+        Data weights for each radar
+    dtype: numpy dtype
+        Floating point type to store the observations in.
+
+    Returns
+    -------
+    observations: list of RadarObservation
+        The observation operator for each radar.
+    """
+    return [RadarObservation(vrs[i], azs[i], els[i], wts[i], weights[i],
+                             dtype=dtype)
+            for i in range(len(vrs))]
+
+
+def merge_radar_observations(observations):
+    """
+    Merges the observation operators of several radars into a
+    :py:class:`MergedRadarObservations` for the compiled data term kernel.
+
+    Parameters
+    ----------
+    observations: list of RadarObservation
+        The observation operator for each radar.
+
+    Returns
+    -------
+    merged: MergedRadarObservations
+        The merged observation operators.
+    """
+    if isinstance(observations, MergedRadarObservations):
+        return observations
+    return MergedRadarObservations(observations)
@@ -0,0 +1,38 @@
+"""
+Checks every term of the cost function with every backend against the
+reference NumPy functions and finite differences.
+"""
+
+import numpy as np
+import pytest
+
+from pydda.cost_functions import J_and_grad, Workspace, gradient_check
+from pydda.cost_functions import merge_radar_observations
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+def test_harness_passes(dtype):
+    rows = gradient_check.run_harness((6, 12, 14), dtype=dtype, repeat=1)
+    assert len(rows) == 14
+    failed = [(row['term'], row['backend']) for row in rows
+              if not row['passed']]
+    assert failed == []
+
+
+def test_anelastic_profile_computed_once():
+    grid_shape = (6, 12, 14)
+    case = gradient_check.make_synthetic_case(grid_shape)
+    workspace = Workspace(grid_shape)
+    args = (merge_radar_observations(case['observations']), case['u_back'],
+            case['v_back'], case['Co'], case['Cm'], 0.0, 0.0, 0.0, 0.0,
+            0.0, None, None, grid_shape, case['dx'], case['dy'],
+            case['dz'], case['z'], case['rmsVr'], case['bg_weights'], True,
+            'numba')
+    winds = case['winds'].reshape(-1)
+    J, _ = J_and_grad(winds, *args, workspace=workspace)
+    anel = workspace.anelastic_profile(case['z'], case['dz'])
+    J_again, _ = J_and_grad(winds, *args, workspace=workspace)
+    assert workspace.anelastic_profile(case['z'], case['dz']) is anel
+    assert J_again == J
+    J_new, _ = J_and_grad(winds, *args)
+    np.testing.assert_allclose(J_new, J, rtol=1e-12)
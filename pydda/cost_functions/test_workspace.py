@@ -0,0 +1,67 @@
+"""
+Checks that the derivative cache never returns derivatives of another wind
+field.
+"""
+
+import gc
+
+import numpy as np
+
+from pydda.cost_functions import DerivativeCache, gradient_check
+from pydda.cost_functions import make_constraints
+
+
+def test_rebinding_never_shares_derivatives():
+    rng = np.random.RandomState(0)
+    cache = DerivativeCache()
+    for i in range(20):
+        # The array of the previous iteration is freed, so this one often
+        # gets the same address
+        winds = rng.randn(3, 4, 5, 6)
+        dudx = cache.bind(winds).gradient('u', 2, 1.0)
+        np.testing.assert_array_equal(dudx, np.gradient(winds[0], 1.0,
+                                                        axis=2))
+        del winds, dudx
+        gc.collect()
+
+
+def test_rebinding_components():
+    rng = np.random.RandomState(1)
+    u, v, w = rng.randn(3, 4, 5, 6)
+    cache = DerivativeCache()
+    dudx = cache.bind((u, v, w)).gradient('u', 2, 1.0)
+    assert cache.bind((u, v, w)).gradient('u', 2, 1.0) is dudx
+    assert cache.hits == 1
+
+    # A different state with the same shapes and strides
+    u2 = u + 1.0
+    dudx2 = cache.bind((u2, v, w)).gradient('u', 2, 1.0)
+    assert dudx2 is not dudx
+    np.testing.assert_array_equal(dudx2, np.gradient(u2, 1.0, axis=2))
+
+
+def test_registry_shares_derivatives():
+    grid_shape = (5, 8, 9)
+    case = gradient_check.make_synthetic_case(grid_shape)
+    registry = make_constraints(
+        case['observations'], case['rmsVr'], case['u_back'],
+        case['v_back'], case['bg_weights'], case['Co'], case['Cm'], 0.0,
+        0.0, 0.0, 0.0, case['Cv'], case['Ut'], case['Vt'])
+    registry.setup(grid_shape, case['dx'], case['dy'], case['dz'],
+                   case['z'])
+    derivatives = registry.workspace.derivatives
+    winds = case['winds'].reshape(-1)
+    J, grad, _ = registry.evaluate(winds)
+    hits = derivatives.hits
+    assert hits > 0
+
+    # A new wind field gives the same cost as a fresh evaluation
+    winds2 = winds + 1.0
+    J2, _, _ = registry.evaluate(winds2)
+    assert derivatives.hits == 2*hits
+    fresh = make_constraints(
+        case['observations'], case['rmsVr'], case['u_back'],
+        case['v_back'], case['bg_weights'], case['Co'], case['Cm'], 0.0,
+        0.0, 0.0, 0.0, case['Cv'], case['Ut'], case['Vt'])
+    fresh.setup(grid_shape, case['dx'], case['dy'], case['dz'], case['z'])
+    assert J2 == fresh.evaluate(winds2)[0]
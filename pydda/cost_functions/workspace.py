@@ -0,0 +1,160 @@
+"""
+Preallocated buffers for evaluating the cost function and its gradient.
+"""
+
+import numpy as np
+
+from .kernels import make_anelastic_profile
+
+
+class Workspace(object):
+    """
+    Buffers that are allocated once per retrieval and reused by every
+    evaluation of the cost function and its gradient.
+
+    Every constraint adds its gradient in place into views of one
+    contiguous gradient buffer, so an evaluation does not need to allocate,
+    stack or flatten the gradient of each constraint.
+
+    Parameters
+    ----------
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the analysis grid
+    dtype: numpy dtype
+        Floating point type of the buffers
+
+    Attributes
+    ----------
+    grad: (3, nz, ny, nx) float array
+        The gradient buffer. grad[0], grad[1] and grad[2] hold the gradient
+        with respect to u, v and w.
+    derivatives: DerivativeCache
+        Derivatives of the wind field shared by the constraints during one
+        evaluation.
+    """
+    def __init__(self, grid_shape, dtype=np.float64):
+        self.grid_shape = tuple(grid_shape)
+        self.dtype = np.dtype(dtype)
+        self.grad = np.zeros((3,) + self.grid_shape, dtype=self.dtype)
+        self.derivatives = DerivativeCache()
+        self._work = {}
+        self._anel = None
+
+    def reset(self):
+        """
+        Zeros the gradient buffer and returns it.
+        """
+        self.grad.fill(0)
+        return self.grad
+
+    def work(self, name):
+        """
+        Returns the working array with the given name, with the shape of
+        the grid. The array is allocated the first time it is requested
+        and its contents are undefined.
+        """
+        if name not in self._work:
+            self._work[name] = np.empty(self.grid_shape, dtype=self.dtype)
+        return self._work[name]
+
+    def anelastic_profile(self, z, dz):
+        """
+        Returns the anelastic profile of the mass continuity equation for
+        the grid heights z, from
+        pydda.cost_functions.kernels.make_anelastic_profile. It is
+        computed on the first call and reused while z and dz are the same.
+        """
+        if(self._anel is None or self._anel[0] is not z or
+           self._anel[1] != dz):
+            self._anel = (z, dz, make_anelastic_profile(z, dz))
+        return self._anel[2]
+
+
+class DerivativeCache(object):
+    """
+    Finite difference derivatives of the wind field, computed at most once
+    per evaluation of the cost function and shared by every constraint.
+
+    The cache is bound to the wind field of the current evaluation with
+    :py:meth:`bind`. Binding a wind field held in different array objects,
+    which happens every time the optimizer asks for a new point, clears it.
+    The cache keeps a reference to the bound arrays, so it must be cleared
+    if they are modified in place. Derivatives are computed with np.gradient,
+    so they match the ones the cost functions compute themselves.
+
+    Examples
+    --------
+    >>> cache = DerivativeCache().bind(winds)
+    >>> dudx = cache.gradient('u', 2, dx)
+    >>> dudxdy = cache.gradient(('u', 2, dx), 1, dy)
+    """
+    _components = {'u': 0, 'v': 1, 'w': 2}
+
+    def __init__(self):
+        self._source = None
+        self._winds = None
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, winds):
+        """
+        Binds the cache to the wind field winds, either a (3, nz, ny, nx)
+        array or a sequence (u, v, w). The cache is cleared unless winds,
+        or each of its components, is the same object it is already bound
+        to. It keeps references to them, so their memory cannot be reused
+        by other arrays while it is bound. Returns the cache.
+        """
+        if winds is self._source:
+            return self
+        fields = tuple(winds)
+        if(self._winds is None or len(fields) != len(self._winds) or
+           any(f is not g for f, g in zip(fields, self._winds))):
+            self._winds = fields
+            self._cache.clear()
+        self._source = winds
+        return self
+
+    def clear(self):
+        """
+        Removes every cached derivative and unbinds the wind field.
+        """
+        self._source = None
+        self._winds = None
+        self._cache.clear()
+
+    def gradient(self, field, axis, spacing):
+        """
+        Returns the derivative of field along axis with the given grid
+        spacing.
+
+        Parameters
+        ----------
+        field: str or tuple
+            'u', 'v' or 'w', or the key (field, axis, spacing, ...) of a
+            derivative to take a higher derivative of.
+        axis: int
+            Axis to differentiate along: 0 for z, 1 for y and 2 for x
+        spacing: float
+            Grid spacing along the axis
+
+        Returns
+        -------
+        derivative: 3D float array
+            The derivative. It must not be modified.
+        """
+        if self._winds is None:
+            raise RuntimeError('The cache is not bound to a wind field')
+        if isinstance(field, str):
+            field = (field,)
+        key = tuple(field) + (axis, spacing)
+        if key in self._cache:
+            self.hits += 1
+            return self._cache[key]
+        self.misses += 1
+        if len(field) == 1:
+            f = self._winds[self._components[field[0]]]
+        else:
+            f = self.gradient(field[:-2], field[-2], field[-1])
+        self._cache[key] = np.gradient(f, spacing, axis=axis)
+        return self._cache[key]
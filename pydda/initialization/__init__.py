@@ -14,6 +14,8 @@ The module containing the core techniques for the multiple doppler wind retrieva
     make_wind_field_from_profile
     make_test_divergence_field
     make_background_from_wrf
+    make_initialization_from_previous
+    estimate_storm_motion
 
 """
 
@@ -21,4 +23,5 @@ from .wind_fields import make_constant_wind_field
 from .wind_fields import make_wind_field_from_profile
 from .wind_fields import make_test_divergence_field
 from .wind_fields import make_background_from_wrf
-
+from .wind_fields import make_initialization_from_previous
+from .wind_fields import estimate_storm_motion
@@ -0,0 +1,86 @@
+"""
+Checks that make_initialization_from_previous advects the previous
+retrieval with the storm motion and handles grids with another origin.
+"""
+
+import numpy as np
+import pyart
+
+from pydda.initialization import make_initialization_from_previous
+
+GRID_SHAPE = (4, 21, 21)
+LIMITS = ((500.0, 3500.0), (-20000.0, 20000.0), (-20000.0, 20000.0))
+
+
+def _make_grid(origin=(-97.4, 36.55)):
+    grid = pyart.testing.make_empty_grid(GRID_SHAPE, LIMITS)
+    grid.origin_longitude['data'] = np.array([origin[0]])
+    grid.origin_latitude['data'] = np.array([origin[1]])
+    grid.init_point_longitude_latitude()
+    grid.add_field('corrected_velocity',
+                   {'data': np.ma.zeros(GRID_SHAPE)}, replace_existing=True)
+    return grid
+
+
+def _winds(x, y, z):
+    # Linear, so the interpolation is exact
+    return (x/1000.0 + 2.0, y/2000.0 - 1.0, z/1000.0 + x/4000.0)
+
+
+def _make_previous(origin=(-97.4, 36.55)):
+    previous = _make_grid(origin)
+    winds = _winds(previous.point_x['data'], previous.point_y['data'],
+                   previous.point_z['data'])
+    for name, data in zip(['u', 'v', 'w'], winds):
+        previous.add_field(name, {'data': np.ma.masked_array(data)})
+    return previous
+
+
+def test_advected_with_storm_motion():
+    grid = _make_grid()
+    previous = _make_previous()
+    storm_motion = (5.0, -3.0)
+    dt = 600.0
+    u, v, w = make_initialization_from_previous(
+        grid, previous, dt=dt, storm_motion=storm_motion)
+
+    x = grid.point_x['data']
+    y = grid.point_y['data']
+    z = grid.point_z['data']
+    expected = _winds(x - storm_motion[0]*dt, y - storm_motion[1]*dt, z)
+    # Points traced back from inside the previous grid
+    inside = (x - storm_motion[0]*dt >= LIMITS[2][0]) & (
+        y - storm_motion[1]*dt <= LIMITS[1][1])
+    assert np.any(~inside)
+    for field, truth in zip([u, v, w], expected):
+        np.testing.assert_allclose(field[inside], truth[inside], atol=1e-9)
+
+    # Points advected in from outside take the mean of their level
+    level_mean = np.mean(previous.fields['u']['data'], axis=(1, 2))
+    np.testing.assert_allclose(
+        u[~inside], np.broadcast_to(level_mean[:, None, None],
+                                    GRID_SHAPE)[~inside])
+    assert np.all(w[~inside] == 0.0)
+
+
+def test_previous_with_other_origin():
+    grid = _make_grid()
+    previous = _make_previous(origin=(-97.45, 36.52))
+    u, v, w = make_initialization_from_previous(
+        grid, previous, dt=0.0, storm_motion=(0.0, 0.0))
+
+    # The analysis points in the coordinates of the previous grid are
+    # about 4.5 km east and 3.3 km north of where they are in their own
+    x, y = pyart.core.geographic_to_cartesian(
+        grid.point_longitude['data'], grid.point_latitude['data'],
+        previous.get_projparams())
+    shift_x = np.mean(x - grid.point_x['data'])
+    shift_y = np.mean(y - grid.point_y['data'])
+    assert abs(shift_x - 0.05*111320.0*np.cos(np.deg2rad(36.535))) < 50.0
+    assert abs(shift_y - 0.03*111320.0) < 50.0
+
+    inside = (x <= LIMITS[2][1]) & (y <= LIMITS[1][1])
+    expected = _winds(grid.point_x['data'] + shift_x,
+                      grid.point_y['data'] + shift_y, grid.point_z['data'])
+    for field, truth in zip([u, v, w], expected):
+        np.testing.assert_allclose(field[inside], truth[inside], atol=0.05)
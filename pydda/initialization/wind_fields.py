@@ -272,4 +272,153 @@ def make_background_from_wrf(Grid, file_path, wrf_time,
 
     return u, v, w
     
-    
\ No newline at end of file
+    
+
+def estimate_storm_motion(Grid, u_field='u', v_field='v', w_field='w'):
+    """
+    This function estimates the storm motion from a retrieved wind field
+    as the mean horizontal wind over the points with multiple doppler
+    coverage.
+
+    The estimate can be used for the advection in
+    make_initialization_from_previous and as the Ut and Vt of the vertical
+    vorticity constraint.
+
+    Parameters
+    ----------
+    Grid: Py-ART Grid object or RetrievalResult
+        The result of get_dd_wind_field, or a Py-ART Grid made from it.
+    u_field: str
+        Name of the u field in Grid.
+    v_field: str
+        Name of the v field in Grid.
+    w_field: str
+        Name of the w field in Grid. The points where it is masked, which
+        get_dd_wind_field masks outside the multiple doppler lobes by
+        default, are left out of the mean.
+
+    Returns
+    -------
+    Ut: float
+        Zonal component of the storm motion.
+    Vt: float
+        Meridional component of the storm motion.
+    """
+    if hasattr(Grid, 'to_grids'):
+        Grid = Grid.to_grids()[0]
+    u = np.ma.masked_invalid(Grid.fields[u_field]['data'])
+    v = np.ma.masked_invalid(Grid.fields[v_field]['data'])
+    covered = ~np.ma.getmaskarray(Grid.fields[w_field]['data'])
+    if not np.any(covered):
+        covered = np.ones(u.shape, dtype=bool)
+    Ut = float(np.ma.mean(u[covered]))
+    Vt = float(np.ma.mean(v[covered]))
+    return Ut, Vt
+
+
+def make_initialization_from_previous(Grid, previous, dt=None,
+                                      storm_motion=None, vel_field=None):
+    """
+    This function makes an initialization field from the retrieval of the
+    previous radar volume, advected to the time of Grid.
+
+    Consecutive volumes are only a few minutes apart, so the previous
+    retrieval shifted with the storm motion is usually much closer to the
+    new solution than a constant field or a sounding, and get_dd_wind_field
+    converges in far fewer iterations.
+
+    Parameters
+    ----------
+    Grid: Py-ART Grid object
+        This is the Py-ART Grid containing the coordinates for the analysis
+        grid.
+    previous: RetrievalResult, Py-ART Grid object or list of Py-ART Grids
+        The result of get_dd_wind_field for the previous volume, or a Grid
+        or list of Grids made from it. It may have a different grid
+        specification from Grid.
+    dt: float or None
+        Time in seconds from the previous volume to Grid. None will compute
+        it from the times of the two grids.
+    storm_motion: 2-tuple of floats or None
+        The (u, v) storm motion used to advect the previous retrieval.
+        None will estimate it with estimate_storm_motion.
+    vel_field: str
+        The name of the velocity field in Grid. None will automatically
+        try to detect this field.
+
+    Returns
+    -------
+    u: 3D ndarray
+        The initialization u field.
+    v: 3D ndarray
+        The initialization v field.
+    w: 3D ndarray
+        The initialization w field.
+    """
+    if hasattr(previous, 'to_grids'):
+        previous = previous.to_grids()
+    if isinstance(previous, (list, tuple)):
+        previous = previous[0]
+
+    # Parse names of velocity field
+    if vel_field is None:
+        vel_field = pyart.config.get_field_name('corrected_velocity')
+    analysis_grid_shape = Grid.fields[vel_field]['data'].shape
+
+    if dt is None:
+        dt = (pyart.util.datetime_from_grid(Grid) -
+              pyart.util.datetime_from_grid(previous)).total_seconds()
+    if storm_motion is None:
+        storm_motion = estimate_storm_motion(previous)
+
+    # Locate the analysis grid points in the coordinates of the previous
+    # grid, then trace them back along the storm motion
+    x = Grid.point_x['data']
+    y = Grid.point_y['data']
+    z = Grid.point_z['data']
+    same_origin = (
+        np.allclose(Grid.origin_latitude['data'],
+                    previous.origin_latitude['data']) and
+        np.allclose(Grid.origin_longitude['data'],
+                    previous.origin_longitude['data']) and
+        Grid.get_projparams() == previous.get_projparams())
+    if not same_origin:
+        x, y = pyart.core.geographic_to_cartesian(
+            Grid.point_longitude['data'], Grid.point_latitude['data'],
+            previous.get_projparams())
+    x = x - storm_motion[0]*dt
+    y = y - storm_motion[1]*dt
+    points = np.stack([np.broadcast_to(z, analysis_grid_shape),
+                       np.broadcast_to(y, analysis_grid_shape),
+                       np.broadcast_to(x, analysis_grid_shape)], axis=-1)
+    prev_coords = (previous.z['data'], previous.y['data'],
+                   previous.x['data'])
+
+    fields = []
+    for name in ['u', 'v', 'w']:
+        data = np.ma.masked_invalid(previous.fields[name]['data'])
+        if name == 'w':
+            level_fill = np.zeros(data.shape[0])
+        else:
+            # Points without data take the mean of their level
+            level_fill = np.ma.filled(np.ma.mean(data, axis=(1, 2)), 0.0)
+        filled = np.ma.filled(data, np.nan)
+        filled = np.where(np.isfinite(filled), filled,
+                          level_fill[:, np.newaxis, np.newaxis])
+        interp = RegularGridInterpolator(prev_coords, filled,
+                                         bounds_error=False,
+                                         fill_value=np.nan)
+        field = interp(points)
+
+        # Points advected in from outside the previous grid take the mean
+        # of the nearest level
+        outside = ~np.isfinite(field)
+        if np.any(outside):
+            level = np.abs(z[..., np.newaxis] -
+                           previous.z['data']).argmin(axis=-1)
+            field[outside] = level_fill[np.broadcast_to(
+                level, analysis_grid_shape)[outside]]
+        fields.append(field)
+
+    u, v, w = fields
+    return u, v, w
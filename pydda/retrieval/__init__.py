@@ -11,11 +11,20 @@ The module containing the core techniques for the multiple doppler wind retrieva
     :toctree: generated/
   
     get_dd_wind_field
+    RetrievalResult
     get_bca
+    get_pairwise_bca
+    get_weights
+    retrieve_many
+    BatchResult
+    tile_seam_diagnostic
     
 """
 
 from .wind_retrieve import get_dd_wind_field, make_constant_wind_field
 from .wind_retrieve import make_wind_field_from_profile
-from .wind_retrieve import get_bca
+from .result import RetrievalResult
+from .wind_retrieve import get_bca, get_pairwise_bca, get_weights
 from .wind_retrieve import make_test_divergence_field
+from .batch import retrieve_many, BatchResult
+from .tiling import tile_seam_diagnostic
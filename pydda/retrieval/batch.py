@@ -0,0 +1,316 @@
+"""
+Batch retrievals of many radar volumes in a pool of processes.
+"""
+
+import os
+import time
+import threading
+import traceback
+import contextlib
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
+
+_THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS',
+                    'NUMBA_NUM_THREADS']
+
+# Serializes the changes of os.environ made by _thread_environment
+_ENVIRONMENT_LOCK = threading.Lock()
+
+
+class BatchResult(object):
+    """
+    The outcome of one retrieval of retrieve_many.
+
+    Attributes
+    ----------
+    index: int
+        Position of the volume in the iterable given to retrieve_many.
+    result: RetrievalResult or None
+        What get_dd_wind_field returned, or None if the retrieval failed.
+        It is sent back from the worker without the fields of the input
+        Grids, so its to_grids only holds the wind fields.
+    error: str or None
+        The formatted traceback of the exception raised by the retrieval,
+        or None if it succeeded.
+    elapsed: float
+        Wall time of the retrieval in seconds, as measured by the worker.
+    """
+    def __init__(self, index, result=None, error=None, elapsed=0.0):
+        self.index = index
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        """
+        True if the retrieval succeeded.
+        """
+        return self.error is None
+
+    def __repr__(self):
+        status = 'ok' if self.ok else 'failed'
+        return 'BatchResult(index={}, {}, elapsed={:.1f} s)'.format(
+            self.index, status, self.elapsed)
+
+
+def _check_thread_limits(context):
+    """
+    Raises a ValueError if the thread limits cannot be applied to worker
+    processes started by the multiprocessing context.
+
+    BLAS and OpenMP read their thread counts when they are loaded, which
+    happens before the worker initializer runs. Workers started with
+    'spawn' get the counts from the environment set by
+    :py:func:`_thread_environment`. Workers started with 'fork' or
+    'forkserver' inherit BLAS already loaded, so only threadpoolctl can
+    limit it.
+    """
+    if context.get_start_method() != 'spawn' and threadpoolctl is None:
+        raise ValueError(('Limiting the threads of workers started with ' +
+                          context.get_start_method() + ' requires ' +
+                          'threadpoolctl. Install it or use ' +
+                          "mp_context='spawn'."))
+
+
+@contextlib.contextmanager
+def _thread_environment(n_threads):
+    """
+    Sets the thread counts of BLAS, OpenMP and numba in os.environ, and
+    restores them on exit. Worker processes spawned inside it start with
+    these counts.
+
+    This is not thread-safe. os.environ belongs to the whole process, so
+    other threads see the changed counts while the block runs, and any
+    process they start inherits them. A module lock only keeps concurrent
+    calls of this function from restoring each other's values, so the
+    block should hold nothing but the starting of the workers.
+    """
+    with _ENVIRONMENT_LOCK:
+        saved = dict((name, os.environ.get(name))
+                     for name in _THREAD_ENV_VARS)
+        for name in _THREAD_ENV_VARS:
+            os.environ[name] = str(n_threads)
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def _limit_threads(n_threads):
+    """
+    Limits the number of threads used by BLAS, OpenMP and numba in a
+    worker process. This is the initializer of the workers, which runs
+    after NumPy is loaded, so the environment of the worker must already
+    hold the limits unless threadpoolctl is installed.
+    """
+    if threadpoolctl is not None:
+        threadpoolctl.threadpool_limits(n_threads)
+    else:
+        for name in _THREAD_ENV_VARS:
+            if os.environ.get(name) != str(n_threads):
+                raise RuntimeError(
+                    name + ' was not set to ' + str(n_threads) + ' when ' +
+                    'the worker started, and threadpoolctl is not ' +
+                    'installed to limit the threads afterwards')
+    import numba
+    numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def _run_retrieval(index, task, kwargs, initialization):
+    """
+    Runs one retrieval in a worker, capturing any exception it raises.
+    """
+    from .wind_retrieve import get_dd_wind_field
+
+    start = time.perf_counter()
+    try:
+        if isinstance(task, dict):
+            task_kwargs = dict(kwargs)
+            task_kwargs.update(task)
+            Grids = task_kwargs.pop('Grids')
+        else:
+            task_kwargs = dict(kwargs)
+            Grids = task
+        if 'u_init' not in task_kwargs:
+            u_init, v_init, w_init = initialization(
+                Grids[0], vel_field=task_kwargs.get('vel_name'))
+            task_kwargs['u_init'] = u_init
+            task_kwargs['v_init'] = v_init
+            task_kwargs['w_init'] = w_init
+        result = get_dd_wind_field(Grids, **task_kwargs)
+        return BatchResult(index, result=result,
+                           elapsed=time.perf_counter() - start)
+    except Exception:
+        return BatchResult(index, error=traceback.format_exc(),
+                           elapsed=time.perf_counter() - start)
+
+
+def retrieve_many(grid_sets, max_workers=None, threads_per_worker=1,
+                  max_pending=None, initialization=None,
+                  mp_context='spawn', **kwargs):
+    """
+    This function runs get_dd_wind_field on many radar volumes in a pool
+    of processes, yielding the results as they finish.
+
+    A retrieval that raises an exception is reported in its BatchResult
+    and does not stop the others. If a worker process dies, the volumes
+    that were in the pool are retried one at a time in a separate worker,
+    and only the ones that kill that worker too are reported as failed.
+
+    Parameters
+    ==========
+    grid_sets: iterable
+        The volumes to retrieve. Each item is either a list of Py-ART
+        Grids, or a dict with the list of Grids under 'Grids' and any
+        other arguments of get_dd_wind_field for that volume, which take
+        precedence over kwargs. The iterable is consumed lazily, so it can
+        be a generator that reads the grids from disk.
+    max_workers: int or None
+        Number of worker processes. None uses the number of CPUs divided
+        by threads_per_worker.
+    threads_per_worker: int
+        Number of threads each worker may use for BLAS, OpenMP and the
+        numba kernels.
+    max_pending: int or None
+        Maximum number of volumes submitted to the pool and not yet
+        returned, which bounds the memory held by queued grids. None uses
+        twice max_workers.
+    initialization: callable or None
+        Function called as initialization(Grid, vel_field=vel_name) to
+        make u_init, v_init and w_init for volumes that do not specify
+        them. None uses pydda.initialization.make_constant_wind_field.
+        It is sent to the workers, so it must be a module level function.
+    mp_context: str
+        Start method of the worker processes. The default, 'spawn', starts
+        workers with the thread limits set in their environment, so that
+        BLAS and OpenMP read them when they are loaded. Scripts using it
+        must protect their entry point with if __name__ == '__main__'.
+        Other start methods require threadpoolctl, and raise a ValueError
+        without it.
+    kwargs:
+        Arguments of get_dd_wind_field shared by all volumes.
+
+    Returns
+    =======
+    results: iterator of BatchResult
+        The result of each volume, in the order they finish. Use the index
+        attribute to match them to grid_sets. The pool is started when the
+        first result is requested.
+    """
+    if initialization is None:
+        from ..initialization import make_constant_wind_field
+        initialization = make_constant_wind_field
+    if max_workers is None:
+        max_workers = max(1, (os.cpu_count() or 1)//threads_per_worker)
+    if max_pending is None:
+        max_pending = 2*max_workers
+    max_pending = max(max_pending, max_workers)
+    context = multiprocessing.get_context(mp_context)
+    _check_thread_limits(context)
+    return _retrieve_many(grid_sets, max_workers, threads_per_worker,
+                          max_pending, initialization, context, kwargs)
+
+
+def _retrieve_many(grid_sets, max_workers, threads_per_worker, max_pending,
+                   initialization, context, kwargs):
+    """
+    Runs the pool of retrieve_many once its arguments are checked.
+    """
+    def make_executor(n_workers):
+        return ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=context,
+            initializer=_limit_threads, initargs=(threads_per_worker,))
+
+    def submit(executor, index, task):
+        with _thread_environment(threads_per_worker):
+            return executor.submit(_run_retrieval, index, task, kwargs,
+                                   initialization)
+
+    tasks = enumerate(grid_sets)
+    # Maps each future to its index, task and whether it runs alone in the
+    # isolation pool
+    pending = {}
+    # Volumes that were in a pool when one of its workers died. They are
+    # retried one at a time, so that a volume that kills its worker again
+    # can be told apart from the others.
+    suspects = []
+    exhausted = False
+    executor = make_executor(max_workers)
+    isolation = None
+    try:
+        while True:
+            n_main = sum(1 for p in pending.values() if not p[2])
+            while not exhausted and n_main < max_pending:
+                try:
+                    index, task = next(tasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = submit(executor, index, task)
+                pending[future] = (index, task, False)
+                n_main += 1
+            if suspects and not any(p[2] for p in pending.values()):
+                if isolation is None:
+                    isolation = make_executor(1)
+                index, task = suspects.pop(0)
+                future = submit(isolation, index, task)
+                pending[future] = (index, task, True)
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            main_broken = False
+            for future in done:
+                index, task, isolated = pending.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    if isolated:
+                        isolation.shutdown(wait=False)
+                        isolation = None
+                        result = BatchResult(
+                            index, error=('BrokenProcessPool: the worker '
+                                          'process died while retrieving '
+                                          'this volume'))
+                    else:
+                        main_broken = True
+                        suspects.append((index, task))
+                        continue
+                except Exception:
+                    # Such as a volume that cannot be pickled
+                    result = BatchResult(index, error=traceback.format_exc())
+                yield result
+
+            if main_broken:
+                # Every task still in the broken pool fails with it
+                for future in list(pending):
+                    index, task, isolated = pending[future]
+                    if isolated:
+                        continue
+                    del pending[future]
+                    if (future.done() and not future.cancelled() and
+                            future.exception() is None):
+                        yield future.result()
+                    else:
+                        future.cancel()
+                        suspects.append((index, task))
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = make_executor(max_workers)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if isolation is not None:
+            isolation.shutdown(wait=True, cancel_futures=True)
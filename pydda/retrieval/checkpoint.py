@@ -0,0 +1,136 @@
+"""
+Checkpoints of the optimizer state of a retrieval.
+
+Long retrievals write their state to a local file every few iterations so
+that a run killed by a batch scheduler can be resumed. The state holds the
+current wind field, the stage of the solver (before the low pass filter,
+after it, or done), the number of iterations of that stage, the maximum
+vertical velocity the convergence check compares against, the iteration
+and evaluation counters, and a hash of the weights, observations and
+settings of the retrieval, so that a checkpoint is never resumed by a
+different retrieval.
+
+L-BFGS-B keeps curvature information that cannot be saved, so with a
+checkpoint the solver is restarted at every checkpoint, in the
+uninterrupted run as well as in the resumed one. Both therefore give
+exactly the same result.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+
+# Stages of the solver
+SOLVE = 0
+FILTERED = 1
+DONE = 2
+
+
+def retrieval_key(arrays, settings):
+    """
+    Returns a hash identifying a retrieval.
+
+    Parameters
+    ----------
+    arrays: list of arrays
+        The arrays the retrieval depends on, such as the weights, the
+        radial velocities and the initial wind field. The masks of masked
+        arrays are included.
+    settings: dict
+        Settings of the retrieval. Their repr is hashed.
+
+    Returns
+    -------
+    key: str
+        Hexadecimal SHA-1 digest.
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        data = np.ascontiguousarray(np.ma.getdata(array))
+        digest.update((str(data.shape) + str(data.dtype)).encode())
+        digest.update(data.tobytes())
+        if np.ma.is_masked(array):
+            digest.update(np.ascontiguousarray(
+                np.ma.getmaskarray(array)).tobytes())
+    digest.update(repr(sorted(settings.items())).encode())
+    return digest.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    The checkpoint file of a retrieval.
+
+    Parameters
+    ----------
+    path: str
+        Path of the checkpoint file. It is written with numpy.savez.
+    key: str
+        Hash of the retrieval from :py:func:`retrieval_key`. A file with
+        a different key is not resumed.
+    interval: int
+        Number of iterations between checkpoints, rounded up to a multiple
+        of 10.
+    """
+    def __init__(self, path, key, interval=50):
+        self.path = path
+        self.key = key
+        self.interval = 10*max(int(np.ceil(interval/10.0)), 1)
+
+    def load(self):
+        """
+        Returns the state stored in the file as a dict with the keys
+        'winds', 'stage', 'iterations', 'wprevmax' and 'diagnostics', or
+        None if there is no file or it was written by another retrieval.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as data:
+            if str(data['key']) != self.key:
+                print('Checkpoint ' + self.path + ' is from a different ' +
+                      'retrieval, starting from the beginning')
+                return None
+            return {'winds': np.array(data['winds']),
+                    'stage': int(data['stage']),
+                    'iterations': int(data['iterations']),
+                    'wprevmax': float(data['wprevmax']),
+                    'diagnostics': json.loads(str(data['diagnostics']))}
+
+    def save(self, winds, stage, iterations, wprevmax, diagnostics):
+        """
+        Writes the state to the file, replacing the previous one.
+
+        Parameters
+        ----------
+        winds: 1D float array
+            The flattened (u, v, w) wind field.
+        stage: int
+            SOLVE, FILTERED or DONE.
+        iterations: int
+            Number of iterations of the current stage.
+        wprevmax: float
+            Maximum vertical velocity at the last convergence check.
+        diagnostics: dict
+            Its 'iterations', 'evaluations' and 'cost' are stored.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        counters = dict((name, diagnostics[name])
+                        for name in ('iterations', 'evaluations', 'cost')
+                        if name in diagnostics)
+        # Write to a temporary file first so that a run killed while
+        # writing leaves the previous checkpoint intact
+        fd, temp_path = tempfile.mkstemp(suffix='.npz', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, key=np.array(self.key), winds=winds,
+                         stage=np.array(stage),
+                         iterations=np.array(iterations),
+                         wprevmax=np.array(wprevmax, dtype=np.float64),
+                         diagnostics=np.array(json.dumps(counters)))
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
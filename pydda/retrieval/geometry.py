@@ -0,0 +1,314 @@
+"""
+Cache of the radar viewing geometry of analysis grids.
+
+The azimuth and elevation of each grid point from a radar and the beam
+crossing angles of each pair of radars only depend on the radar locations
+and on the grid specification. Radars do not move and analysis grids are
+usually fixed, so these are computed once and looked up by a key made from
+the grid specification on the following calls to get_dd_wind_field.
+
+The cache is kept in memory, and can also be stored as .npy files in a
+directory so that later processes load it memory mapped instead of
+computing it again.
+"""
+
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+import pyart
+
+from collections import OrderedDict
+
+from .angles import gc_bear_array, gc_dist, rsl_get_slantr_and_elev
+from .angles import _add_field_to_object
+
+
+class GeometryCache(object):
+    """
+    A least recently used cache of geometry arrays, optionally backed by a
+    directory of .npy files.
+
+    The cached arrays are shared between all the grids with the same
+    specification, and the arrays loaded from disk are read only memory
+    maps, so they must not be modified in place.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of arrays kept in memory.
+    directory: str or None
+        Directory where the arrays are stored. None keeps them only in
+        memory.
+    """
+    def __init__(self, maxsize=64, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, name + '.npy')
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def _store(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        # Write to a temporary file first so that other processes never
+        # load a partly written array
+        fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, value)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return np.load(self._path(key), mmap_mode='r')
+
+    def get(self, key, compute):
+        """
+        Returns the array stored under key. It is looked up in memory, then
+        in the directory, and only made by calling compute() if it is in
+        neither. New arrays are written to the directory.
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        value = self._load(key)
+        if value is None:
+            self.misses += 1
+            value = np.asarray(compute())
+            if self.directory is not None:
+                value = self._store(key, value)
+        else:
+            self.hits += 1
+        self._entries[key] = value
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        """
+        Empties the cache in memory. The files in the directory are kept.
+        """
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+geometry_cache = GeometryCache()
+_directory_caches = {}
+
+
+def get_cache(directory=None):
+    """
+    Returns the geometry cache stored in directory, or the cache kept only
+    in memory if directory is None. The same cache object is returned for
+    the same directory.
+    """
+    if directory is None:
+        return geometry_cache
+    directory = os.path.abspath(directory)
+    if directory not in _directory_caches:
+        _directory_caches[directory] = GeometryCache(directory=directory)
+    return _directory_caches[directory]
+
+
+def grid_spec_key(grid):
+    """
+    Returns a key identifying the radar location and grid specification of
+    a Py-ART Grid.
+    """
+    digest = hashlib.sha1()
+    for coords in [grid.radar_latitude, grid.radar_longitude,
+                   grid.radar_altitude, grid.origin_latitude,
+                   grid.origin_longitude, grid.x, grid.y, grid.z]:
+        data = np.ascontiguousarray(coords['data'], dtype=np.float64)
+        digest.update(str(data.shape).encode())
+        digest.update(data.tobytes())
+    digest.update(repr(sorted(grid.get_projparams().items())).encode())
+    return digest.hexdigest()
+
+
+def _azimuth(grid):
+    """
+    Computes the azimuth in radians of each horizontal grid point from the
+    radar of grid.
+    """
+    az = gc_bear_array(
+        grid.radar_latitude['data'][0], grid.radar_longitude['data'][0],
+        grid.point_latitude['data'][0], grid.point_longitude['data'][0])
+    return az*np.pi/180
+
+
+def _elevation(grid):
+    """
+    Computes the elevation in radians of each grid point from the radar of
+    grid.
+    """
+    gr = gc_dist(
+        grid.radar_latitude['data'][0], grid.radar_longitude['data'][0],
+        grid.point_latitude['data'][0], grid.point_longitude['data'][0])
+    h = grid.z['data'] - grid.radar_altitude['data'][0]
+    sr, el = rsl_get_slantr_and_elev(gr[np.newaxis, :, :],
+                                     h[:, np.newaxis, np.newaxis]/1000.0)
+    return el*np.pi/180
+
+
+def _masked(data, shape):
+    """
+    Returns data broadcast to shape as a masked array, masked where it is
+    not finite. The data is not copied.
+    """
+    invalid = np.broadcast_to(~np.isfinite(data), shape)
+    data = np.broadcast_to(data, shape)
+    return np.ma.masked_array(data, mask=invalid, copy=False)
+
+
+def get_azimuth(grid, cache=None):
+    """
+    Returns the azimuth in radians of each point of grid from its radar.
+
+    Parameters
+    ----------
+    grid: Py-ART Grid object
+        Grid of one radar.
+    cache: GeometryCache or None
+        Cache to look the azimuth up in. None uses the cache in memory.
+
+    Returns
+    -------
+    az: 3D masked array
+        The azimuth, masked where it is undefined. It does not vary with
+        height, so its data is a read only view of a 2D array.
+    """
+    if cache is None:
+        cache = geometry_cache
+    az = cache.get(('AZ', grid_spec_key(grid)), lambda: _azimuth(grid))
+    return _masked(az, (len(grid.z['data']),) + az.shape)
+
+
+def get_elevation(grid, cache=None):
+    """
+    Returns the elevation in radians of each point of grid from its radar.
+
+    Parameters
+    ----------
+    grid: Py-ART Grid object
+        Grid of one radar.
+    cache: GeometryCache or None
+        Cache to look the elevation up in. None uses the cache in memory.
+
+    Returns
+    -------
+    el: 3D masked array
+        The elevation, masked where it is undefined.
+    """
+    if cache is None:
+        cache = geometry_cache
+    el = cache.get(('EL', grid_spec_key(grid)), lambda: _elevation(grid))
+    return _masked(el, el.shape)
+
+
+def get_pairwise_bca(Grids):
+    """
+    This function gets the beam crossing angles of every pair of radars
+    over the horizontal grid at once.
+
+    Parameters
+    ----------
+    Grids: list of Py-ART Grids
+        The grids of each radar. All grids must have the same specification.
+
+    Returns
+    -------
+    pairs: list of 2-tuples
+        The (i, j) indices in Grids of each pair of radars, with i < j, in
+        the order of the loops for i in range(len(Grids)) and
+        for j in range(i+1, len(Grids)).
+    bca: 3D float array
+        The beam crossing angle in radians between the radars of each pair,
+        with shape (len(pairs), ny, nx).
+    """
+    projparams = Grids[0].get_projparams()
+    x = Grids[0].point_x['data'][0]
+    y = Grids[0].point_y['data'][0]
+    radar_x = np.zeros(len(Grids))
+    radar_y = np.zeros(len(Grids))
+    for i in range(len(Grids)):
+        rad = pyart.core.geographic_to_cartesian(
+            Grids[i].radar_longitude['data'], Grids[i].radar_latitude['data'],
+            projparams)
+        radar_x[i] = np.squeeze(rad[0])
+        radar_y[i] = np.squeeze(rad[1])
+
+    first, second = np.triu_indices(len(Grids), 1)
+    pairs = list(zip(first.tolist(), second.tolist()))
+    # Distance from each radar to each grid point
+    dist = np.sqrt(np.square(x - radar_x[:, np.newaxis, np.newaxis]) +
+                   np.square(y - radar_y[:, np.newaxis, np.newaxis]))
+    a = dist[first]
+    b = dist[second]
+    c = np.sqrt(np.square(radar_x[second] - radar_x[first]) +
+                np.square(radar_y[second] - radar_y[first]))
+    c = c[:, np.newaxis, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pairs, np.arccos((a*a+b*b-c*c)/(2*a*b))
+
+
+def get_cached_pairwise_bca(Grids, cache=None):
+    """
+    Returns get_pairwise_bca(Grids), looking the beam crossing angles up in
+    cache, or in the cache in memory if cache is None.
+    """
+    if cache is None:
+        cache = geometry_cache
+    key = ('BCA',) + tuple(grid_spec_key(grid) for grid in Grids)
+    bca = cache.get(key, lambda: get_pairwise_bca(Grids)[1])
+    first, second = np.triu_indices(len(Grids), 1)
+    return list(zip(first.tolist(), second.tolist())), bca
+
+
+def add_geometry_fields(grid, dz_name='DT', az_name='AZ', el_name='EL',
+                        cache=None):
+    """
+    Adds the azimuth and elevation fields in degrees to a Py-ART Grid
+    object, taking them from the geometry cache when a grid with the same
+    specification has been seen before. get_dd_wind_field does not need
+    these fields, this is only for looking at them.
+
+    Parameters
+    ----------
+    grid: Py-ART Grid object
+        Input Grid object for modification.
+    dz_name: str
+        Name of the reflectivity field in the Grid.
+    az_name: str
+        Name of the azimuth field to add to the Grid.
+    el_name: str
+        Name of the elevation field to add to the Grid.
+    cache: GeometryCache or None
+        Cache to look the geometry up in. None uses the cache in memory.
+
+    Returns
+    -------
+    grid: Py-ART Grid object
+        Output Grid object with the azimuth and elevation fields added.
+    """
+    az = get_azimuth(grid, cache)*180/np.pi
+    el = get_elevation(grid, cache)*180/np.pi
+    _add_field_to_object(grid, az, field_name=az_name, dz_name=dz_name)
+    _add_field_to_object(grid, el, field_name=el_name, dz_name=dz_name)
+    return grid
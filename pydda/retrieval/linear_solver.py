@@ -0,0 +1,236 @@
+"""
+Preconditioned conjugate gradient solver for quadratic cost functions.
+
+Without the vertical vorticity constraint every term of the cost function
+is quadratic in the winds, so its gradient is affine, g(x) = H x + g(0),
+and its minimum is the solution of the symmetric positive semidefinite
+linear system H x = -g(0), where H is the Hessian of the cost function.
+The constraints compute products with H through
+ConstraintRegistry.hessian_product, so the system is solved with
+conjugate gradients on a scipy.sparse.linalg.LinearOperator without ever
+forming H.
+
+The impermeability condition fixes w on the bottom level, and on the top
+level when upper_bc is True. The solver projects these points out of the
+operator, the right hand side and the preconditioner, so they keep their
+initial values.
+"""
+
+import numpy as np
+
+from scipy.sparse.linalg import LinearOperator, cg
+
+
+def boundary_projection(grid_shape, upper_bc=True):
+    """
+    Returns the projection onto the points of the wind field that are not
+    fixed by the impermeability condition.
+
+    Parameters
+    ----------
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the analysis grid
+    upper_bc: bool
+        True if w is also fixed at the top of the domain
+
+    Returns
+    -------
+    free: 1-D float array
+        1 for the free points and 0 for the fixed points of the flattened
+        (u, v, w) wind field. Multiplying by it is the projection.
+    """
+    free = np.ones((3,) + tuple(grid_shape))
+    free[2, 0] = 0
+    if(upper_bc == True):
+        free[2, -1] = 0
+    return free.reshape(-1)
+
+
+class HessianOperator(LinearOperator):
+    """
+    The projected Hessian of a quadratic cost function as a
+    scipy.sparse.linalg.LinearOperator.
+
+    The vector to multiply is scaled to a maximum of scale m/s before it is
+    passed to the constraints, so that the products are well resolved in
+    float32 as well as in float64.
+
+    Parameters
+    ----------
+    cost_function: ConstraintRegistry
+        The set up constraints of the retrieval. All active constraints
+        must be quadratic.
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the analysis grid
+    upper_bc: bool
+        True if w is also fixed at the top of the domain
+    scale: float
+        Maximum absolute value of the wind field the constraints are
+        evaluated at.
+
+    Attributes
+    ----------
+    free: 1-D float array
+        The projection from :py:func:`boundary_projection`
+    n_products: int
+        Number of products computed so far
+    """
+    def __init__(self, cost_function, grid_shape, upper_bc=True, scale=10.0):
+        if not cost_function.quadratic:
+            raise ValueError(('The conjugate gradient solver requires ' +
+                              'every active constraint to be quadratic'))
+        n = 3*int(np.prod(grid_shape))
+        LinearOperator.__init__(self, np.float64, (n, n))
+        self.cost_function = cost_function
+        self.grid_shape = tuple(grid_shape)
+        self.free = boundary_projection(grid_shape, upper_bc)
+        self.scale = scale
+        self.n_products = 0
+
+    def product(self, p):
+        """
+        Returns the product of the Hessian with p, which is not projected.
+        """
+        p_max = np.abs(p).max()
+        self.n_products += 1
+        if(p_max == 0):
+            return np.zeros(self.shape[0])
+        s = self.scale/p_max
+        return self.cost_function.hessian_product(s*p)/s
+
+    def _matvec(self, p):
+        return self.free*self.product(self.free*np.ravel(p))
+
+    def _adjoint(self):
+        return self
+
+
+def jacobi_preconditioner(operator):
+    """
+    Makes a diagonal preconditioner for a :py:class:`HessianOperator`.
+
+    The diagonal of the radial velocity constraint is taken exactly from
+    its observation operators. The other constraints are stencils with
+    nearly constant coefficients, so the diagonal of their sum is
+    approximated for each wind component by its value at the center of the
+    grid, from one product with the operator per component.
+
+    Parameters
+    ----------
+    operator: HessianOperator
+        The operator to precondition
+
+    Returns
+    -------
+    M: scipy.sparse.linalg.LinearOperator
+        Multiplication by the inverse of the diagonal on the free points.
+    """
+    cost_function = operator.cost_function
+    grid_shape = operator.grid_shape
+    diagonal = np.zeros((3,) + grid_shape)
+    if 'Jvel' in cost_function and cost_function['Jvel'].active:
+        data = cost_function['Jvel']
+        lambda_o = 2*data.coeff/(data.rmsVr*data.rmsVr)
+        for obs in data.observations:
+            weight = lambda_o*obs.weight.astype(np.float64)
+            for i, coeff in enumerate([obs.x_coeff, obs.y_coeff,
+                                       obs.z_coeff]):
+                obs.scatter(weight*np.square(coeff, dtype=np.float64),
+                            diagonal[i])
+
+    center = tuple(n//2 for n in grid_shape)
+    for i in range(3):
+        spike = np.zeros((3,) + grid_shape)
+        spike[(i,) + center] = 1.0
+        column = np.reshape(operator.matvec(spike.reshape(-1)),
+                            (3,) + grid_shape)
+        diagonal[i] += max(column[(i,) + center] -
+                           diagonal[(i,) + center], 0.0)
+
+    diagonal = diagonal.reshape(-1)
+    diagonal[diagonal <= 0] = 1.0
+    inverse = operator.free/diagonal
+    return LinearOperator(operator.shape, dtype=np.float64,
+                          matvec=lambda r: inverse*np.ravel(r))
+
+
+def solve_cg(cost_function, winds, grid_shape, max_iterations, dtype,
+             upper_bc=True, diagnostics=None, preconditioner='jacobi',
+             rtol=1e-3, label='Iterations before filter: '):
+    """
+    Minimizes a quadratic cost function with preconditioned conjugate
+    gradients.
+
+    Unlike L-BFGS-B, the winds are not bounded to +/- 100 m/s and the
+    solver stops when the norm of the gradient has dropped by rtol, rather
+    than on the change of the maximum vertical velocity.
+
+    Parameters
+    ----------
+    cost_function: ConstraintRegistry
+        The set up constraints of the retrieval. All active constraints
+        must be quadratic.
+    winds: 1D float array
+        Initial guess of the flattened (u, v, w) wind field. The fixed
+        boundary points keep their values.
+    grid_shape: tuple
+        Shape of the analysis grid.
+    max_iterations: int
+        Maximum number of conjugate gradient iterations.
+    dtype: numpy dtype
+        Storage precision of the wind field.
+    upper_bc: bool
+        True if w is also fixed at the top of the domain
+    diagnostics: dict or None
+        If given, the number of iterations and of evaluations of the cost
+        function are added to its 'iterations' and 'evaluations', and the
+        final cost is stored in 'cost'.
+    preconditioner: 'jacobi', None or scipy.sparse.linalg.LinearOperator
+        'jacobi' uses :py:func:`jacobi_preconditioner`. A LinearOperator
+        is used as the inverse of the preconditioner.
+    rtol: float
+        Relative reduction of the norm of the projected gradient at which
+        the solver stops.
+    label: str
+        Printed before the number of iterations every 10 iterations.
+
+    Returns
+    -------
+    winds: 1D float array
+        The flattened (u, v, w) wind field.
+    """
+    if(max_iterations <= 0):
+        return winds
+    operator = HessianOperator(cost_function, grid_shape, upper_bc)
+    if(isinstance(preconditioner, str)):
+        if(preconditioner != 'jacobi'):
+            raise ValueError("preconditioner must be 'jacobi', None or a " +
+                             "LinearOperator")
+        preconditioner = jacobi_preconditioner(operator)
+
+    winds = np.asarray(winds, dtype=np.float64)
+    grad0 = cost_function.evaluate(np.zeros_like(winds))[1].copy()
+    rhs = -operator.free*(grad0 + operator.product(winds))
+    n_iterations = [0]
+
+    def callback(increment):
+        n_iterations[0] += 1
+        if(n_iterations[0] % 10 == 0):
+            w = np.reshape(winds + increment, (3,) + tuple(grid_shape))[2]
+            print('Max w: ' + "{:9.4f}".format(np.abs(w).max()))
+            print(label + str(n_iterations[0]))
+
+    increment, info = cg(operator, rhs, rtol=rtol, atol=0.0,
+                         maxiter=max_iterations, M=preconditioner,
+                         callback=callback)
+    if(info < 0):
+        raise RuntimeError('Conjugate gradient solver failed')
+    winds = winds + operator.free*increment
+    cost, _, _ = cost_function.evaluate(winds)
+    if(diagnostics is not None):
+        diagnostics['iterations'] = (diagnostics.get('iterations', 0) +
+                                     n_iterations[0])
+        diagnostics['evaluations'] = (diagnostics.get('evaluations', 0) +
+                                      operator.n_products + 2)
+        diagnostics['cost'] = float(cost)
+    return np.asarray(winds, dtype=dtype)
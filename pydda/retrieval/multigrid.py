@@ -0,0 +1,182 @@
+"""
+Grid transfer operators for the coarse to fine multigrid retrieval.
+
+Each coarser level halves the number of points in x and y. The vertical
+levels are kept, since radar grids have far fewer points in z than in the
+horizontal. A coarse grid point is the mean of a 2 x 2 block of fine grid
+points, so its position is the center of that block.
+"""
+
+import numpy as np
+
+from scipy.ndimage import map_coordinates
+
+
+def _pad_even(field):
+    """
+    Pads the last two axes of field to an even size by repeating the last
+    row and column.
+    """
+    pad = [(0, 0)]*(field.ndim - 2) + [(0, field.shape[-2] % 2),
+                                       (0, field.shape[-1] % 2)]
+    if any(p[1] for p in pad):
+        return np.pad(field, pad, mode='edge')
+    return field
+
+
+def _block_sum(field):
+    """
+    Sums field over 2 x 2 blocks of its last two axes.
+    """
+    field = _pad_even(field)
+    shape = field.shape[:-2] + (field.shape[-2]//2, 2, field.shape[-1]//2, 2)
+    return field.reshape(shape).sum(axis=(-3, -1))
+
+
+def coarsen(field, valid=None):
+    """
+    Coarsens a 3D field by averaging it over 2 x 2 blocks in the horizontal.
+
+    Parameters
+    ----------
+    field: 3D float array
+        Field to coarsen. Masked points are left out of the average.
+    valid: 3D bool array
+        If given, only points where valid is True are averaged.
+
+    Returns
+    -------
+    coarse: 3D masked array
+        The coarse field, masked where no points of the block are valid.
+    """
+    if valid is None:
+        valid = ~np.ma.getmaskarray(field)
+    else:
+        valid = np.logical_and(valid, ~np.ma.getmaskarray(field))
+    data = np.where(valid, np.ma.getdata(field), 0.0)
+    count = _block_sum(valid.astype(np.float64))
+    total = _block_sum(data)
+    coarse = total/np.maximum(count, 1)
+    return np.ma.masked_array(coarse, mask=(count == 0))
+
+
+def coarsen_angle(angle):
+    """
+    Coarsens a 3D field of angles in radians by taking the circular mean
+    over 2 x 2 blocks in the horizontal, so that azimuths on both sides of
+    north average correctly.
+    """
+    sin_mean = coarsen(np.ma.sin(angle))
+    cos_mean = coarsen(np.ma.cos(angle))
+    coarse = np.arctan2(np.ma.getdata(sin_mean), np.ma.getdata(cos_mean))
+    return np.ma.masked_array(coarse, mask=np.ma.getmaskarray(sin_mean))
+
+
+def coarsen_inputs(vrs, azs, els, wts, weights, bg_weights, z):
+    """
+    Coarsens the inputs of the retrieval by a factor of 2 in x and y.
+
+    The radial velocities and fall speeds of each radar are averaged over
+    the points where the radar has data, and the data weight of a coarse
+    point is the fraction of the points in its block that have data.
+
+    Parameters
+    ----------
+    vrs: list of 3D masked arrays
+        Radial velocity from each radar
+    azs: list of 3D masked arrays
+        Azimuth from each radar in radians
+    els: list of 3D masked arrays
+        Elevation from each radar in radians
+    wts: list of 3D masked arrays
+        Fall speed from each radar
+    weights: 4D float array
+        Data weights of each radar
+    bg_weights: 3D float array
+        Weights of the background constraint
+    z: 3D float array
+        Height of each grid point
+
+    Returns
+    -------
+    inputs: tuple
+        The coarsened (vrs, azs, els, wts, weights, bg_weights, z), with the
+        same types and dtypes as the inputs.
+    """
+    dtype = weights.dtype
+    coarse_vrs = []
+    coarse_azs = []
+    coarse_els = []
+    coarse_wts = []
+    coarse_weights = []
+    for i in range(len(vrs)):
+        has_data = np.logical_and(~np.ma.getmaskarray(vrs[i]),
+                                  weights[i] > 0)
+        coarse_vrs.append(coarsen(vrs[i], has_data))
+        coarse_wts.append(coarsen(wts[i], has_data))
+        coarse_azs.append(coarsen_angle(azs[i]))
+        coarse_els.append(coarsen(els[i]))
+        coarse_weights.append(
+            np.ma.getdata(coarsen(has_data.astype(np.float64))))
+    coarse_weights = np.stack(coarse_weights).astype(dtype)
+    coarse_bg_weights = np.ma.getdata(coarsen(bg_weights)).astype(dtype)
+    coarse_z = np.ma.getdata(coarsen(z)).astype(z.dtype)
+    return (coarse_vrs, coarse_azs, coarse_els, coarse_wts, coarse_weights,
+            coarse_bg_weights, coarse_z)
+
+
+def coarsen_winds(winds):
+    """
+    Coarsens a (3, nz, ny, nx) wind field by a factor of 2 in x and y.
+    """
+    return np.stack([np.ma.getdata(coarsen(winds[i]))
+                     for i in range(3)]).astype(winds.dtype)
+
+
+def refine(field, fine_shape):
+    """
+    Interpolates a coarse 3D field to the next finer grid with bilinear
+    interpolation in the horizontal. Points outside the outermost coarse
+    points take the value of the nearest one.
+
+    Parameters
+    ----------
+    field: 3D float array
+        Coarse field
+    fine_shape: tuple
+        Shape (nz, ny, nx) of the finer grid
+
+    Returns
+    -------
+    fine: 3D float array
+        The field on the finer grid
+    """
+    nz, ny, nx = fine_shape
+    # Fine point j is at coarse index (j - 0.5)/2
+    k, j, i = np.meshgrid(np.arange(nz, dtype=np.float64),
+                          (np.arange(ny) - 0.5)/2.0,
+                          (np.arange(nx) - 0.5)/2.0, indexing='ij')
+    return map_coordinates(field, [k, j, i], order=1, mode='nearest')
+
+
+def refine_winds(winds, fine_shape):
+    """
+    Interpolates a coarse (3, nz, ny, nx) wind field to the next finer
+    grid.
+    """
+    return np.stack([refine(winds[i], fine_shape)
+                     for i in range(3)]).astype(winds.dtype)
+
+
+def count_levels(grid_shape, min_points=16):
+    """
+    Returns the number of times the grid can be coarsened by 2 in x and y
+    while keeping at least min_points points in each direction.
+    """
+    levels = 0
+    ny, nx = grid_shape[1], grid_shape[2]
+    while (min((ny + 1)//2, (nx + 1)//2) >= min_points):
+        ny = (ny + 1)//2
+        nx = (nx + 1)//2
+        levels += 1
+    return levels
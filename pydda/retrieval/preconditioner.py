@@ -0,0 +1,179 @@
+"""
+Spectral preconditioner for the retrieval.
+
+The weights of the constraints differ by orders of magnitude, and the mass
+continuity and smoothness constraints couple neighbouring points, so the
+Hessian of the cost function is badly conditioned. On a periodic grid
+both constraints are diagonalized by the Fourier transform: the smoothness
+constraint is made of wrapped Laplacians, and the mass continuity
+constraint, without its anelastic term, becomes a rank one 3 x 3 block
+coupling u, v and w at each wavenumber. Adding the mean of the diagonal of
+the radial velocity and background constraints to each component gives a
+symmetric positive definite 3 x 3 block per wavenumber that approximates
+the Hessian. Its inverse is used as the preconditioner of the conjugate
+gradient solver, and its inverse square root as a change of variables for
+L-BFGS-B.
+"""
+
+import numpy as np
+
+from scipy.sparse.linalg import LinearOperator
+
+from .linear_solver import boundary_projection
+
+
+def _difference_symbols(grid_shape, dx, dy, dz):
+    """
+    Returns the symbols, on the grid of np.fft.rfftn, of the centered first
+    difference (without the factor i) along z, y and x and of the wrapped
+    Laplacian with unit spacing.
+    """
+    spacings = (dz, dy, dx)
+    first = []
+    laplacian = 0
+    for axis, n in enumerate(grid_shape):
+        if(axis == 2):
+            theta = 2*np.pi*np.fft.rfftfreq(n)
+        else:
+            theta = 2*np.pi*np.fft.fftfreq(n)
+        shape = [1, 1, 1]
+        shape[axis] = len(theta)
+        theta = theta.reshape(shape)
+        first.append(np.sin(theta)/spacings[axis])
+        laplacian = laplacian + 2*np.cos(theta) - 2
+    shape = np.broadcast(*first).shape
+    first = [np.broadcast_to(s, shape) for s in first]
+    return first, np.broadcast_to(laplacian, shape)
+
+
+class SpectralPreconditioner(LinearOperator):
+    """
+    Preconditioner from a Fourier diagonalized approximation of the
+    Hessian of the cost function.
+
+    Calling :py:meth:`matvec` applies the inverse of the approximation
+    with the fixed boundary points of w projected out, so the object can be
+    passed as M to scipy.sparse.linalg.cg. :py:meth:`sqrt_matvec` applies
+    the inverse square root, which is used for the change of variables
+    winds = winds0 + sqrt_matvec(y) in :py:class:`ChangeOfVariables`.
+
+    Parameters
+    ----------
+    cost_function: ConstraintRegistry
+        The set up constraints of the retrieval. The radial velocity,
+        mass continuity, smoothness and background constraints are
+        included in the approximation; other constraints are left out.
+    upper_bc: bool
+        True if w is also fixed at the top of the domain
+    """
+    def __init__(self, cost_function, upper_bc=True):
+        grid_shape = cost_function.grid_shape
+        n = 3*int(np.prod(grid_shape))
+        LinearOperator.__init__(self, np.float64, (n, n))
+        self.grid_shape = grid_shape
+        self.free = boundary_projection(grid_shape, upper_bc)
+
+        # Mean diagonal of the point wise constraints for u, v and w
+        diagonal = np.zeros(3)
+        if 'Jvel' in cost_function and cost_function['Jvel'].active:
+            data = cost_function['Jvel']
+            lambda_o = 2*data.coeff/(data.rmsVr*data.rmsVr)
+            for obs in data.observations:
+                weight = obs.weight.astype(np.float64)
+                for i, coeff in enumerate([obs.x_coeff, obs.y_coeff,
+                                           obs.z_coeff]):
+                    diagonal[i] += lambda_o*np.sum(
+                        weight*np.square(coeff, dtype=np.float64))
+        if 'Jbg' in cost_function and cost_function['Jbg'].active:
+            background = cost_function['Jbg']
+            diagonal[:2] += 2*background.coeff*np.sum(
+                background.weights, dtype=np.float64)
+        diagonal /= np.prod(grid_shape)
+
+        first, laplacian = _difference_symbols(
+            grid_shape, cost_function.dx, cost_function.dy,
+            cost_function.dz)
+        blocks = np.zeros(laplacian.shape + (3, 3))
+        if 'Jsmooth' in cost_function and cost_function['Jsmooth'].active:
+            smooth = cost_function['Jsmooth']
+            for i, coeff in enumerate([smooth.Cx, smooth.Cy, smooth.Cz]):
+                blocks[..., i, i] += 2*coeff*np.square(laplacian)
+        if 'Jmass' in cost_function and cost_function['Jmass'].active:
+            # The components are ordered u, v, w and the symbols z, y, x
+            symbols = np.stack(first[::-1], axis=-1)
+            blocks += (cost_function['Jmass'].coeff *
+                       symbols[..., :, np.newaxis]*symbols[..., np.newaxis, :])
+
+        # Keep the blocks positive definite when some constraints are off
+        for i in range(3):
+            blocks[..., i, i] += diagonal[i]
+        floor = 1e-6*max(np.abs(blocks).max(), 1e-30)
+        eigenvalues, eigenvectors = np.linalg.eigh(blocks)
+        eigenvalues = np.maximum(eigenvalues, floor)
+        self.eigenvalues = eigenvalues
+        self.eigenvectors = eigenvectors
+        self.condition = eigenvalues.max()/eigenvalues.min()
+
+    def _apply(self, winds, power):
+        """
+        Multiplies the flattened wind field by the approximation raised to
+        power, without the projection.
+        """
+        winds = np.reshape(winds, (3,) + self.grid_shape)
+        spectrum = np.stack([np.fft.rfftn(winds[i]) for i in range(3)],
+                            axis=-1)
+        # V diag(lambda**power) V^T on every block
+        spectrum = np.einsum('...ji,...j->...i', self.eigenvectors,
+                             spectrum)
+        spectrum *= self.eigenvalues**power
+        spectrum = np.einsum('...ij,...j->...i', self.eigenvectors,
+                             spectrum)
+        return np.stack([np.fft.irfftn(spectrum[..., i], s=self.grid_shape)
+                         for i in range(3)]).reshape(-1)
+
+    def _matvec(self, r):
+        return self.free*self._apply(self.free*np.ravel(r), -1.0)
+
+    def sqrt_matvec(self, r):
+        """
+        Applies the inverse square root of the approximation, with the
+        fixed boundary points projected out, to the flattened r.
+        """
+        return self.free*self._apply(self.free*np.ravel(r), -0.5)
+
+    def _adjoint(self):
+        return self
+
+
+class ChangeOfVariables(object):
+    """
+    Cost function in the preconditioned variables y, where the wind field
+    is winds0 + T y and T is the inverse square root of a
+    :py:class:`SpectralPreconditioner`.
+
+    In these variables the Hessian is T H T, which is much better
+    conditioned than H, so L-BFGS-B needs far fewer iterations.
+
+    Parameters
+    ----------
+    cost_function: callable
+        Returns the cost and its gradient for a flattened wind field.
+    preconditioner: SpectralPreconditioner
+        The preconditioner
+    winds0: 1D float array
+        The wind field at y = 0
+    """
+    def __init__(self, cost_function, preconditioner, winds0):
+        self.cost_function = cost_function
+        self.preconditioner = preconditioner
+        self.winds0 = np.asarray(winds0, dtype=np.float64)
+
+    def winds(self, y):
+        """
+        Returns the flattened wind field at y.
+        """
+        return self.winds0 + self.preconditioner.sqrt_matvec(y)
+
+    def __call__(self, y):
+        J, grad = self.cost_function(self.winds(y))
+        return J, self.preconditioner.sqrt_matvec(grad)
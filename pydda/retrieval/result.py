@@ -0,0 +1,145 @@
+"""
+The result of a wind retrieval.
+"""
+
+import copy
+
+
+class RetrievalResult(object):
+    """
+    The wind field retrieved by get_dd_wind_field.
+
+    The wind components are held once, and the coordinates are shared with
+    the input Grids rather than copied. Py-ART Grids with the winds added,
+    as needed by pydda.vis or pyart.io.write_grid, are only made when
+    to_grids is called.
+
+    A pickled result, such as one returned by retrieve_many, leaves out
+    the fields of the input Grids and keeps only their coordinates and
+    metadata, so that sending it between processes costs little more
+    than the winds. The Grids from its to_grids then only hold the u, v
+    and w fields.
+
+    Attributes
+    ----------
+    u: 3D float array
+        Zonal component of the wind. Masked outside the multiple doppler
+        lobes if mask_outside_opt was set.
+    v: 3D float array
+        Meridional component of the wind, masked like u.
+    w: 3D float array
+        Vertical component of the wind. Masked outside the multiple doppler
+        lobes if mask_outside_opt or mask_w_outside_opt was set.
+    coverage: 3D uint8 array
+        Number of radars whose observations are used at each point.
+    x: dict
+        The x coordinate of the analysis grid, shared with the input Grids.
+    y: dict
+        The y coordinate of the analysis grid, shared with the input Grids.
+    z: dict
+        The z coordinate of the analysis grid, shared with the input Grids.
+    min_bca: float
+        Minimum beam crossing angle used in the retrieval in degrees.
+    max_bca: float
+        Maximum beam crossing angle used in the retrieval in degrees.
+    diagnostics: dict
+        Diagnostics of the retrieval: 'rmsVr', 'time', the wall time of
+        the solver in seconds, 'iterations' and 'evaluations', the numbers
+        of iterations of L-BFGS-B and of evaluations of the cost function,
+        and 'cost', the final value of the cost function. With multigrid,
+        'multigrid' holds the 'grid_shape', 'iterations', 'evaluations'
+        and 'cost' of each coarse level, coarsest first, and their
+        iterations and evaluations are included in the totals. With
+        tile_size, the tiles are solved separately, so these are replaced
+        by the lists 'tile_iterations', 'tile_evaluations' and
+        'tile_costs', with one entry per tile.
+    """
+    def __init__(self, u, v, w, coverage, Grids, vel_name, min_bca=30.0,
+                 max_bca=150.0, diagnostics=None):
+        self.u = u
+        self.v = v
+        self.w = w
+        self.coverage = coverage
+        self.x = Grids[0].x
+        self.y = Grids[0].y
+        self.z = Grids[0].z
+        self.min_bca = min_bca
+        self.max_bca = max_bca
+        if diagnostics is None:
+            diagnostics = {}
+        self.diagnostics = diagnostics
+        self._input_grids = list(Grids)
+        self._vel_name = vel_name
+        self._grids = None
+
+    @property
+    def grid_shape(self):
+        """
+        Shape (nz, ny, nx) of the analysis grid.
+        """
+        return self.u.shape
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Keep the metadata of the velocity field and the Grids without
+        # their fields
+        state['_vel_field'] = self._vel_metadata()
+        grids = []
+        for grid in self._input_grids:
+            new_grid = copy.copy(grid)
+            new_grid.fields = {}
+            grids.append(new_grid)
+        state['_input_grids'] = grids
+        state['_grids'] = None
+        return state
+
+    def _vel_metadata(self):
+        # The metadata of the velocity field without its data
+        if '_vel_field' in self.__dict__:
+            return self._vel_field
+        return dict((key, value) for key, value in
+                    self._input_grids[0].fields[self._vel_name].items()
+                    if key != 'data')
+
+    def _wind_field(self, data, standard_name, long_name):
+        field = dict(self._vel_metadata())
+        field['data'] = data
+        field['standard_name'] = standard_name
+        field['long_name'] = long_name
+        field['min_bca'] = self.min_bca
+        field['max_bca'] = self.max_bca
+        return field
+
+    def to_grids(self):
+        """
+        Returns a list of Py-ART Grids, one for each input Grid, with the
+        u, v and w fields added.
+
+        The Grids are made on the first call and reused afterwards. They
+        share the coordinates, the other fields and the wind arrays with
+        the input Grids and with this result instead of copying them, so
+        modifying their data in place modifies those too. For a result
+        that was pickled, the Grids only hold the wind fields.
+
+        Returns
+        -------
+        Grids: list of Py-ART Grids
+            The input Grids with the retrieved wind fields.
+        """
+        if self._grids is None:
+            u_field = self._wind_field(
+                self.u, 'u_wind', 'meridional component of wind velocity')
+            v_field = self._wind_field(
+                self.v, 'v_wind', 'zonal component of wind velocity')
+            w_field = self._wind_field(
+                self.w, 'w_wind', 'vertical component of wind velocity')
+            grids = []
+            for grid in self._input_grids:
+                new_grid = copy.copy(grid)
+                new_grid.fields = dict(grid.fields)
+                new_grid.fields['u'] = u_field
+                new_grid.fields['v'] = v_field
+                new_grid.fields['w'] = w_field
+                grids.append(new_grid)
+            self._grids = grids
+        return self._grids
@@ -0,0 +1,79 @@
+"""
+Synthetic radar volumes for validating and benchmarking the retrieval.
+"""
+
+import numpy as np
+import pyart
+
+from . import geometry
+
+
+def make_synthetic_grids(grid_shape=(10, 40, 40), noise=0.5,
+                         missing=0.2, seed=0, offset=(0.0, 0.0)):
+    """
+    Makes the Grids of two radars observing a known wind field.
+
+    The wind field is smooth and varies in all three directions. The
+    radial velocities of each radar are its projection on the beams of
+    that radar, plus Gaussian noise, with a random fraction of the points
+    masked. The reflectivity is -40 dBZ everywhere, so the fall speed is
+    negligible.
+
+    Parameters
+    ----------
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the grids. The grids span 0.5 to 9.5 km in
+        z and 40 km in x and y.
+    noise: float
+        Standard deviation of the noise added to the radial velocities in
+        m/s.
+    missing: float
+        Fraction of the points of each radar with no radial velocity.
+    seed: int
+        Seed of the random number generator
+    offset: 2-tuple of floats
+        Distance in m the wind field is moved by in x and y, to make a
+        later volume of a moving storm.
+
+    Returns
+    -------
+    Grids: list of Py-ART Grids
+        The Grids of the two radars, with the 'corrected_velocity' and
+        'reflectivity' fields.
+    winds: tuple of 3D float arrays
+        The true u, v and w.
+    """
+    limits = ((500.0, 9500.0), (-20000.0, 20000.0), (-20000.0, 20000.0))
+    Grids = []
+    for lon, lat in [(-97.6, 36.45), (-97.2, 36.65)]:
+        grid = pyart.testing.make_empty_grid(grid_shape, limits)
+        grid.radar_longitude['data'] = np.array([lon])
+        grid.radar_latitude['data'] = np.array([lat])
+        grid.radar_altitude['data'] = np.array([0.0])
+        grid.origin_longitude['data'] = np.array([-97.4])
+        grid.origin_latitude['data'] = np.array([36.55])
+        grid.init_point_longitude_latitude()
+        grid.init_point_altitude()
+        Grids.append(grid)
+
+    x = Grids[0].point_x['data'] - offset[0]
+    y = Grids[0].point_y['data'] - offset[1]
+    z = Grids[0].point_z['data']
+    u = 10 + 3*np.sin(x/8000.0)*np.cos(z/5000.0)
+    v = 5 + 2*np.cos(y/7000.0)
+    w = np.sin(x/6000.0)*np.sin(np.pi*z/10000.0)
+
+    rng = np.random.RandomState(seed)
+    for grid in Grids:
+        az = np.ma.getdata(geometry.get_azimuth(grid))
+        el = np.ma.getdata(geometry.get_elevation(grid))
+        vr = (np.cos(el)*np.sin(az)*u + np.cos(el)*np.cos(az)*v +
+              np.sin(el)*w + noise*rng.randn(*grid_shape))
+        vr = np.ma.masked_where(rng.rand(*grid_shape) < missing, vr)
+        grid.add_field('corrected_velocity', {'data': vr},
+                       replace_existing=True)
+        grid.add_field('reflectivity',
+                       {'data': np.ma.masked_array(
+                           np.full(grid_shape, -40.0))},
+                       replace_existing=True)
+    return Grids, (u, v, w)
@@ -0,0 +1,52 @@
+"""
+Checks that retrieve_many reports a volume that fails, or that kills its
+worker, without losing the results of the other volumes.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from pydda.retrieval import batch, retrieve_many
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+KWARGS = dict(Co=1.0, Cm=1500.0, Cx=1e-2, Cy=1e-2, Cz=1e-2, frz=5000.0,
+              filt_iterations=0, mask_w_outside_opt=False,
+              max_iterations=10)
+
+
+class _KillWorker(object):
+    # Unpickling this in the worker ends the worker process at once
+    def __reduce__(self):
+        return (os._exit, (1,))
+
+
+def test_failures_are_isolated():
+    Grids, _ = make_synthetic_grids((4, 12, 12))
+    tasks = [Grids,
+             {'Grids': Grids, 'vel_name': 'missing_velocity'},
+             Grids,
+             {'Grids': Grids, 'kill_worker': _KillWorker()},
+             Grids]
+    results = list(retrieve_many(tasks, max_workers=2, **KWARGS))
+
+    assert sorted(result.index for result in results) == list(range(5))
+    by_index = dict((result.index, result) for result in results)
+    for index in [0, 2, 4]:
+        assert by_index[index].ok
+        assert by_index[index].result.diagnostics['iterations'] > 0
+        np.testing.assert_array_equal(by_index[index].result.u,
+                                      by_index[0].result.u)
+    assert not by_index[1].ok
+    assert 'missing_velocity' in by_index[1].error
+    assert not by_index[3].ok
+    assert 'BrokenProcessPool' in by_index[3].error
+
+
+def test_bad_context_fails_at_call(monkeypatch):
+    with pytest.raises(ValueError):
+        retrieve_many([], mp_context='no_such_method')
+    monkeypatch.setattr(batch, 'threadpoolctl', None)
+    with pytest.raises(ValueError):
+        retrieve_many([], mp_context='forkserver')
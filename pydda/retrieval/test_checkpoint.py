@@ -0,0 +1,89 @@
+"""
+Checks that a retrieval resumed from its checkpoint gives exactly the
+result of the uninterrupted run, and that a checkpoint of another
+retrieval is ignored.
+"""
+
+import numpy as np
+import pytest
+
+from pydda.initialization import make_constant_wind_field
+from pydda.retrieval import checkpoint, get_dd_wind_field
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+
+class _Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(scope='module')
+def grids():
+    return make_synthetic_grids((10, 16, 16))[0]
+
+
+def _retrieve(Grids, checkpoint_file, **kwargs):
+    u_init, v_init, w_init = make_constant_wind_field(Grids[0])
+    settings = dict(Co=1.0, Cm=1500.0, Cx=1e-2, Cy=1e-2, Cz=1e-2,
+                    frz=5000.0, filt_iterations=2, mask_w_outside_opt=False,
+                    max_iterations=60, checkpoint_file=checkpoint_file,
+                    checkpoint_interval=10)
+    settings.update(kwargs)
+    return get_dd_wind_field(Grids, u_init, v_init, w_init, **settings)
+
+
+def _interrupt_after(monkeypatch, stage):
+    # Stops the retrieval once the first checkpoint of stage is written
+    save = checkpoint.Checkpoint.save
+
+    def save_and_stop(self, winds, saved_stage, *args):
+        save(self, winds, saved_stage, *args)
+        if saved_stage == stage:
+            raise _Interrupted()
+
+    monkeypatch.setattr(checkpoint.Checkpoint, 'save', save_and_stop)
+
+
+def _assert_same(result, expected):
+    for name in ['u', 'v', 'w']:
+        np.testing.assert_array_equal(getattr(result, name),
+                                      getattr(expected, name))
+    for name in ['iterations', 'evaluations', 'cost']:
+        assert result.diagnostics[name] == expected.diagnostics[name]
+
+
+@pytest.mark.parametrize('stage', [checkpoint.SOLVE, checkpoint.FILTERED])
+def test_resume_matches_uninterrupted(grids, tmp_path, monkeypatch, capsys,
+                                      stage):
+    expected = _retrieve(grids, str(tmp_path/'full.npz'))
+    assert expected.diagnostics['iterations'] > 20
+
+    path = str(tmp_path/'interrupted.npz')
+    with monkeypatch.context() as m:
+        _interrupt_after(m, stage)
+        with pytest.raises(_Interrupted):
+            _retrieve(grids, path)
+    with np.load(path) as data:
+        assert int(data['stage']) == stage
+        if stage == checkpoint.SOLVE:
+            assert int(data['iterations']) == 10
+    capsys.readouterr()
+
+    result = _retrieve(grids, path)
+    assert 'Resuming from checkpoint' in capsys.readouterr().out
+    _assert_same(result, expected)
+
+
+@pytest.mark.parametrize('change', [{'Cm': 1000.0}, {'min_bca': 40.0}])
+def test_other_retrieval_ignored(grids, tmp_path, monkeypatch, capsys,
+                                 change):
+    path = str(tmp_path/'interrupted.npz')
+    with monkeypatch.context() as m:
+        _interrupt_after(m, checkpoint.SOLVE)
+        with pytest.raises(_Interrupted):
+            _retrieve(grids, path)
+    capsys.readouterr()
+
+    result = _retrieve(grids, path, **change)
+    assert 'from a different retrieval' in capsys.readouterr().out
+    expected = _retrieve(grids, str(tmp_path/'fresh.npz'), **change)
+    _assert_same(result, expected)
@@ -0,0 +1,127 @@
+"""
+Checks the cached radar geometry and the vectorized weights against the
+per-pair computation they replace.
+"""
+
+import copy
+import math
+
+import numpy as np
+import pytest
+
+from pydda.retrieval import angles, geometry
+from pydda.retrieval import get_bca, get_pairwise_bca, get_weights
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+MIN_BCA = 30.0
+MAX_BCA = 150.0
+
+
+def _make_grids():
+    Grids, _ = make_synthetic_grids((4, 24, 24))
+    # A third radar north of the others, with data in other places
+    third = copy.deepcopy(Grids[0])
+    third.radar_longitude['data'] = np.array([-97.4])
+    third.radar_latitude['data'] = np.array([36.8])
+    third.init_point_longitude_latitude()
+    vr = third.fields['corrected_velocity']['data']
+    rng = np.random.RandomState(3)
+    third.fields['corrected_velocity']['data'] = np.ma.masked_where(
+        rng.rand(*vr.shape) < 0.5, np.ma.getdata(vr))
+    Grids.append(third)
+    for grid in Grids:
+        grid.fields['reflectivity']['_FillValue'] = -9999.0
+    return Grids
+
+
+def _reference_weights(Grids, vrs):
+    """
+    The weights of the per-pair loop of get_dd_wind_field before the
+    weights were vectorized. That loop wrote the background weights of
+    each level into bg_weights[i], the index of the first radar; here they
+    stay in bg_weights[k] as get_weights defines them.
+    """
+    weights = np.zeros((len(Grids),) + vrs[0].shape)
+    bg_weights = np.zeros(vrs[0].shape)
+    bca = np.zeros((len(Grids), len(Grids)) + vrs[0].shape[1:])
+    for i in range(len(Grids)):
+        for j in range(i+1, len(Grids)):
+            bca[i, j] = get_bca(
+                Grids[i].radar_longitude['data'],
+                Grids[i].radar_latitude['data'],
+                Grids[j].radar_longitude['data'],
+                Grids[j].radar_latitude['data'],
+                Grids[i].point_x['data'][0], Grids[i].point_y['data'][0],
+                Grids[i].get_projparams())
+            in_range = np.logical_and(bca[i, j] >= math.radians(MIN_BCA),
+                                      bca[i, j] <= math.radians(MAX_BCA))
+            for k in range(vrs[i].shape[0]):
+                weights[i, k][np.logical_and(
+                    vrs[i][k].mask == False, in_range)] += 1
+                weights[j, k][np.logical_and(
+                    vrs[j][k].mask == False, in_range)] += 1
+                bg_weights[k][np.logical_or(
+                    bca[i, j] >= math.radians(MIN_BCA),
+                    bca[i, j] <= math.radians(MAX_BCA))] = 1
+                bg_weights[k][vrs[i][k].mask == True] = 0
+    weights[weights > 0] = 1
+    return bca, weights, bg_weights
+
+
+def test_geometry_matches_angle_fields():
+    Grids = _make_grids()
+    cache = geometry.GeometryCache()
+    for grid in Grids:
+        reference = copy.deepcopy(grid)
+        angles.add_azimuth_as_field(reference, dz_name='reflectivity')
+        angles.add_elevation_as_field(reference, dz_name='reflectivity')
+        np.testing.assert_allclose(
+            geometry.get_azimuth(grid, cache),
+            reference.fields['AZ']['data']*np.pi/180, rtol=1e-12)
+        np.testing.assert_allclose(
+            geometry.get_elevation(grid, cache),
+            reference.fields['EL']['data']*np.pi/180, rtol=1e-12)
+
+
+def test_weights_match_pair_loop():
+    Grids = _make_grids()
+    vrs = [grid.fields['corrected_velocity']['data'] for grid in Grids]
+    bca, ref_weights, ref_bg_weights = _reference_weights(Grids, vrs)
+
+    pairs, pairwise_bca = get_pairwise_bca(Grids)
+    assert pairs == [(0, 1), (0, 2), (1, 2)]
+    for p, (i, j) in enumerate(pairs):
+        np.testing.assert_allclose(pairwise_bca[p], bca[i, j], rtol=1e-10)
+    weights, bg_weights = get_weights(vrs, pairs, pairwise_bca, MIN_BCA,
+                                      MAX_BCA)
+    np.testing.assert_array_equal(weights, ref_weights)
+    np.testing.assert_array_equal(bg_weights, ref_bg_weights)
+
+
+def test_directory_cache_loads_memory_maps(tmp_path):
+    Grids = _make_grids()
+    first = geometry.GeometryCache(directory=str(tmp_path))
+    az = geometry.get_azimuth(Grids[2], first)
+    el = geometry.get_elevation(Grids[2], first)
+    pairs, bca = geometry.get_cached_pairwise_bca(Grids, first)
+    assert first.misses == 3
+
+    def compute():
+        pytest.fail('the array was computed again')
+
+    # A new cache on the same directory, as in another process
+    second = geometry.GeometryCache(directory=str(tmp_path))
+    key = geometry.grid_spec_key(Grids[2])
+    for name, expected in [('AZ', np.ma.getdata(az)[0]),
+                           ('EL', np.ma.getdata(el))]:
+        loaded = second.get((name, key), compute)
+        assert isinstance(loaded, np.memmap)
+        assert not loaded.flags.writeable
+        np.testing.assert_array_equal(loaded, expected)
+    assert np.ma.allequal(geometry.get_azimuth(Grids[2], second), az)
+    pairs_again, bca_again = geometry.get_cached_pairwise_bca(Grids, second)
+    assert isinstance(bca_again, np.memmap)
+    assert pairs_again == pairs
+    np.testing.assert_array_equal(bca_again, bca)
+    np.testing.assert_array_equal(bca_again, get_pairwise_bca(Grids)[1])
+    assert second.misses == 0
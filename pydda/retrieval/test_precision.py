@@ -0,0 +1,56 @@
+"""
+Checks that float32 retrievals of a synthetic case stay close to float64.
+"""
+
+import numpy as np
+import pytest
+
+from pydda.initialization import make_constant_wind_field
+from pydda.retrieval import get_dd_wind_field
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+# Maximum difference in m/s between the float32 and float64 winds of a
+# retrieval run to its minimum
+CONVERGED_TOLERANCE = 0.1
+# Maximum increase in m/s of the RMS error against the true winds of a
+# float32 retrieval stopped by the convergence check on w
+ERROR_TOLERANCE = 0.25
+
+
+def _retrieve(Grids, precision, backend, **kwargs):
+    u_init, v_init, w_init = make_constant_wind_field(Grids[0])
+    return get_dd_wind_field(
+        Grids, u_init, v_init, w_init, Co=1.0, Cm=1500.0, Cx=1e-2,
+        Cy=1e-2, Cz=1e-2, frz=5000.0, filt_iterations=0,
+        mask_w_outside_opt=False, precision=precision, backend=backend,
+        **kwargs)
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_float32_converged_retrieval(backend):
+    # With the spectral preconditioner L-BFGS-B reaches the minimum, so
+    # the difference is only due to the precision
+    Grids, winds = make_synthetic_grids((10, 40, 40))
+    result64 = _retrieve(Grids, 'float64', backend,
+                         preconditioner='spectral')
+    result32 = _retrieve(Grids, 'float32', backend,
+                         preconditioner='spectral')
+    for name in ['u', 'v', 'w']:
+        difference = np.abs(np.ma.getdata(getattr(result32, name)) -
+                            np.ma.getdata(getattr(result64, name)))
+        assert difference.max() < CONVERGED_TOLERANCE, name
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+def test_float32_default_retrieval(backend):
+    # The convergence check on w can stop the two retrievals at different
+    # iterations, so compare their errors against the true winds instead
+    Grids, winds = make_synthetic_grids((10, 40, 40))
+    result64 = _retrieve(Grids, 'float64', backend)
+    result32 = _retrieve(Grids, 'float32', backend)
+    for name, truth in zip(['u', 'v', 'w'], winds):
+        error64 = np.sqrt(np.mean(np.square(
+            np.ma.getdata(getattr(result64, name)) - truth)))
+        error32 = np.sqrt(np.mean(np.square(
+            np.ma.getdata(getattr(result32, name)) - truth)))
+        assert error32 < error64 + ERROR_TOLERANCE, name
@@ -0,0 +1,118 @@
+"""
+Checks that RetrievalResult.to_grids makes the Grids get_dd_wind_field
+used to return, and that pickled results still make them.
+"""
+
+import copy
+import pickle
+
+import numpy as np
+import pytest
+
+from pydda.initialization import make_constant_wind_field
+from pydda.retrieval import get_dd_wind_field
+from pydda.retrieval.synthetic import make_synthetic_grids
+
+
+@pytest.fixture(scope='module')
+def retrieval():
+    Grids, _ = make_synthetic_grids((4, 12, 12))
+    for grid in Grids:
+        grid.fields['corrected_velocity'].update(
+            units='meters_per_second', _FillValue=-9999.0,
+            coordinates='elevation azimuth range')
+    u_init, v_init, w_init = make_constant_wind_field(Grids[0])
+    result = get_dd_wind_field(
+        Grids, u_init, v_init, w_init, Co=1.0, Cm=1500.0, frz=5000.0,
+        filt_iterations=0, mask_w_outside_opt=False, max_iterations=10,
+        min_bca=25.0, max_bca=155.0)
+    return Grids, result
+
+
+def _old_grids(Grids, result):
+    # The Grids get_dd_wind_field returned before RetrievalResult
+    fields = []
+    for data, standard_name, long_name in [
+            (result.u, 'u_wind', 'meridional component of wind velocity'),
+            (result.v, 'v_wind', 'zonal component of wind velocity'),
+            (result.w, 'w_wind', 'vertical component of wind velocity')]:
+        field = copy.deepcopy(Grids[0].fields['corrected_velocity'])
+        field['data'] = data
+        field['standard_name'] = standard_name
+        field['long_name'] = long_name
+        field['min_bca'] = 25.0
+        field['max_bca'] = 155.0
+        fields.append(field)
+    new_grid_list = []
+    for grid in Grids:
+        temp_grid = copy.deepcopy(grid)
+        for name, field in zip(['u', 'v', 'w'], fields):
+            temp_grid.add_field(name, field, replace_existing=True)
+        new_grid_list.append(temp_grid)
+    return new_grid_list
+
+
+def _assert_fields_equal(field, expected):
+    assert sorted(field) == sorted(expected)
+    for key in expected:
+        if key == 'data':
+            assert np.ma.allequal(field['data'], expected['data'])
+        else:
+            assert field[key] == expected[key]
+
+
+def test_to_grids_matches_old_output(retrieval):
+    Grids, result = retrieval
+    grids = result.to_grids()
+    expected = _old_grids(Grids, result)
+    assert len(grids) == len(expected)
+    for grid, old_grid in zip(grids, expected):
+        assert sorted(grid.fields) == sorted(old_grid.fields)
+        for name in old_grid.fields:
+            _assert_fields_equal(grid.fields[name], old_grid.fields[name])
+        np.testing.assert_array_equal(grid.point_x['data'],
+                                      old_grid.point_x['data'])
+        np.testing.assert_array_equal(grid.radar_longitude['data'],
+                                      old_grid.radar_longitude['data'])
+
+
+def test_to_grids_shares_arrays(retrieval):
+    Grids, result = retrieval
+    grids = result.to_grids()
+    assert result.to_grids() is grids
+    for grid, input_grid in zip(grids, Grids):
+        assert grid is not input_grid
+        assert 'u' not in input_grid.fields
+        assert grid.fields['u']['data'] is result.u
+        assert grid.fields['v']['data'] is result.v
+        assert grid.fields['w']['data'] is result.w
+        assert (grid.fields['corrected_velocity'] is
+                input_grid.fields['corrected_velocity'])
+        assert grid.x is input_grid.x
+        assert grid.z is input_grid.z
+    assert result.z is Grids[0].z
+
+
+def test_pickle_drops_input_fields(retrieval):
+    Grids, result = retrieval
+    data = pickle.dumps(result)
+    loaded = pickle.loads(data)
+    assert len(data) < len(pickle.dumps(Grids))
+    for name in ['u', 'v', 'w', 'coverage']:
+        assert np.ma.allequal(getattr(loaded, name), getattr(result, name))
+    assert loaded.diagnostics == result.diagnostics
+    assert all(grid.fields == {} for grid in loaded._input_grids)
+    # The result that was pickled keeps its input fields
+    assert 'corrected_velocity' in result._input_grids[0].fields
+
+    expected = result.to_grids()
+    grids = loaded.to_grids()
+    assert len(grids) == len(expected)
+    for grid, old_grid in zip(grids, expected):
+        assert sorted(grid.fields) == ['u', 'v', 'w']
+        for name in ['u', 'v', 'w']:
+            _assert_fields_equal(grid.fields[name], old_grid.fields[name])
+        np.testing.assert_array_equal(grid.point_x['data'],
+                                      old_grid.point_x['data'])
+        np.testing.assert_array_equal(grid.point_latitude['data'],
+                                      old_grid.point_latitude['data'])
@@ -0,0 +1,51 @@
+"""
+Checks the blending weights of the tiles and that a tiled retrieval stays
+close to the monolithic one at the seams.
+"""
+
+import numpy as np
+import pytest
+
+from pydda.initialization import make_constant_wind_field
+from pydda.retrieval import get_dd_wind_field
+from pydda.retrieval.synthetic import make_synthetic_grids
+from pydda.retrieval.tiling import make_tiles, tile_seam_diagnostic
+
+# Largest difference in m/s from the monolithic retrieval at the seams
+MAX_SEAM_DIFFERENCE = {'u': 2.0, 'v': 2.0, 'w': 0.1}
+
+
+@pytest.mark.parametrize('grid_shape, tile_size, overlap', [
+    ((2, 32, 32), 16, 4),
+    ((2, 37, 29), 10, 3),
+    ((2, 23, 41), (7, 12), 5),
+    ((2, 37, 29), 10, 0),
+    ((2, 20, 20), 40, 8)])
+def test_weights_sum_to_one(grid_shape, tile_size, overlap):
+    total_weight = np.zeros(grid_shape[1:])
+    for ys, xs, weight in make_tiles(grid_shape, tile_size, overlap):
+        assert weight.shape == total_weight[ys, xs].shape
+        assert np.all(weight >= 0.0)
+        total_weight[ys, xs] += weight
+    np.testing.assert_allclose(total_weight, 1.0, rtol=1e-12)
+
+
+def test_seams_close_to_monolithic():
+    Grids, _ = make_synthetic_grids((6, 32, 32))
+    u_init, v_init, w_init = make_constant_wind_field(Grids[0])
+    kwargs = dict(Co=1.0, Cm=1500.0, Cx=1e-2, Cy=1e-2, Cz=1e-2,
+                  frz=5000.0, filt_iterations=0, mask_w_outside_opt=False,
+                  max_iterations=1000, preconditioner='spectral')
+    reference = get_dd_wind_field(Grids, u_init, v_init, w_init, **kwargs)
+    tiled = get_dd_wind_field(Grids, u_init, v_init, w_init, tile_size=16,
+                              tile_overlap=6, tile_workers=1, **kwargs)
+    assert len(tiled.diagnostics['tile_iterations']) == 4
+
+    diagnostic = tile_seam_diagnostic(tiled, 16, 6, reference=reference)
+    for name in ['u', 'v', 'w']:
+        assert (diagnostic[name]['max_seam_difference'] <
+                MAX_SEAM_DIFFERENCE[name])
+    # The blending leaves no step at the seams
+    for name in ['u', 'v']:
+        assert (diagnostic[name]['seam_roughness'] <
+                2*diagnostic[name]['interior_roughness'])
@@ -0,0 +1,263 @@
+"""
+Horizontally tiled retrievals.
+
+The analysis grid is split into tiles of about tile_size points in y and x,
+each extended by overlap points on the sides it shares with other tiles.
+Each tile is retrieved independently, and the tiles are blended with
+weights that fall from 1 to 0 across the 2*overlap points around each
+shared edge.
+The weights of two neighbouring tiles sum to 1 there, so the blended field
+is continuous across the seams.
+"""
+
+import multiprocessing
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .batch import _limit_threads, _thread_environment
+
+
+def _ramp(t):
+    """
+    Smooth step from 0 at t <= 0 to 1 at t >= 1.
+    """
+    return np.sin(0.5*np.pi*np.clip(t, 0.0, 1.0))**2
+
+
+def _axis_tiles(n, core, overlap):
+    """
+    Returns the extents and blending weights of the tiles along an axis of
+    n points.
+    """
+    n_tiles = max(1, int(round(n/float(core))))
+    edges = np.linspace(0, n, n_tiles + 1).round().astype(int)
+    # The ramps at the two edges of a tile must not overlap, or the
+    # weights no longer sum to 1
+    overlap = min(overlap, np.diff(edges).min()//2)
+    tiles = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        lo = max(start - overlap, 0)
+        hi = min(stop + overlap, n)
+        j = np.arange(lo, hi) + 0.5
+        weight = np.ones(hi - lo)
+        if overlap > 0:
+            if start > 0:
+                weight *= _ramp((j - (start - overlap))/(2.0*overlap))
+            if stop < n:
+                weight *= 1 - _ramp((j - (stop - overlap))/(2.0*overlap))
+        tiles.append((slice(lo, hi), weight))
+    return tiles
+
+
+def make_tiles(grid_shape, tile_size, overlap=8):
+    """
+    Splits a grid into overlapping horizontal tiles.
+
+    Parameters
+    ----------
+    grid_shape: tuple
+        Shape (nz, ny, nx) of the analysis grid.
+    tile_size: int or 2-tuple of ints
+        Approximate number of points in y and x of each tile, before adding
+        the overlap. The points of each axis are split evenly between the
+        tiles.
+    overlap: int
+        Number of points each tile extends past its edges shared with
+        other tiles. It is reduced to half the tile size along an axis
+        whose tiles are shorter than 2*overlap points.
+
+    Returns
+    -------
+    tiles: list of tuples
+        The (y slice, x slice, weight) of each tile, where weight is the 2D
+        blending weight of the points of the tile.
+    """
+    if np.isscalar(tile_size):
+        tile_size = (tile_size, tile_size)
+    tiles = []
+    for ys, wy in _axis_tiles(grid_shape[1], int(tile_size[0]), overlap):
+        for xs, wx in _axis_tiles(grid_shape[2], int(tile_size[1]),
+                                  overlap):
+            tiles.append((ys, xs, np.outer(wy, wx)))
+    return tiles
+
+
+def _solve_tile(inputs, winds, cost_kwargs, max_iterations,
+                filt_iterations, solver='lbfgs', preconditioner=None):
+    """
+    Retrieves the winds of one tile.
+    """
+    from .wind_retrieve import _fused_cost_function, _solve
+
+    cost_function = _fused_cost_function(*inputs, **cost_kwargs)
+    diagnostics = {}
+    winds = _solve(cost_function, winds, (), None, inputs[-1].shape,
+                   max_iterations, filt_iterations, cost_kwargs['dtype'],
+                   diagnostics, solver=solver,
+                   upper_bc=cost_kwargs['upper_bc'],
+                   preconditioner=preconditioner)
+    return winds, diagnostics
+
+
+def solve_tiles(winds, inputs, cost_kwargs, max_iterations,
+                filt_iterations, tile_size, overlap=8, n_workers=None,
+                diagnostics=None, solver='lbfgs', preconditioner=None):
+    """
+    Retrieves the winds tile by tile and blends the tiles.
+
+    Parameters
+    ----------
+    winds: 4D float array
+        Initial guess of the (u, v, w) wind field.
+    inputs: tuple
+        The (vrs, azs, els, wts, weights, bg_weights, z) of the retrieval.
+    cost_kwargs: dict
+        Keyword arguments of the cost function other than its inputs.
+    max_iterations: int
+        Maximum number of iterations before the low pass filter.
+    filt_iterations: int
+        Number of passes of 10 iterations after the low pass filter.
+    tile_size: int or 2-tuple of ints
+        Number of points in y and x of each tile, before adding the
+        overlap.
+    overlap: int
+        Number of points each tile extends past its shared edges.
+    n_workers: int or None
+        Number of processes solving tiles at the same time. 1 solves the
+        tiles one after the other in this process. None uses one process
+        per CPU, up to the number of tiles.
+    diagnostics: dict or None
+        If given, the iterations, evaluations and final cost of each tile,
+        in the order of make_tiles, are stored in it as the lists
+        'tile_iterations', 'tile_evaluations' and 'tile_costs'.
+    solver: str
+        'lbfgs' or 'cg', the solver of each tile.
+    preconditioner: str or None
+        None or 'spectral', the preconditioner of each tile.
+
+    Returns
+    -------
+    winds: 4D float array
+        The blended wind field.
+    """
+    vrs, azs, els, wts, weights, bg_weights, z = inputs
+    grid_shape = z.shape
+    tiles = make_tiles(grid_shape, tile_size, overlap)
+    print('Retrieving ' + str(len(tiles)) + ' tiles')
+
+    def tile_job(ys, xs):
+        tile_inputs = ([vr[:, ys, xs] for vr in vrs],
+                       [az[:, ys, xs] for az in azs],
+                       [el[:, ys, xs] for el in els],
+                       [wt[:, ys, xs] for wt in wts],
+                       weights[:, :, ys, xs], bg_weights[:, ys, xs],
+                       z[:, ys, xs])
+        tile_winds = winds[:, :, ys, xs].flatten()
+        return (tile_inputs, tile_winds, cost_kwargs, max_iterations,
+                filt_iterations, solver, preconditioner)
+
+    blended = np.zeros(winds.shape, dtype=np.float64)
+    total_weight = np.zeros(grid_shape[1:], dtype=np.float64)
+
+    # The tiles are solved in parallel and their costs cover overlapping
+    # regions, so their diagnostics are kept per tile rather than summed
+    tile_diagnostics = [None]*len(tiles)
+
+    def add_tile(index, tile_result):
+        tile_winds, tile_diagnostics[index] = tile_result
+        ys, xs, weight = tiles[index]
+        tile_shape = (3, grid_shape[0]) + weight.shape
+        blended[:, :, ys, xs] += np.reshape(tile_winds, tile_shape)*weight
+        total_weight[ys, xs] += weight
+
+    if n_workers is None:
+        n_workers = min(multiprocessing.cpu_count(), len(tiles))
+    if n_workers == 1:
+        for index, tile in enumerate(tiles):
+            add_tile(index, _solve_tile(*tile_job(tile[0], tile[1])))
+    else:
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                                 initializer=_limit_threads,
+                                 initargs=(1,)) as executor:
+            jobs = [tile_job(tile[0], tile[1]) for tile in tiles]
+            futures = {}
+            with _thread_environment(1):
+                for index, job in enumerate(jobs):
+                    futures[executor.submit(_solve_tile, *job)] = index
+            for future in as_completed(futures):
+                add_tile(futures.pop(future), future.result())
+
+    if(diagnostics is not None):
+        for key, name in [('tile_iterations', 'iterations'),
+                          ('tile_evaluations', 'evaluations'),
+                          ('tile_costs', 'cost')]:
+            diagnostics[key] = [tile.get(name) for tile in tile_diagnostics]
+    return (blended/total_weight).astype(winds.dtype)
+
+
+def tile_seam_diagnostic(Grids, tile_size, overlap=8, reference=None):
+    """
+    This function measures the discontinuities left at the tile seams of a
+    tiled retrieval.
+
+    The seams are the points in the overlap of two or more tiles. The
+    roughness of a wind component is the mean absolute value of its
+    horizontal five point Laplacian, which jumps at a seam that is not
+    blended smoothly. If the winds of a monolithic retrieval are given, the
+    mean and maximum absolute differences from them are also reported.
+
+    Parameters
+    ----------
+    Grids: RetrievalResult or list of Py-ART Grids
+        The result of get_dd_wind_field with tile_size set, or the Grids
+        made from it.
+    tile_size: int or 2-tuple of ints
+        The tile_size of the retrieval.
+    overlap: int
+        The tile_overlap of the retrieval.
+    reference: RetrievalResult, list of Py-ART Grids or None
+        The result of get_dd_wind_field for the same inputs without tiles.
+
+    Returns
+    -------
+    diagnostic: dict
+        For each of 'u', 'v' and 'w', a dict with 'seam_roughness' and
+        'interior_roughness', and if reference is given 'seam_difference',
+        'interior_difference' and 'max_seam_difference'.
+    """
+    if hasattr(Grids, 'to_grids'):
+        Grids = Grids.to_grids()
+    if hasattr(reference, 'to_grids'):
+        reference = reference.to_grids()
+    grid = Grids[0]
+    grid_shape = grid.fields['u']['data'].shape
+    coverage = np.zeros(grid_shape[1:], dtype=int)
+    for ys, xs, weight in make_tiles(grid_shape, tile_size, overlap):
+        coverage[ys, xs] += 1
+    seam = np.broadcast_to(coverage > 1, grid_shape)
+
+    diagnostic = {}
+    for name in ['u', 'v', 'w']:
+        field = np.ma.masked_invalid(grid.fields[name]['data'])
+        laplacian = np.ma.masked_all(grid_shape)
+        laplacian[:, 1:-1, 1:-1] = (
+            field[:, 2:, 1:-1] + field[:, :-2, 1:-1] + field[:, 1:-1, 2:] +
+            field[:, 1:-1, :-2] - 4*field[:, 1:-1, 1:-1])
+        laplacian = np.ma.abs(laplacian)
+        result = {
+            'seam_roughness': float(np.ma.mean(laplacian[seam])),
+            'interior_roughness': float(np.ma.mean(laplacian[~seam]))}
+        if reference is not None:
+            difference = np.ma.abs(
+                field - np.ma.masked_invalid(
+                    reference[0].fields[name]['data']))
+            result['seam_difference'] = float(np.ma.mean(difference[seam]))
+            result['interior_difference'] = float(
+                np.ma.mean(difference[~seam]))
+            result['max_seam_difference'] = float(
+                np.ma.max(difference[seam]))
+        diagnostic[name] = result
+    return diagnostic
@@ -14,13 +14,21 @@ import math
 
 from .. import cost_functions
 from ..cost_functions import J_function, grad_J
-from scipy.optimize import fmin_l_bfgs_b
+from ..cost_functions import instrumentation
+from scipy.optimize import minimize, Bounds
 from scipy.interpolate import interp1d
 from scipy.signal import savgol_filter
 from matplotlib import pyplot as plt
-from copy import deepcopy
+from functools import partial
 
-from .angles import add_azimuth_as_field, add_elevation_as_field
+from . import multigrid as multigrid_
+from . import geometry
+from .geometry import get_pairwise_bca
+from . import tiling
+from . import linear_solver
+from . import preconditioner as preconditioner_
+from . import checkpoint as checkpoint_
+from .result import RetrievalResult
 
 num_evaluations = 0
 
@@ -32,7 +40,13 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
                       filt_iterations=2, mask_outside_opt=False, 
                       max_iterations=200, mask_w_outside_opt=True, 
                       filter_window=9, filter_order=4, min_bca=30.0, 
-                      max_bca=150.0, upper_bc=True):
+                      max_bca=150.0, upper_bc=True, fused_cost=True,
+                      backend='numpy', precision='float64', constraints=None,
+                      multigrid=False, multigrid_levels=None,
+                      tile_size=None, tile_overlap=8, tile_workers=None,
+                      geometry_cache_dir=None, solver='lbfgs',
+                      preconditioner=None, checkpoint_file=None,
+                      checkpoint_interval=50):
     """
     This function takes in a list of Py-ART Grids and derives a wind field.
 
@@ -114,15 +128,145 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     upper_bc: bool
         Set this to true to enforce w = 0 at the top of the atmosphere. This is
         commonly called the impermeability condition.
+    fused_cost: bool
+        If True, the cost function and its gradient are evaluated together
+        by a pydda.cost_functions.ConstraintRegistry holding only the terms
+        with a nonzero weight, so that each constraint's intermediate fields
+        are only computed once per iteration. Set to False to use the
+        separate J_function and grad_J callables.
+    backend: str
+        'numpy' to evaluate the constraints with NumPy, or 'numba' to use
+        the compiled stencil kernels in pydda.cost_functions.kernels. Only
+        used when fused_cost is True.
+    precision: str
+        'float64' or 'float32'. With 'float32' the wind field, observations,
+        data weights, geometry and the work arrays of the cost function are
+        stored in single precision, halving the memory traffic of each
+        iteration, while the cost function is still accumulated in float64.
+        The optimizer itself always works in float64. Only used when
+        fused_cost is True. The numba kernels do their arithmetic in
+        float64 and are limited by it rather than by memory traffic, so
+        with backend='numba' float32 saves memory but is not faster than
+        float64, and can be slightly slower. The convergence check on w
+        can also stop the solver at a different iteration in float32, so
+        retrievals stopped well before the minimum can differ from
+        float64 by much more than the rounding error.
+    constraints: list of pydda.cost_functions.Constraint
+        Additional constraints to add to the cost function, such as
+        user defined subclasses of pydda.cost_functions.Constraint. Only
+        used when fused_cost is True.
+    multigrid: bool
+        If True, first solve the retrieval on a hierarchy of grids
+        coarsened by a factor of 2 in x and y, from the coarsest up, and use
+        each solution interpolated to the next finer grid as its initial
+        guess. The coarse levels use the same constraints and weights as
+        the full grid and stop on the same criteria. Their iterations and
+        evaluations are included in the diagnostics of the result, which
+        also lists them for each coarse level under 'multigrid'. Requires
+        fused_cost=True and no additional constraints.
+    multigrid_levels: int
+        Number of coarse levels used when multigrid is True. None uses as
+        many as possible while keeping at least 16 points in x and y on the
+        coarsest grid.
+    tile_size: int, 2-tuple of ints or None
+        If not None, split the grid into horizontal tiles of this many
+        points in y and x, retrieve each tile independently in parallel and
+        blend the tiles where they overlap. Use
+        pydda.retrieval.tile_seam_diagnostic to check the seams. Requires
+        fused_cost=True and no additional constraints.
+    tile_overlap: int
+        Number of points each tile extends past the edges it shares with
+        other tiles. The tiles are blended over twice this width.
+    tile_workers: int or None
+        Number of processes retrieving tiles at the same time. None uses
+        one per CPU. 1 retrieves the tiles one after the other.
+    geometry_cache_dir: str or None
+        Directory where the azimuth, elevation and beam crossing angles of
+        the radars are stored, keyed by radar location and grid
+        specification. Later retrievals with the same radars and grid, in
+        this or other processes, load them memory mapped instead of
+        computing them. None keeps them in memory for this process only.
+    solver: str
+        'lbfgs' to minimize the cost function with L-BFGS-B, or 'cg' to
+        solve it as a linear system with preconditioned conjugate
+        gradients, see pydda.retrieval.linear_solver. 'cg' requires
+        fused_cost=True and a cost function made only of quadratic
+        constraints, so Cv must be 0. It usually reaches the minimum in far
+        fewer evaluations of the cost function, runs until the gradient has
+        dropped by a factor of 1000 or max_iterations is reached, and does
+        not bound the winds to +/- 100 m/s.
+    preconditioner: str or None
+        'spectral' to precondition the solver with a Fourier diagonalized
+        approximation of the cost function, see
+        pydda.retrieval.preconditioner. With L-BFGS-B this is a change of
+        variables, under which the winds are not bounded to +/- 100 m/s.
+        It usually cuts the number of iterations by a large factor, most
+        of all with strong mass continuity or smoothness constraints. None
+        uses no preconditioner with L-BFGS-B and a diagonal one with
+        conjugate gradients. Requires fused_cost=True.
+    checkpoint_file: str or None
+        Path of a local file the state of the solver is saved to every
+        checkpoint_interval iterations, see pydda.retrieval.checkpoint. If
+        the file exists and was written by a retrieval with the same
+        inputs and settings, the retrieval resumes from it, and gives the
+        same result as if it had not been interrupted. To make this
+        possible, L-BFGS-B is restarted at every checkpoint, which can cost
+        some extra iterations. Not supported with solver='cg' or
+        tile_size.
+    checkpoint_interval: int
+        Number of iterations between checkpoints, rounded up to a multiple
+        of 10.
     
     Returns
     =======
-    new_grid_list: list
-        A list of Py-ART grids containing the derived wind field. These fields
-        are displayable by the visualization module.
+    result: pydda.retrieval.RetrievalResult
+        The derived wind field. Use result.to_grids() to get a list of
+        Py-ART grids containing it, which are displayable by the
+        visualization module.
+
+    Run the retrieval inside pydda.cost_functions.instrument() to record
+    the time spent in each stage of the retrieval and in each constraint.
+
+    The azimuth, elevation and beam crossing angles of the radars are
+    cached by grid specification, so consecutive volumes on the same grid
+    skip their computation. They are not added to Grids; use
+    pydda.retrieval.geometry.add_geometry_fields to look at them. For
+    consecutive volumes, initializing with
+    pydda.initialization.make_initialization_from_previous usually cuts
+    the number of iterations needed to converge.
     """
     
     num_evaluations = 0
+
+    if precision not in ('float32', 'float64'):
+        raise ValueError("precision must be 'float32' or 'float64'")
+    if solver not in ('lbfgs', 'cg'):
+        raise ValueError("solver must be 'lbfgs' or 'cg'")
+    if(solver == 'cg' and (fused_cost == False or Cv != 0)):
+        raise ValueError("solver='cg' requires fused_cost=True and Cv=0")
+    if preconditioner not in (None, 'spectral'):
+        raise ValueError("preconditioner must be None or 'spectral'")
+    if(preconditioner is not None and fused_cost == False):
+        raise ValueError('preconditioner requires fused_cost=True')
+    if(checkpoint_file is not None and
+       (solver == 'cg' or tile_size is not None)):
+        raise ValueError(("checkpoint_file is not supported with " +
+                          "solver='cg' or tile_size"))
+    if(fused_cost == False):
+        precision = 'float64'
+        if constraints is not None:
+            raise ValueError('constraints require fused_cost=True')
+        if(multigrid == True):
+            raise ValueError('multigrid requires fused_cost=True')
+    if(multigrid == True and constraints is not None):
+        raise ValueError('multigrid does not support additional constraints')
+    if tile_size is not None:
+        if(fused_cost == False or constraints is not None or
+           multigrid == True):
+            raise ValueError(('tile_size requires fused_cost=True, no ' +
+                              'additional constraints and multigrid=False'))
+    dtype = np.dtype(precision)
+    instrumentation.stage('setup')
     
     if(Ut == None or Vt == None):
         if(Cv != 0.0):
@@ -155,70 +299,34 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     # Parse names of velocity field
     if vel_name is None:
         vel_name = pyart.config.get_field_name('corrected_velocity')    
-    winds = np.stack([u_init, v_init, w_init])
+    winds = np.stack([u_init, v_init, w_init]).astype(dtype)
     wts = []
     vrs = []
     azs = []
     els = []
     
-    # Set up wind fields and weights from each radar
-    weights = np.zeros(
-        (len(Grids), u_init.shape[0], u_init.shape[1], u_init.shape[2]))
-    bg_weights = np.zeros(v_init.shape)
-    bca = np.zeros(
-        (len(Grids), len(Grids), u_init.shape[1], u_init.shape[2]))
-    M = np.zeros(len(Grids))
     sum_Vr = np.zeros(len(Grids))
+    cache = geometry.get_cache(geometry_cache_dir)
 
     for i in range(len(Grids)):
         wts.append(cost_functions.calculate_fall_speed(Grids[i], 
                                                        refl_field=refl_field))
-        add_azimuth_as_field(Grids[i])
-        add_elevation_as_field(Grids[i])
         vrs.append(Grids[i].fields[vel_name]['data'])
-        azs.append(Grids[i].fields['AZ']['data']*np.pi/180)
-        els.append(Grids[i].fields['EL']['data']*np.pi/180)
-        
-    for i in range(len(Grids)):    
-        for j in range(i+1, len(Grids)):
-            print(("Calculating weights for radars " + str(i) +
-                   " and " + str(j)))
-            bca[i,j] = get_bca(Grids[i].radar_longitude['data'],
-                               Grids[i].radar_latitude['data'],
-                               Grids[j].radar_longitude['data'],
-                               Grids[j].radar_latitude['data'],
-                               Grids[i].point_x['data'][0],
-                               Grids[i].point_y['data'][0],
-                               Grids[i].get_projparams())
-
-            for k in range(vrs[i].shape[0]):
-                cur_array = weights[i,k]
-                cur_array[np.logical_and(
-                    vrs[i][k].mask == False,
-                    np.logical_and(
-                        bca[i,j] >= math.radians(min_bca), 
-                        bca[i,j] <= math.radians(max_bca)))] += 1
-                weights[i,k] = cur_array
-                cur_array = weights[j,k]
-                cur_array[np.logical_and(
-                    vrs[j][k].mask == False,
-                    np.logical_and(
-                        bca[i,j] >= math.radians(min_bca), 
-                        bca[i,j] <= math.radians(max_bca)))] += 1
-                weights[j,k] = cur_array
-                cur_array = bg_weights[k]
-                cur_array[np.logical_or(
-                    bca[i,j] >= math.radians(min_bca),
-                    bca[i,j] <= math.radians(max_bca))] = 1
-                cur_array[vrs[i][k].mask == True] = 0
-                bg_weights[i] = cur_array
-    
-    weights[weights > 0] = 1            
-    sum_Vr = np.sum(np.square(vrs*weights))
+        azs.append(geometry.get_azimuth(Grids[i], cache))
+        els.append(geometry.get_elevation(Grids[i], cache))
+
+    # Set up weights from each radar
+    instrumentation.stage('weights')
+    print('Calculating weights for ' + str(len(Grids)) + ' radars')
+    pairs, bca = geometry.get_cached_pairwise_bca(Grids, cache)
+    weights, bg_weights = get_weights(vrs, pairs, bca, min_bca, max_bca,
+                                      dtype=dtype)
+
+    for i in range(len(Grids)):
+        sum_Vr[i] = np.sum(np.square(np.ma.getdata(vrs[i]))*weights[i])
 
     rmsVr = np.sum(sum_Vr)/np.sum(weights)
     
-    del bca
     grid_shape = u_init.shape
     # Parse names of velocity field
 
@@ -227,103 +335,119 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
 
     ndims = len(winds)
 
+    instrumentation.stage('solve')
     print(("Starting solver "))
     dx = np.diff(Grids[0].x['data'], axis=0)[0]
     dy = np.diff(Grids[0].y['data'], axis=0)[0]
     dz = np.diff(Grids[0].z['data'], axis=0)[0]
     print('rmsVR = ' + str(rmsVr))
     print('Total points:' +str(weights.sum()))
-    z = Grids[0].point_z['data']
+    z = Grids[0].point_z['data'].astype(dtype)
 
     the_time = time.time()
     bt = time.time()
     
-    # First pass - no filter
-    wcurr = w_init
-    wprev = 100*np.ones(w_init.shape)
-    wprevmax = 99
-    wcurrmax = w_init.max()
-    iterations = 0
-    warnflag = 99999
-    coeff_max = np.max([Co, Cb, Cm, Cx, Cy, Cz, Cb])
-    bounds = [(-x,x) for x in 100*np.ones(winds.shape)]
-    while(iterations < max_iterations and 
-          (abs(wprevmax-wcurrmax) > 0.02)):
-        wprevmax = wcurrmax
-        winds = fmin_l_bfgs_b(J_function, winds, args=(vrs, azs, els, 
-                                                       wts, u_back, v_back,
-                                                       Co, Cm, Cx, Cy, Cz, Cb,
-                                                       Cv, Ut, Vt,
-                                                       grid_shape,  
-                                                       dx, dy, dz, z, rmsVr, 
-                                                       weights, bg_weights,
-                                                       upper_bc),
-                                maxiter=10, pgtol=1e-3, bounds=bounds, 
-                                fprime=grad_J, disp=1, iprint=-1)
-        
-
-        # Print out cost function values after 10 iterations
-        J = J_function(winds[0], vrs, azs, els, wts, u_back, v_back,
-                       Co, Cm, Cx, Cy, Cz, Cb, Cv, Ut, Vt, grid_shape,  
-                       dx, dy, dz, z, rmsVr, weights, bg_weights, upper_bc=True,
-                       print_out=True)
-        J = grad_J(winds[0], vrs, azs, els, wts, u_back, v_back,
-                   Co, Cm, Cx, Cy, Cz, Cb, Cv, Ut, Vt, grid_shape,  
-                   dx, dy, dz, z, rmsVr, weights, bg_weights, upper_bc=True,
-                   print_out=True)
-        
-        warnflag = winds[2]['warnflag']
-        
-        winds = np.reshape(winds[0], (3, grid_shape[0], grid_shape[1],
-                                           grid_shape[2]))
-        iterations = iterations+10
-        print('Iterations before filter: ' + str(iterations))
-        
-        wcurrmax = winds[2].max()
-        
-        winds = np.stack([winds[0], winds[1], winds[2]])
-        winds = winds.flatten()
-
-        
-    if(filt_iterations > 0):
-        print('Applying low pass filter to wind field...')
-        winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
-                                           grid_shape[2]))
-        winds[0] = savgol_filter(winds[0], 9, 3, axis=0)
-        winds[0] = savgol_filter(winds[0], 9, 3, axis=1)
-        winds[0] = savgol_filter(winds[0], 9, 3, axis=2)
-        winds[1] = savgol_filter(winds[1], 9, 3, axis=0)
-        winds[1] = savgol_filter(winds[1], 9, 3, axis=1)
-        winds[1] = savgol_filter(winds[1], 9, 3, axis=2)
-        winds[2] = savgol_filter(winds[2], 9, 3, axis=0)
-        winds[2] = savgol_filter(winds[2], 9, 3, axis=1)
-        winds[2] = savgol_filter(winds[2], 9, 3, axis=2)  
-        
-        winds = np.stack([winds[0], winds[1], winds[2]])
-        winds = winds.flatten()
-        iterations = 0
-        while(iterations < filt_iterations):
-            winds = fmin_l_bfgs_b(
-               J_function, winds, args=(
-                   vrs, azs, els, wts, u_back, v_back, Co, Cm, Cx, Cy, Cz, Cb,
-                   Cv, Ut, Vt, grid_shape, dx, dy, dz, z, rmsVr, weights, 
-                   bg_weights,upper_bc),
-               maxiter=10, pgtol=1e-3, bounds=bounds, 
-               fprime=grad_J, disp=1, iprint=-1)
-
-            warnflag = winds[2]['warnflag']
-        
-            winds = np.reshape(winds[0], (3, grid_shape[0], grid_shape[1],
-                                             grid_shape[2]))
-            iterations = iterations+1
-            print('Iterations after filter: ' + str(iterations))
-                
-            winds = np.stack([winds[0], winds[1], winds[2]])
-            winds = winds.flatten()
-            
-    print("Done! Time = " + "{:2.1f}".format(time.time() - bt))
+    cost_kwargs = dict(
+        rmsVr=rmsVr, u_back=u_back, v_back=v_back, Co=Co, Cm=Cm, Cx=Cx,
+        Cy=Cy, Cz=Cz, Cb=Cb, Cv=Cv, Ut=Ut, Vt=Vt, dx=dx, dy=dy, dz=dz,
+        upper_bc=upper_bc, backend=backend, dtype=dtype)
+    diagnostics = {'rmsVr': rmsVr}
+    checkpoint = None
+    state = None
+    if checkpoint_file is not None:
+        settings = dict(cost_kwargs, dtype=str(dtype),
+                        max_iterations=max_iterations,
+                        filt_iterations=filt_iterations,
+                        fused_cost=fused_cost, multigrid=multigrid,
+                        multigrid_levels=multigrid_levels,
+                        preconditioner=preconditioner,
+                        constraints=[c.name for c in constraints or []])
+        backgrounds = [np.asarray(settings.pop(name), dtype=np.float64)
+                       for name in ('u_back', 'v_back')
+                       if settings[name] is not None]
+        key = checkpoint_.retrieval_key(
+            [weights, bg_weights, winds] + vrs + wts + backgrounds,
+            settings)
+        checkpoint = checkpoint_.Checkpoint(checkpoint_file, key,
+                                            checkpoint_interval)
+        state = checkpoint.load()
+        if state is not None:
+            print('Resuming from checkpoint ' + checkpoint_file)
+            diagnostics.update(state['diagnostics'])
+    if(tile_size is not None):
+        winds = tiling.solve_tiles(
+            np.reshape(winds, (3,) + grid_shape),
+            (vrs, azs, els, wts, weights, bg_weights, z), cost_kwargs,
+            max_iterations, filt_iterations, tile_size, tile_overlap,
+            tile_workers, diagnostics, solver=solver,
+            preconditioner=preconditioner).flatten()
+    else:
+        if(fused_cost == True):
+            cost_function = _fused_cost_function(
+                vrs, azs, els, wts, weights, bg_weights, z,
+                constraints=constraints, **cost_kwargs)
+            cost_args = ()
+            cost_gradient = None
+        else:
+            cost_args = (vrs, azs, els, wts, u_back, v_back, Co, Cm, Cx, Cy,
+                         Cz, Cb, Cv, Ut, Vt, grid_shape, dx, dy, dz, z,
+                         rmsVr, weights, bg_weights, upper_bc)
+            # Every evaluation of the gradient reuses the buffers in one
+            # workspace
+            workspace = cost_functions.Workspace(grid_shape, dtype=dtype)
+            cost_function = J_function
+            cost_gradient = partial(grad_J, workspace=workspace)
+
+        if(multigrid == True and state is None):
+            if(multigrid_levels is None):
+                multigrid_levels = multigrid_.count_levels(grid_shape)
+            # Coarsen the inputs once per level, finest first
+            level_inputs = [(vrs, azs, els, wts, weights, bg_weights, z)]
+            level_winds = np.reshape(winds, (3,) + grid_shape)
+            for level in range(multigrid_levels):
+                level_inputs.append(
+                    multigrid_.coarsen_inputs(*level_inputs[-1]))
+                level_winds = multigrid_.coarsen_winds(level_winds)
+
+            # Solve from the coarsest level up, initializing each level
+            # with the solution of the level below it
+            for level in range(multigrid_levels, 0, -1):
+                level_shape = level_inputs[level][-1].shape
+                print(('Multigrid level ' + str(level) + ', grid shape ' +
+                       str(level_shape)))
+                level_kwargs = dict(cost_kwargs)
+                level_kwargs['dx'] = dx*2**level
+                level_kwargs['dy'] = dy*2**level
+                level_cost_function = _fused_cost_function(
+                    *level_inputs[level], **level_kwargs)
+                level_diagnostics = {}
+                level_winds = _minimize(
+                    level_cost_function, level_winds.flatten(), (), None,
+                    level_shape, max_iterations, dtype, level_diagnostics,
+                    solver=solver, upper_bc=upper_bc,
+                    preconditioner=_make_preconditioner(
+                        preconditioner, level_cost_function, upper_bc))
+                for name in ('iterations', 'evaluations'):
+                    diagnostics[name] = (diagnostics.get(name, 0) +
+                                         level_diagnostics.get(name, 0))
+                level_diagnostics['grid_shape'] = level_shape
+                diagnostics.setdefault('multigrid', []).append(
+                    level_diagnostics)
+                level_winds = multigrid_.refine_winds(
+                    np.reshape(level_winds, (3,) + level_shape),
+                    level_inputs[level - 1][-1].shape)
+            winds = level_winds.flatten()
+
+        winds = _solve(cost_function, winds, cost_args, cost_gradient,
+                       grid_shape, max_iterations, filt_iterations, dtype,
+                       diagnostics, solver=solver, upper_bc=upper_bc,
+                       preconditioner=preconditioner, checkpoint=checkpoint,
+                       state=state)
 
-    # First pass - no filter
+    solve_time = time.time() - bt
+    diagnostics['time'] = solve_time
+    print("Done! Time = " + "{:2.1f}".format(solve_time))
+    instrumentation.stage('output')
 
     the_winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
                                        grid_shape[2]))
@@ -331,45 +455,325 @@ def get_dd_wind_field(Grids, u_init, v_init, w_init, vel_name=None,
     v = the_winds[1]
     w = the_winds[2]
 
-    where_mask = np.sum(weights, axis=0)
+    coverage = np.count_nonzero(weights, axis=0).astype(np.uint8)
     if(mask_outside_opt==True):
-        u = np.ma.masked_where(where_mask < 1, u)
-        v = np.ma.masked_where(where_mask < 1, v)
-        w = np.ma.masked_where(where_mask < 1, w)
+        u = np.ma.masked_where(coverage < 1, u, copy=False)
+        v = np.ma.masked_where(coverage < 1, v, copy=False)
+        w = np.ma.masked_where(coverage < 1, w, copy=False)
     if(mask_w_outside_opt==True):
-        w = np.ma.masked_where(where_mask < 1, w)
-
-    u_field = deepcopy(Grids[0].fields[vel_name])
-    u_field['data'] = u
-    u_field['standard_name'] = 'u_wind'
-    u_field['long_name'] = 'meridional component of wind velocity'
-    u_field['min_bca'] = min_bca
-    u_field['max_bca'] = max_bca
-    v_field = deepcopy(Grids[0].fields[vel_name])
-    v_field['data'] = v
-    v_field['standard_name'] = 'v_wind'
-    v_field['long_name'] = 'zonal component of wind velocity' 
-    v_field['min_bca'] = min_bca
-    v_field['max_bca'] = max_bca
-    w_field = deepcopy(Grids[0].fields[vel_name])
-    w_field['data'] = w
-    w_field['standard_name'] = 'w_wind'
-    w_field['long_name'] = 'vertical component of wind velocity' 
-    w_field['min_bca'] = min_bca
-    w_field['max_bca'] = max_bca
+        w = np.ma.masked_where(coverage < 1, w, copy=False)
 
-    
-    new_grid_list = []
-    
-    for grid in Grids:
-        temp_grid = deepcopy(grid)
-        temp_grid.add_field('u', u_field, replace_existing=True)
-        temp_grid.add_field('v', v_field, replace_existing=True)
-        temp_grid.add_field('w', w_field, replace_existing=True)
-        
-        new_grid_list.append(temp_grid)
-        
-    return new_grid_list
+    result = RetrievalResult(
+        u, v, w, coverage, Grids, vel_name, min_bca=min_bca,
+        max_bca=max_bca, diagnostics=diagnostics)
+
+    instrumentation.stage(None)
+    return result
+
+
+def _fused_cost_function(vrs, azs, els, wts, weights, bg_weights, z,
+                         rmsVr, u_back, v_back, Co, Cm, Cx, Cy, Cz, Cb, Cv,
+                         Ut, Vt, dx, dy, dz, upper_bc=True, backend='numpy',
+                         dtype=np.float64, constraints=None):
+    """
+    Makes the constraint registry of a retrieval on the grid of z and sets
+    it up for that grid.
+    """
+    observations = cost_functions.make_radar_observations(
+        vrs, azs, els, wts, weights, dtype=dtype)
+    cost_function = cost_functions.make_constraints(
+        observations, rmsVr, u_back, v_back, bg_weights, Co, Cm, Cx, Cy,
+        Cz, Cb, Cv, Ut, Vt, upper_bc=upper_bc, backend=backend,
+        constraints=constraints)
+    cost_function.setup(z.shape, dx, dy, dz, z, dtype=dtype)
+    return cost_function
+
+
+def _make_preconditioner(name, cost_function, upper_bc=True):
+    """
+    Returns the preconditioner called name for the constraint registry
+    cost_function, or None if name is None.
+    """
+    if name is None:
+        return None
+    instrumentation.stage('preconditioner')
+    preconditioner = preconditioner_.SpectralPreconditioner(
+        cost_function, upper_bc)
+    instrumentation.stage('solve')
+    return preconditioner
+
+
+def _solve(cost_function, winds, cost_args, cost_gradient, grid_shape,
+           max_iterations, filt_iterations, dtype, diagnostics=None,
+           solver='lbfgs', upper_bc=True, preconditioner=None,
+           checkpoint=None, state=None):
+    """
+    Minimizes the cost function until convergence, then, if
+    filt_iterations is greater than 0, applies the low pass filter and
+    runs 10*filt_iterations more iterations. The arguments are those of
+    _minimize, except that preconditioner is None or the name of the
+    preconditioner, which is built once for both runs. If state, loaded
+    from checkpoint, is given the solver continues from it.
+    """
+    if(diagnostics is None):
+        diagnostics = {}
+    stage = checkpoint_.SOLVE
+    if state is not None:
+        stage = state['stage']
+        winds = state['winds']
+        if(stage == checkpoint_.DONE):
+            return np.asarray(winds, dtype=dtype)
+    preconditioner = _make_preconditioner(preconditioner, cost_function,
+                                          upper_bc)
+    if(stage == checkpoint_.SOLVE):
+        winds = _minimize(cost_function, winds, cost_args, cost_gradient,
+                          grid_shape, max_iterations, dtype, diagnostics,
+                          solver=solver, upper_bc=upper_bc,
+                          preconditioner=preconditioner,
+                          checkpoint=checkpoint, resume=state)
+        state = None
+    if(filt_iterations > 0):
+        if(stage == checkpoint_.SOLVE):
+            instrumentation.stage('filter')
+            print('Applying low pass filter to wind field...')
+            the_winds = np.reshape(winds, (3, grid_shape[0], grid_shape[1],
+                                           grid_shape[2]))
+            the_winds[0] = savgol_filter(the_winds[0], 9, 3, axis=0)
+            the_winds[0] = savgol_filter(the_winds[0], 9, 3, axis=1)
+            the_winds[0] = savgol_filter(the_winds[0], 9, 3, axis=2)
+            the_winds[1] = savgol_filter(the_winds[1], 9, 3, axis=0)
+            the_winds[1] = savgol_filter(the_winds[1], 9, 3, axis=1)
+            the_winds[1] = savgol_filter(the_winds[1], 9, 3, axis=2)
+            the_winds[2] = savgol_filter(the_winds[2], 9, 3, axis=0)
+            the_winds[2] = savgol_filter(the_winds[2], 9, 3, axis=1)
+            the_winds[2] = savgol_filter(the_winds[2], 9, 3, axis=2)
+            if checkpoint is not None:
+                checkpoint.save(winds, checkpoint_.FILTERED, 0,
+                                the_winds[2].max(), diagnostics)
+
+        instrumentation.stage('solve')
+        winds = _minimize(cost_function, winds, cost_args, cost_gradient,
+                          grid_shape, 10*filt_iterations, dtype,
+                          diagnostics, check_w=False,
+                          label='Iterations after filter: ', solver=solver,
+                          upper_bc=upper_bc, preconditioner=preconditioner,
+                          checkpoint=checkpoint,
+                          stage=checkpoint_.FILTERED, resume=state)
+    if checkpoint is not None:
+        checkpoint.save(winds, checkpoint_.DONE, 0,
+                        np.reshape(winds, (3,) + grid_shape)[2].max(),
+                        diagnostics)
+    return winds
+
+
+class _Converged(Exception):
+    """
+    Raised by the optimizer callback to stop the solver once w has
+    converged.
+    """
+    def __init__(self, winds):
+        Exception.__init__(self)
+        self.winds = winds
+
+
+class _SolverMonitor(object):
+    """
+    Cost function and iteration callback of a run of L-BFGS-B.
+
+    It keeps the cost and gradient of the last evaluation so that the
+    progress is printed every 10 iterations without evaluating the cost
+    function again. L-BFGS-B accepts an iterate only after evaluating the
+    cost function there, so these are the values at the iterate passed to
+    the callback.
+
+    When the optimizer works in preconditioned variables, set to_winds to
+    the function that returns the wind field of an iterate.
+    """
+    def __init__(self, cost_function, cost_args, cost_gradient, grid_shape,
+                 check_w=True, label='Iterations before filter: '):
+        self.to_winds = np.asarray
+        self.cost_function = cost_function
+        self.cost_args = cost_args
+        self.cost_gradient = cost_gradient
+        self.grid_shape = grid_shape
+        self.check_w = check_w
+        self.label = label
+        self.n_evaluations = 0
+        self.n_iterations = 0
+        self.cost = None
+        self.grad = None
+        self.values = None
+        self.wprevmax = None
+
+    def __call__(self, winds):
+        self.n_evaluations += 1
+        if(self.cost_gradient is not None):
+            self.cost = self.cost_function(winds, *self.cost_args)
+            self.grad = self.cost_gradient(winds, *self.cost_args)
+        elif(hasattr(self.cost_function, 'evaluate')):
+            self.cost, self.grad, self.values = self.cost_function.evaluate(
+                winds)
+        else:
+            self.cost, self.grad = self.cost_function(winds, *self.cost_args)
+        return self.cost, self.grad
+
+    def print_progress(self, winds):
+        max_w = np.abs(np.reshape(winds, (3,) + self.grid_shape)[2]).max()
+        grad_norm = np.linalg.norm(self.grad, np.inf)
+        if(self.values is not None):
+            self.cost_function.print_values(self.values, max_w, grad_norm)
+        else:
+            print('|    J    | Max w  ')
+            print('|' + "{:9.4f}".format(self.cost) + '|' +
+                  "{:9.4f}".format(max_w))
+            print('Norm of gradient: ' + str(grad_norm))
+
+    def callback(self, x):
+        self.n_iterations += 1
+        if(self.n_iterations % 10 != 0):
+            return
+        winds = self.to_winds(x)
+        self.print_progress(winds)
+        print(self.label + str(self.n_iterations))
+        if(self.check_w == True):
+            wcurrmax = np.reshape(winds, (3,) + self.grid_shape)[2].max()
+            if(abs(self.wprevmax - wcurrmax) <= 0.02):
+                raise _Converged(np.array(winds))
+            self.wprevmax = wcurrmax
+
+
+def _minimize(cost_function, winds, cost_args, cost_gradient, grid_shape,
+              max_iterations, dtype, diagnostics=None, check_w=True,
+              label='Iterations before filter: ', solver='lbfgs',
+              upper_bc=True, preconditioner=None, checkpoint=None,
+              stage=checkpoint_.SOLVE, resume=None):
+    """
+    Minimizes the cost function with a single run of L-BFGS-B, until
+    max_iterations is reached or the maximum vertical velocity changes
+    by no more than 0.02 m/s over 10 iterations. With solver='cg' it is
+    minimized by pydda.retrieval.linear_solver.solve_cg instead.
+
+    Parameters
+    ----------
+    cost_function: callable
+        Cost function, or cost function and gradient if cost_gradient is
+        None.
+    winds: 1D float array
+        Initial guess of the flattened (u, v, w) wind field.
+    cost_args: tuple
+        Extra arguments of cost_function and cost_gradient.
+    cost_gradient: callable or None
+        Gradient of the cost function.
+    grid_shape: tuple
+        Shape of the analysis grid.
+    max_iterations: int
+        Maximum number of iterations, rounded up to a multiple of 10.
+    dtype: numpy dtype
+        Storage precision of the wind field.
+    diagnostics: dict or None
+        If given, the number of iterations and of evaluations of the cost
+        function are added to its 'iterations' and 'evaluations', and the
+        final cost is stored in 'cost'.
+    check_w: bool
+        Set to False to run max_iterations without checking the
+        convergence of w.
+    label: str
+        Printed before the number of iterations every 10 iterations.
+    solver: str
+        'lbfgs' or 'cg'. 'cg' requires a ConstraintRegistry of quadratic
+        constraints as the cost function and ignores check_w.
+    upper_bc: bool
+        True if w is fixed at the top of the domain. Only used by 'cg'.
+    preconditioner: SpectralPreconditioner or None
+        If given, L-BFGS-B minimizes the cost function without bounds in
+        the variables of a pydda.retrieval.preconditioner.ChangeOfVariables,
+        and conjugate gradients use it instead of the diagonal
+        preconditioner.
+    checkpoint: pydda.retrieval.checkpoint.Checkpoint or None
+        If given, L-BFGS-B is restarted every checkpoint.interval
+        iterations and the state is saved to the checkpoint before each
+        restart.
+    stage: int
+        Stage of the solver saved in the checkpoint.
+    resume: dict or None
+        State loaded from the checkpoint to continue from. Its winds must
+        be passed as winds.
+
+    Returns
+    -------
+    winds: 1D float array
+        The flattened (u, v, w) wind field.
+    """
+    if(max_iterations <= 0):
+        return winds
+    if(solver == 'cg'):
+        return linear_solver.solve_cg(
+            cost_function, winds, grid_shape, max_iterations, dtype,
+            upper_bc=upper_bc, diagnostics=diagnostics, label=label,
+            preconditioner=(preconditioner if preconditioner is not None
+                            else 'jacobi'))
+    n_runs = int(math.ceil(max_iterations/10.0))
+    if(diagnostics is None):
+        diagnostics = {}
+    done = 0
+    wprevmax = np.reshape(winds, (3,) + grid_shape)[2].max()
+    if resume is not None:
+        done = resume['iterations']
+        wprevmax = resume['wprevmax']
+    segment = 10*n_runs if checkpoint is None else checkpoint.interval
+    while True:
+        monitor = _SolverMonitor(cost_function, cost_args, cost_gradient,
+                                 grid_shape, check_w, label)
+        monitor.n_iterations = done
+        monitor.wprevmax = wprevmax
+        winds, cost, finished = _run_lbfgs(
+            monitor, winds, min(segment, 10*n_runs - done), preconditioner)
+        diagnostics['iterations'] = (diagnostics.get('iterations', 0) +
+                                     monitor.n_iterations - done)
+        diagnostics['evaluations'] = (diagnostics.get('evaluations', 0) +
+                                      monitor.n_evaluations)
+        diagnostics['cost'] = float(cost)
+        winds = np.asarray(winds, dtype=dtype)
+        done = monitor.n_iterations
+        wprevmax = monitor.wprevmax
+        if(finished or done >= 10*n_runs):
+            return winds
+        checkpoint.save(winds, stage, done, wprevmax, diagnostics)
+
+
+def _run_lbfgs(monitor, winds, max_iterations, preconditioner=None):
+    """
+    Runs L-BFGS-B for at most max_iterations iterations on the cost
+    function of monitor.
+
+    Returns
+    -------
+    winds: 1D float array
+        The flattened (u, v, w) wind field.
+    cost: float
+        The cost at winds.
+    finished: bool
+        True if the run stopped before max_iterations, because w or the
+        optimizer converged.
+    """
+    n_runs = int(math.ceil(max_iterations/10.0))
+    if preconditioner is None:
+        fun, x0, bounds = monitor, winds, Bounds(-100.0, 100.0)
+    else:
+        fun = preconditioner_.ChangeOfVariables(monitor, preconditioner,
+                                                winds)
+        x0, bounds = np.zeros(len(winds)), None
+        monitor.to_winds = fun.winds
+    try:
+        result = minimize(
+            fun, x0, method='L-BFGS-B', jac=True, bounds=bounds,
+            callback=monitor.callback,
+            options={'maxiter': max_iterations, 'maxfun': 15000*n_runs,
+                     'gtol': 1e-3})
+    except _Converged as converged:
+        return converged.winds, monitor.cost, True
+    return (monitor.to_winds(result.x), result.fun,
+            result.nit < max_iterations)
 
 
 """ Makes a initialization wind field that is a constant everywhere"""
@@ -575,9 +979,55 @@ def get_bca(rad1_lon, rad1_lat,
     a = np.sqrt(np.multiply(x,x)+np.multiply(y,y))
     b = np.sqrt(pow(x-rad2[0],2)+pow(y-rad2[1],2))
     c = np.sqrt(rad2[0]*rad2[0]+rad2[1]*rad2[1])
-    theta_1 = np.arccos(x/a)
-    theta_2 = np.arccos((x-rad2[1])/b)
     return np.arccos((a*a+b*b-c*c)/(2*a*b))
 
 
+def get_weights(vrs, pairs, bca, min_bca=30.0, max_bca=150.0,
+                dtype=np.float64):
+    """
+    This function calculates the data weights of each radar and the weights
+    of the background constraint.
+
+    A radar's observations get a weight of 1 where it has data and its beam
+    crosses the beam of at least one other radar at an angle between
+    min_bca and max_bca.
+
+    Parameters
+    ==========
+    vrs: list of 3D masked arrays
+        The radial velocity of each radar.
+    pairs: list of 2-tuples
+        The pairs of radars, as returned by get_pairwise_bca.
+    bca: 3D float array
+        The beam crossing angle of each pair, as returned by
+        get_pairwise_bca.
+    min_bca: float
+        Minimum beam crossing angle in degrees.
+    max_bca: float
+        Maximum beam crossing angle in degrees.
+    dtype: numpy dtype
+        Data type of the weights.
+
+    Returns
+    =======
+    weights: 4D float array
+        The weights of each radar, with shape (len(vrs), nz, ny, nx).
+    bg_weights: 3D float array
+        The weights of the background constraint.
+    """
+    grid_shape = vrs[0].shape
+    has_data = np.stack([~np.ma.getmaskarray(vr) for vr in vrs])
+    in_range = np.logical_and(bca >= math.radians(min_bca),
+                              bca <= math.radians(max_bca))
+
+    # Horizontal points where each radar crosses the beam of another
+    crossed = np.zeros((len(vrs),) + grid_shape[1:], dtype=bool)
+    bg_weights = np.zeros(grid_shape, dtype=dtype)
+    for p, (i, j) in enumerate(pairs):
+        crossed[i] |= in_range[p]
+        crossed[j] |= in_range[p]
+        bg_weights[:, np.isfinite(bca[p])] = 1
+        bg_weights[~has_data[i]] = 0
 
+    weights = np.logical_and(has_data, crossed[:, np.newaxis]).astype(dtype)
+    return weights, bg_weights
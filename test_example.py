@@ -21,13 +21,14 @@ u_init, v_init, w_init = pydda.retrieval.make_wind_field_from_profile(cpol_grid,
 
 berr_grid.fields['DT']['data'] = cpol_grid.fields['DT']['data']
 # Step 1 - do iterations with just data
-Grids = pydda.retrieval.get_dd_wind_field([berr_grid, cpol_grid], u_init,
+result = pydda.retrieval.get_dd_wind_field([berr_grid, cpol_grid], u_init,
                                             v_init, w_init,u_back=u_back,
                                             v_back=v_back, z_back=z_back,
                                             Co=100.0, Cm=1500.0, vel_name='VT', 
                                             refl_field='DT', frz=5000.0, 
                                             filt_iterations=0,
                                             mask_w_outside_opt=False)
+Grids = result.to_grids()
 
 plt.figure(figsize=(8,8))
 pydda.vis.plot_horiz_xsection_barbs(Grids, 'DT', level=6,